@@ -1,32 +1,114 @@
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import os
 import json
+import asyncio
 from api_client import ModelClient
-from tqdm import tqdm
-import json_repair
-import base64
+from pair_index import iter_candidate_pairs
+from ingest import iter_image_files, limit_items
+from journal import RunJournal
+from prompts import PromptBuilder
+from scheduler import PairScheduler
+from store import CorpusStore
+from streaming import extract_json
+
+# 场景描述生成失败时返回的占位文本
+SCENE_DESCRIPTION_FAILED = "场景描述生成失败"
+# 问答对必需的键
+QA_KEYS = ('question', 'answer')
+
 
 class ImageAnalyzer:
-    def __init__(self, client: ModelClient):
+    def __init__(self, client: ModelClient, journal: RunJournal = None, prompts: PromptBuilder = None,
+                 store: CorpusStore = None):
         self.client = client
+        # 断点续跑日志，为 None 时每次运行都从头开始
+        self.journal = journal
+        # 图片分析结果和配对结论的磁盘存储，提供时代替日志的对应阶段，结果不再全部保留在内存中
+        self.store = store
+        # 构建紧凑提示词并统计 token 数，缓存每张图片的序列化片段
+        self.prompts = prompts or PromptBuilder(metrics=client.metrics)
+        # 记录分析失败的图片及原因，格式为 {image_name: error_message}
+        self.failed_images = {}
+
+    def _restore_image_info(self, image_file: str):
+        """从存储或日志中恢复已分析过的图片信息，未分析过时返回 None"""
+        if self.store is not None:
+            return self.store.restore_image(image_file)
+        if self.journal is None:
+            return None
+        return self.journal.get(RunJournal.ANALYZE, image_file)
+
+    def _save_image_info(self, image_file: str, info: Dict):
+        """将图片分析结果写入存储或日志，生成失败的描述不记录，下次运行时重试"""
+        if info['description'] == SCENE_DESCRIPTION_FAILED:
+            return
+        if self.store is not None:
+            self.store.save_image(image_file, info)
+        elif self.journal is not None:
+            self.journal.record(RunJournal.ANALYZE, image_file, info)
+
+    def _restore_pair(self, ref_name: str, test_name: str):
+        """从存储或日志中恢复已判断过的配对，格式为 {'match': bool, 'qa_pair': dict}，未判断过时返回 None"""
+        if self.store is not None:
+            return self.store.restore_pair(ref_name, test_name)
+        if self.journal is None:
+            return None
+        return self.journal.get(RunJournal.PAIR, RunJournal.pair_key(ref_name, test_name))
+
+    def _save_pair(self, ref_name: str, test_name: str, is_match: Optional[bool], qa_pair: Dict):
+        """将配对判断结果写入存储或日志，判断或问答生成失败的配对不记录，下次运行时重试"""
+        if is_match is None or (is_match and not qa_pair):
+            return
+        if self.store is not None:
+            self.store.save_pair(ref_name, test_name, is_match, qa_pair)
+        elif self.journal is not None:
+            self.journal.record(RunJournal.PAIR, RunJournal.pair_key(ref_name, test_name),
+                                {'match': is_match, 'qa_pair': qa_pair})
+
+    def _iter_image_files(self, image_dir: str, annotations: Dict, limit: int = None,
+                          offset: int = 0, image_files: Iterable[str] = None) -> Iterator[str]:
+        """逐个产出待分析的图片文件名，只包含有标注数据的图片
+        Args:
+            image_dir: 图片目录路径
+            annotations: 图片标注数据字典
+            limit: 最多分析的图片数，为 None 时不限制
+            offset: 跳过的图片数
+            image_files: 指定待分析的文件名序列，为 None 时遍历 image_dir
+        """
+        if image_files is None:
+            image_files = iter_image_files(image_dir)
+        annotated = (f for f in image_files if annotations and f in annotations)
+        return limit_items(annotated, limit, offset)
         
-    def analyze_images(self, image_dir: str, annotations: Dict = None, show_progress=False) -> Dict[str, Dict]:
+    def analyze_images(self, image_dir: str, annotations: Dict = None, show_progress=False,
+                       limit: int = None, offset: int = 0,
+                       image_files: Iterable[str] = None) -> Dict[str, Dict]:
         """分析目录下所有图片
         Args:
             image_dir: 图片目录路径
             annotations: 图片标注数据字典，格式为 {image_name: annotation_data}
             show_progress: 是否显示进度条
+            limit: 最多分析的图片数，为 None 时不限制
+            offset: 跳过的图片数
+            image_files: 指定待分析的文件名序列，为 None 时遍历 image_dir
         """
         image_infos = {}
-        image_files = [f for f in os.listdir(image_dir) if f.endswith(('.jpg', '.jpeg', '.png'))][:5]
+        image_files = self._iter_image_files(image_dir, annotations, limit, offset, image_files)
         
-        iterator = tqdm(image_files) if show_progress else image_files
+        if show_progress:
+            from tqdm import tqdm
+        iterator = tqdm(image_files, total=limit) if show_progress else image_files
         for image_file in iterator:
             if show_progress:
                 iterator.set_description(f"正在分析: {image_file}")
             
             try:
-                if annotations and image_file in annotations:
+                restored = self._restore_image_info(image_file)
+                if restored is not None:
+                    # 上次运行已分析过，直接复用
+                    if self.store is None:
+                        image_infos[image_file] = restored
+                elif annotations and image_file in annotations:
                     # 获取标注数据中的 objects
                     objects = annotations[image_file].get('objects', [])
                     
@@ -37,12 +119,18 @@ class ImageAnalyzer:
                     
                     # 使用模型生成场景描述
                     description = self._generate_scene_description(objects, image_data)
+                    if description == SCENE_DESCRIPTION_FAILED:
+                        # 重试耗尽仍失败的图片记为分析失败，不带着占位描述进入配对
+                        raise RuntimeError(SCENE_DESCRIPTION_FAILED)
                     
                     # 保存标注数据和生成的描述
-                    image_infos[image_file] = {
+                    info = {
                         'annotation': annotations[image_file],
                         'description': description
                     }
+                    self._save_image_info(image_file, info)
+                    if self.store is None:
+                        image_infos[image_file] = info
                 
                 if show_progress:
                     objects_count = len(annotations.get(image_file, {}).get('objects', []))
@@ -53,162 +141,612 @@ class ImageAnalyzer:
             except Exception as e:
                 if show_progress:
                     iterator.set_postfix(status="失败")
+                self.failed_images[image_file] = str(e)
                 print(f"处理图片 {image_file} 时发生错误: {str(e)}")
         
-        return image_infos
+        # 使用存储时结果已写入数据库，返回按需读取的字典视图
+        return image_infos if self.store is None else self.store.infos()
+
+    async def analyze_images_async(self, image_dir: str, annotations: Dict = None,
+                                   show_progress=False, max_concurrency: int = 8,
+                                   limit: int = None, offset: int = 0,
+                                   image_files: Iterable[str] = None,
+                                   batch_size: int = 1) -> Dict[str, Dict]:
+        """并发分析目录下所有图片，返回格式与 analyze_images 一致
+        Args:
+            image_dir: 图片目录路径
+            annotations: 图片标注数据字典，格式为 {image_name: annotation_data}
+            show_progress: 是否显示进度条
+            max_concurrency: 同时进行中的模型请求数上限
+            limit: 最多分析的图片数，为 None 时不限制
+            offset: 跳过的图片数
+            image_files: 指定待分析的文件名序列，为 None 时遍历 image_dir
+            batch_size: 每个请求描述的图片数，大于 1 时多张图片合并为一次请求
+        """
+        image_infos = {}
+        annotations = annotations or {}
+        # 按需从文件流中取出图片，同一时刻最多只有 max_concurrency 个任务
+        pending_files = self._iter_image_files(image_dir, annotations, limit, offset, image_files)
+        submitted = []
+
+        async def analyze_group(group: List[str]):
+            if len(group) > 1:
+                return await self._describe_images_batch_async(image_dir, group, annotations)
+            image_file = group[0]
+            try:
+                description = await self._describe_image_async(image_dir, image_file, annotations[image_file])
+                return [(image_file, description, None)]
+            except Exception as e:
+                # 单张图片失败不影响整个批次
+                return [(image_file, None, e)]
+
+        in_flight = set()
+        if show_progress:
+            from tqdm import tqdm
+        progress = tqdm(total=limit) if show_progress else None
+        try:
+            while True:
+                exhausted = False
+                while len(in_flight) < max_concurrency and not exhausted:
+                    group = []
+                    while len(group) < batch_size:
+                        image_file = next(pending_files, None)
+                        if image_file is None:
+                            exhausted = True
+                            break
+                        restored = self._restore_image_info(image_file)
+                        if self.store is None:
+                            submitted.append(image_file)
+                        if restored is not None:
+                            # 上次运行已分析过，直接复用
+                            if self.store is None:
+                                image_infos[image_file] = restored
+                            if progress:
+                                progress.update(1)
+                            continue
+                        group.append(image_file)
+                    if group:
+                        in_flight.add(asyncio.ensure_future(analyze_group(group)))
+                if not in_flight:
+                    break
+
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for image_file, description, error in (r for task in done for r in task.result()):
+                    if error is None:
+                        info = {
+                            'annotation': annotations[image_file],
+                            'description': description
+                        }
+                        self._save_image_info(image_file, info)
+                        if self.store is None:
+                            image_infos[image_file] = info
+                    else:
+                        self.failed_images[image_file] = str(error)
+                        print(f"处理图片 {image_file} 时发生错误: {str(error)}")
+                    if progress:
+                        progress.set_description(f"已完成: {image_file}")
+                        progress.set_postfix(status="成功" if error is None else "失败",
+                                             failed=len(self.failed_images))
+                        progress.update(1)
+        finally:
+            for task in in_flight:
+                task.cancel()
+            if progress:
+                progress.close()
+
+        if self.store is not None:
+            # 结果已写入数据库，返回按需读取的字典视图，按图片首次写入的顺序遍历
+            return self.store.infos()
+        # 按目录顺序返回，保证与同步模式结果一致
+        return {f: image_infos[f] for f in submitted if f in image_infos}
+
+    async def _describe_image_async(self, image_dir: str, image_file: str, annotation: Dict) -> str:
+        """异步读取单张图片并生成场景描述，失败时抛出异常"""
+        objects = annotation.get('objects', [])
+        image_path = os.path.join(image_dir, image_file)
+        image_data = await asyncio.to_thread(self._load_image, image_path)
+        return await self._generate_scene_description_async(objects, image_data)
+
+    def _load_image(self, image_path: str) -> bytes:
+        """读取图片二进制数据并预先完成缩放和编码，避免阻塞事件循环"""
+        with open(image_path, 'rb') as f:
+            image_data = f.read()
+        self.client.preprocessor.to_data_url(image_data)
+        return image_data
     
-    def _generate_scene_description(self, objects: List[str], image_data: bytes) -> str:
-        """根据��和标注的物体列表生成场景描述
+    def _build_scene_description_messages(self, objects: List[str], image_data: bytes) -> List[Dict]:
+        """构建场景描述请求的消息列表
         Args:
             objects: 标注的物体列表
             image_data: 图片二进制数据
         """
-        prompt = f"""对以下标注物体描述其颜色、外观和行为，并以JSON格式返回：
-
-        物体列表：{', '.join(objects)}
+        return [{
+            'role': 'user',
+            'content': [{
+                'type': 'text',
+                'text': self.prompts.scene_description(objects),
+            }, self.client.image_content(image_data)],
+        }]
 
-        返回格式示例：
-        {{
-            "塔吊": "黄色高大塔吊，正在进行钢构件吊装",
-            "脚手架": "银灰色金属脚手架，已完成搭设并固定",
-            "安全网": "绿色密织安全网，完整覆盖外立面"
-        }}
-
-        要求：
-        1. 使用简洁的专业用语描述外观和行为
-        2. 只返回JSON格式数据
+    def _generate_scene_description(self, objects: List[str], image_data: bytes) -> str:
+        """根据图片和标注的物体列表生成场景描述
+        Args:
+            objects: 标注的物体列表
+            image_data: 图片二进制数据
         """
-        
         try:
-            response = self.client.client.chat.completions.create(
-                model=self.client.model,
-                messages=[{
-                    'role': 'user',
-                    'content': [{
-                        'type': 'text',
-                        'text': prompt,
-                    }, {
-                        'type': 'image_url',
-                        'image_url': {
-                            "url": f"data:image/jpeg;base64,{base64.b64encode(image_data).decode('utf-8')}",
-                        }
-                    }],
-                }],
+            content = self.client.chat(
+                messages=self._build_scene_description_messages(objects, image_data),
+                stage='scene_description',
                 temperature=0.7,
-                top_p=0.7
+                top_p=0.7,
+                json_root='{'
             )
             
-            return response.choices[0].message.content.strip()
+            return content.strip()
         except Exception as e:
+            self.client.metrics.count('scene_description_failed')
             print(f"生成场景描述失败: {str(e)}")
-            return "场景描述生成失败"
+            return SCENE_DESCRIPTION_FAILED
+
+    async def _generate_scene_description_async(self, objects: List[str], image_data: bytes) -> str:
+        """异步生成场景描述，失败时抛出异常由调用方记录"""
+        content = await self.client.achat(
+            messages=self._build_scene_description_messages(objects, image_data),
+            stage='scene_description',
+            temperature=0.7,
+            top_p=0.7,
+            json_root='{'
+        )
         
-    def create_reference_pairs(self, image_infos: Dict) -> List[Dict]:
-        """创建参照图对并生成问答"""
-        pairs_with_qa = []
-        image_names = list(image_infos.keys())
+        return content.strip()
+
+    def _build_batch_description_messages(self, items: List[Tuple[List[str], bytes]]) -> List[Dict]:
+        """构建多图场景描述请求的消息列表，每张图片前标注编号和物体列表，回复按编号对应
+        Args:
+            items: (标注的物体列表, 图片二进制数据) 列表
+        """
+        header, labels = self.prompts.scene_description_batch([objects for objects, _ in items])
+        content = [{'type': 'text', 'text': header}]
+        for label, (_, image_data) in zip(labels, items):
+            content.append({'type': 'text', 'text': label})
+            content.append(self.client.image_content(image_data))
         
-        # 两两配对遍历
-        for i in range(len(image_names)):
-            for j in range(i + 1, len(image_names)):
-                ref_name = image_names[i]
-                test_name = image_names[j]
-                
-                # 判断两张图片是否适合配对
-                is_match = self._check_pair_match(
-                    ref_name, 
-                    test_name,
-                    image_infos[ref_name],
-                    image_infos[test_name]
+        return [{
+            'role': 'user',
+            'content': content,
+        }]
+
+    @staticmethod
+    def _parse_batch_descriptions(content: str, size: int) -> Dict[int, str]:
+        """按图片编号拆分多图描述的回复，返回 {图片下标: 描述JSON文本}，缺失或格式不对的图片不出现在结果中"""
+        result = extract_json(content, '{')
+        descriptions = {}
+        for key, value in result.items() if isinstance(result, dict) else []:
+            raw_id = str(key).strip().upper().lstrip('I')
+            if not raw_id.isdigit() or not 1 <= int(raw_id) <= size:
+                continue
+            if isinstance(value, dict) and value:
+                # 与单图请求的回复保持同样的格式
+                descriptions[int(raw_id) - 1] = json.dumps(value, ensure_ascii=False)
+        return descriptions
+
+    async def _describe_images_batch_async(self, image_dir: str, image_files: List[str],
+                                           annotations: Dict) -> List[Tuple[str, Optional[str], Optional[Exception]]]:
+        """用一次请求描述多张图片，返回 [(图片文件名, 描述, 异常)]
+        回复中缺失或无法解析的图片退回到单图请求，单图请求失败时记录其异常。
+        """
+        image_datas = await asyncio.gather(*(
+            asyncio.to_thread(self._load_image, os.path.join(image_dir, image_file))
+            for image_file in image_files
+        ), return_exceptions=True)
+        loaded = [i for i, data in enumerate(image_datas) if not isinstance(data, Exception)]
+        descriptions = {}
+        if len(loaded) > 1:
+            items = [(annotations[image_files[i]].get('objects', []), image_datas[i]) for i in loaded]
+            try:
+                content = await self.client.achat(
+                    messages=self._build_batch_description_messages(items),
+                    stage='scene_description_batch',
+                    temperature=0.7,
+                    top_p=0.7,
+                    json_root='{'
                 )
-                
-                if is_match:
-                    # 如果适合配对，则生成问答对
-                    qa_pair = self._generate_qa_pair(
-                        ref_name, 
-                        test_name,
-                        image_infos[ref_name],
-                        image_infos[test_name]
-                    )
-                    
-                    if qa_pair:  # 如果成功生成问答对
+                descriptions = {loaded[i]: d for i, d in self._parse_batch_descriptions(content, len(items)).items()}
+            except Exception as e:
+                print(f"批量生成场景描述失败: {str(e)}")
+            self.client.metrics.count('images_batched', len(descriptions))
+
+        results = []
+        for i, image_file in enumerate(image_files):
+            if isinstance(image_datas[i], Exception):
+                results.append((image_file, None, image_datas[i]))
+            elif i in descriptions:
+                results.append((image_file, descriptions[i], None))
+            else:
+                results.append((image_file, None, None))
+        missing = [i for i, (_, description, error) in enumerate(results) if description is None and error is None]
+        if len(loaded) > 1 and missing:
+            self.client.metrics.count('describe_batch_fallback', len(missing))
+
+        async def fallback(i: int):
+            image_file = image_files[i]
+            try:
+                description = await self._generate_scene_description_async(
+                    annotations[image_file].get('objects', []), image_datas[i]
+                )
+                return image_file, description, None
+            except Exception as e:
+                return image_file, None, e
+
+        for i, result in zip(missing, await asyncio.gather(*(fallback(i) for i in missing))):
+            results[i] = result
+        return results
+        
+    def create_reference_pairs(self, image_infos: Dict, top_k: int = 10,
+                               only_images: Iterable[str] = None, fused: bool = True,
+                               batch_tokens: int = None, max_batch_pairs: int = 32,
+                               scheduler: PairScheduler = None) -> List[Dict]:
+        """创建参照图对并生成问答
+        Args:
+            image_infos: analyze_images 返回的图片信息
+            top_k: 每张图片交给模型判断的候选数，为 None 时遍历全部两两组合
+            only_images: 只为包含这些图片的候选对调用模型，用于增量运行；为 None 时不限制
+            fused: 是否用一次请求同时完成配对判断和问答生成，为 False 时分两次请求
+            batch_tokens: 批量判断时每个请求提示词的 token 预算，为 None 时逐对判断（仅在 fused 时生效）
+            max_batch_pairs: 批量判断时每个请求最多的候选对数
+            scheduler: 按优先级安排候选对，达到目标问答数或预算后停止；为 None 时按图片顺序判断全部候选对
+        Returns:
+            配对成功的问答列表；使用存储时为按页读取数据库的 MatchedPairView，可直接遍历
+        """
+        pairs_with_qa = []
+
+        def collect(ref_name: str, test_name: str, is_match: Optional[bool], qa_pair: Optional[Dict]):
+            if qa_pair and self.store is None:  # 如果成功生成问答对
+                pairs_with_qa.append({
+                    "reference": ref_name,
+                    "test": test_name,
+                    "qa_pair": qa_pair
+                })
+            self._save_pair(ref_name, test_name, is_match, qa_pair)
+            if scheduler is not None:
+                scheduler.record(ref_name, test_name, qa_pair, image_infos)
+
+        def skip(n: int = 1):
+            self.client.metrics.count('pairs_skipped', n)
+
+        def to_judge() -> Iterator[Tuple[str, str]]:
+            """依次产出需要请求模型的候选对，上次运行已判断过的直接复用"""
+            candidates = iter_candidate_pairs(image_infos, top_k, only_images)
+            if scheduler is not None:
+                # 按优先级全局排序需要完整的候选列表，只保存图片名，不含图片信息
+                candidates = scheduler.order(candidates, image_infos)
+            for i, (ref_name, test_name) in enumerate(candidates):
+                if scheduler is not None:
+                    if scheduler.done:
+                        skip(len(candidates) - i)
+                        return
+                    if not scheduler.admit(ref_name, test_name, image_infos):
+                        skip()
+                        continue
+                restored = self._restore_pair(ref_name, test_name)
+                if restored is not None:
+                    # 上次运行已判断过，直接复用
+                    qa_pair = restored['qa_pair']
+                    if scheduler is not None:
+                        scheduler.record(ref_name, test_name, qa_pair, image_infos)
+                    if qa_pair and self.store is None:
                         pairs_with_qa.append({
                             "reference": ref_name,
                             "test": test_name,
                             "qa_pair": qa_pair
                         })
-        
-        return pairs_with_qa
+                    continue
+                if batched and scheduler is not None:
+                    # 打包成批次后按整批重新接纳
+                    scheduler.release(ref_name, test_name)
+                yield ref_name, test_name
 
-    def _check_pair_match(self, ref_name: str, test_name: str, 
-                         ref_info: Dict, test_info: Dict) -> bool:
-        """使用模型判断两张图片是否适合配对"""
-        prompt = f"""请分析这两张图片是否适合作为参照图对进行配对：
+        batched = bool(fused and batch_tokens)
+        if batched:
+            def pack(pairs: Iterable[Tuple[str, str]]) -> Iterator[List[Tuple[str, str]]]:
+                return self.prompts.iter_pair_batches(pairs, image_infos, batch_tokens, max_batch_pairs)
 
-                参考图信息：
-                {json.dumps(ref_info, ensure_ascii=False, indent=2)}
+            # 批量模式下边遍历候选对边按 token 预算打包请求，不保存全部待判断的候选对；
+            # 设置调度器时批次截断到剩余名额内，其余候选对等这一批的结果出来后再安排
+            batches = pack(to_judge()) if scheduler is None else \
+                scheduler.iter_admitted_batches(to_judge(), image_infos, pack, skip)
+            for batch in batches:
+                verdicts = self._judge_pair_batch(batch, image_infos)
+                for (ref_name, test_name), (is_match, qa_pair) in zip(batch, verdicts):
+                    collect(ref_name, test_name, is_match, qa_pair)
+        else:
+            for ref_name, test_name in to_judge():
+                if fused:
+                    # 一次请求同时得到配对结论和问答
+                    is_match, qa_pair = self._judge_pair(
+                        ref_name, test_name, image_infos[ref_name], image_infos[test_name]
+                    )
+                else:
+                    # 判断两张图片是否适合配对
+                    is_match = self._check_pair_match(
+                        ref_name, 
+                        test_name,
+                        image_infos[ref_name],
+                        image_infos[test_name]
+                    )
+                    
+                    qa_pair = None
+                    if is_match:
+                        # 如果适合配对，则生成问答对
+                        qa_pair = self._generate_qa_pair(
+                            ref_name, 
+                            test_name,
+                            image_infos[ref_name],
+                            image_infos[test_name]
+                        )
 
-                测试图信息：
-                {json.dumps(test_info, ensure_ascii=False, indent=2)}
+                collect(ref_name, test_name, is_match, qa_pair)
+    
+        if self.store is not None:
+            return self.store.matched_pairs()
+        return pairs_with_qa
 
-                配对原则：
-                1. 两张图片应该包含相似的主要物体或场景
-                2. 两张图片之间应该存在有意义的对比点
-                3. 两张图片的内容应该具有关联性
+    def _build_pair_match_messages(self, ref_name: str, ref_info: Dict,
+                                   test_name: str, test_info: Dict) -> List[Dict]:
+        """构建配对判断请求的消息列表"""
+        return [{
+            'role': 'user',
+            'content': self.prompts.pair_match(ref_name, ref_info, test_name, test_info),
+        }]
 
-                请直接返回 "是" 或 "否"，表示是否适合配对。"""
-        
+    def _check_pair_match(self, ref_name: str, test_name: str, 
+                         ref_info: Dict, test_info: Dict) -> Optional[bool]:
+        """使用模型判断两张图片是否适合配对，请求失败时返回 None"""
         try:
-            response = self.client.client.chat.completions.create(
-                model=self.client.model,
-                messages=[{
-                    'role': 'user',
-                    'content': prompt,
-                }],
+            result = self.client.chat(
+                messages=self._build_pair_match_messages(ref_name, ref_info, test_name, test_info),
+                stage='pair_match',
                 temperature=0.2,  # 降低温度以获得更确定的答案
                 top_p=0.1
-            )
-            
-            result = response.choices[0].message.content.strip()
+            ).strip()
             return result == "是"
         except Exception as e:
+            self.client.metrics.count('pair_match_failed')
+            print(f"判断配对失败: {str(e)}")
+            return None
+
+    async def _check_pair_match_async(self, ref_name: str, test_name: str,
+                                      ref_info: Dict, test_info: Dict) -> Optional[bool]:
+        """_check_pair_match 的异步版本"""
+        try:
+            result = await self.client.achat(
+                messages=self._build_pair_match_messages(ref_name, ref_info, test_name, test_info),
+                stage='pair_match',
+                temperature=0.2,
+                top_p=0.1
+            )
+            return result.strip() == "是"
+        except Exception as e:
+            self.client.metrics.count('pair_match_failed')
             print(f"判断配对失败: {str(e)}")
-            return False
+            return None
+
+    def _build_qa_pair_messages(self, ref_name: str, ref_info: Dict,
+                                test_name: str, test_info: Dict) -> List[Dict]:
+        """构建问答生成请求的消息列表"""
+        return [{
+            'role': 'user',
+            'content': self.prompts.qa_pair(ref_name, ref_info, test_name, test_info),
+        }]
 
     def _generate_qa_pair(self, ref_name: str, test_name: str, 
                          ref_info: Dict, test_info: Dict) -> Dict:
         """生成问答对"""
-        prompt = f"""基于以下两张工地场景图片的分析信息，生成一个专业的问答对：
-
-                参考图信息：
-                {json.dumps(ref_info, ensure_ascii=False, indent=2)}
-
-                测试图信息：
-                {json.dumps(test_info, ensure_ascii=False, indent=2)}
+        try:
+            content = self.client.chat(
+                messages=self._build_qa_pair_messages(ref_name, ref_info, test_name, test_info),
+                stage='qa_pair',
+                temperature=0.8,
+                top_p=0.8,
+                json_root='{',
+                required_keys=QA_KEYS
+            )
+            
+            return self._parse_qa_pair(content)
+        except Exception as e:
+            self.client.metrics.count('qa_pair_failed')
+            print(f"生成问答对失败: {str(e)}")
+            return None
 
-                请生成一个问答对，要求：
-                1. 问题应该从参考图的场景出发，询问测试图的相关情况
-                2. 回答应该详细对比两张图片中物体的异同
-                3. 回答要突出重点，使用专业的描述方式
+    @staticmethod
+    def _parse_qa_pair(content: str) -> Dict:
+        """取出回复中的问答对，忽略前后的多余文字，缺少问题或回答时抛出 ValueError"""
+        qa_pair = extract_json(content, '{', QA_KEYS)
+        if qa_pair is None:
+            raise ValueError(f"回复中没有有效的问答对: {content[:100]}")
+        return qa_pair
 
-                请以下面的JSON格式返回：
-                {{
-                    "question": "您的问题",
-                    "answer": "您的回答"
-                }}"""
-        
+    async def _generate_qa_pair_async(self, ref_name: str, test_name: str,
+                                      ref_info: Dict, test_info: Dict) -> Dict:
+        """_generate_qa_pair 的异步版本"""
         try:
-            response = self.client.client.chat.completions.create(
-                model=self.client.model,
-                messages=[{
-                    'role': 'user',
-                    'content': prompt,
-                }],
+            content = await self.client.achat(
+                messages=self._build_qa_pair_messages(ref_name, ref_info, test_name, test_info),
+                stage='qa_pair',
                 temperature=0.8,
-                top_p=0.8
+                top_p=0.8,
+                json_root='{',
+                required_keys=QA_KEYS
             )
             
-            return json.loads(response.choices[0].message.content)
+            return self._parse_qa_pair(content)
         except Exception as e:
+            self.client.metrics.count('qa_pair_failed')
             print(f"生成问答对失败: {str(e)}")
-            return None
\ No newline at end of file
+            return None
+
+    def _build_pair_judge_messages(self, ref_name: str, ref_info: Dict,
+                                   test_name: str, test_info: Dict) -> List[Dict]:
+        """构建配对判断与问答生成合并请求的消息列表"""
+        return [{
+            'role': 'user',
+            'content': self.prompts.pair_judge(ref_name, ref_info, test_name, test_info),
+        }]
+
+    @staticmethod
+    def _parse_verdict(result) -> Tuple[Optional[bool], Optional[Dict]]:
+        """解析单个配对的结论对象，返回 (是否配对, 问答对)
+        无法解析时返回 (None, None)；判断为配对但问答缺失时返回 (True, None)，均不写入日志，下次运行重试。
+        """
+        if not isinstance(result, dict):
+            return None, None
+        match = result.get('match')
+        if isinstance(match, str):
+            match = match.strip().lower() in ('true', '是', 'yes')
+        if not isinstance(match, bool):
+            return None, None
+        if not match:
+            return False, None
+        question, answer = result.get('question'), result.get('answer')
+        if not (isinstance(question, str) and question.strip() and isinstance(answer, str) and answer.strip()):
+            return True, None
+        return True, {'question': question, 'answer': answer}
+
+    @staticmethod
+    def _parse_pair_judgement(content: str) -> Tuple[Optional[bool], Optional[Dict]]:
+        """解析合并请求的回复，返回 (是否配对, 问答对)，格式同 _parse_verdict"""
+        result = extract_json(content, '{', ('match',))
+        if result is None:
+            return None, None
+        return ImageAnalyzer._parse_verdict(result)
+
+    def _judge_pair(self, ref_name: str, test_name: str,
+                    ref_info: Dict, test_info: Dict) -> Tuple[Optional[bool], Optional[Dict]]:
+        """一次请求同时判断配对并生成问答，返回 (是否配对, 问答对)，请求或解析失败时是否配对为 None"""
+        try:
+            content = self.client.chat(
+                messages=self._build_pair_judge_messages(ref_name, ref_info, test_name, test_info),
+                stage='pair_judge',
+                temperature=0.7,
+                top_p=0.8,
+                json_root='{',
+                required_keys=('match',)
+            )
+        except Exception as e:
+            self.client.metrics.count('pair_judge_failed')
+            print(f"判断配对失败: {str(e)}")
+            return None, None
+        is_match, qa_pair = self._parse_pair_judgement(content)
+        if is_match is None or (is_match and qa_pair is None):
+            self.client.metrics.count('pair_judge_parse_failed')
+        return is_match, qa_pair
+
+    async def _judge_pair_async(self, ref_name: str, test_name: str,
+                                ref_info: Dict, test_info: Dict) -> Tuple[Optional[bool], Optional[Dict]]:
+        """_judge_pair 的异步版本"""
+        try:
+            content = await self.client.achat(
+                messages=self._build_pair_judge_messages(ref_name, ref_info, test_name, test_info),
+                stage='pair_judge',
+                temperature=0.7,
+                top_p=0.8,
+                json_root='{',
+                required_keys=('match',)
+            )
+        except Exception as e:
+            self.client.metrics.count('pair_judge_failed')
+            print(f"判断配对失败: {str(e)}")
+            return None, None
+        is_match, qa_pair = self._parse_pair_judgement(content)
+        if is_match is None or (is_match and qa_pair is None):
+            self.client.metrics.count('pair_judge_parse_failed')
+        return is_match, qa_pair
+
+    def _build_batch_judge_messages(self, batch: List[Tuple[str, str]], image_infos: Dict) -> List[Dict]:
+        """构建批量配对判断请求的消息列表，图片和候选对都用编号引用，回复按编号对应"""
+        return [{
+            'role': 'user',
+            'content': self.prompts.pair_judge_batch(batch, image_infos),
+        }]
+
+    @classmethod
+    def _parse_batch_judgement(cls, content: str, size: int) -> Dict[int, Tuple[Optional[bool], Optional[Dict]]]:
+        """按编号拆分批量判断的回复，返回 {候选对下标: (是否配对, 问答对)}，缺失或无法解析的候选对不出现在结果中"""
+        items = extract_json(content, '[')
+        verdicts = {}
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict):
+                continue
+            raw_id = str(item.get('id', '')).strip().upper().lstrip('P')
+            if not raw_id.isdigit() or not 1 <= int(raw_id) <= size:
+                continue
+            index = int(raw_id) - 1
+            verdict = cls._parse_verdict(item)
+            # 同一编号出现多次时只采用第一个有效结论
+            if verdict[0] is not None and index not in verdicts:
+                verdicts[index] = verdict
+        return verdicts
+
+    def _record_batch_result(self, batch: List[Tuple[str, str]],
+                             verdicts: Dict[int, Tuple[Optional[bool], Optional[Dict]]]) -> List[int]:
+        """统计批量判断的结果，返回需要逐个重新判断的候选对下标"""
+        missing = [i for i in range(len(batch))
+                   if i not in verdicts or (verdicts[i][0] and verdicts[i][1] is None)]
+        self.client.metrics.count('pairs_batched', len(batch) - len(missing))
+        if missing:
+            self.client.metrics.count('pair_batch_fallback', len(missing))
+        return missing
+
+    def _judge_pair_batch(self, batch: List[Tuple[str, str]],
+                          image_infos: Dict) -> List[Tuple[Optional[bool], Optional[Dict]]]:
+        """一次请求判断一批候选对，按输入顺序返回每个候选对的 (是否配对, 问答对)
+        回复中缺失或无法解析的候选对退回到逐个判断。
+        """
+        if len(batch) == 1:
+            ref_name, test_name = batch[0]
+            return [self._judge_pair(ref_name, test_name, image_infos[ref_name], image_infos[test_name])]
+        try:
+            content = self.client.chat(
+                messages=self._build_batch_judge_messages(batch, image_infos),
+                stage='pair_judge_batch',
+                temperature=0.7,
+                top_p=0.8,
+                json_root='['
+            )
+            verdicts = self._parse_batch_judgement(content, len(batch))
+        except Exception as e:
+            self.client.metrics.count('pair_judge_failed')
+            print(f"批量判断配对失败: {str(e)}")
+            verdicts = {}
+        for i in self._record_batch_result(batch, verdicts):
+            ref_name, test_name = batch[i]
+            verdicts[i] = self._judge_pair(ref_name, test_name, image_infos[ref_name], image_infos[test_name])
+        return [verdicts[i] for i in range(len(batch))]
+
+    async def _judge_pair_batch_async(self, batch: List[Tuple[str, str]],
+                                      image_infos: Dict) -> List[Tuple[Optional[bool], Optional[Dict]]]:
+        """_judge_pair_batch 的异步版本"""
+        if len(batch) == 1:
+            ref_name, test_name = batch[0]
+            return [await self._judge_pair_async(ref_name, test_name, image_infos[ref_name], image_infos[test_name])]
+        try:
+            content = await self.client.achat(
+                messages=self._build_batch_judge_messages(batch, image_infos),
+                stage='pair_judge_batch',
+                temperature=0.7,
+                top_p=0.8,
+                json_root='['
+            )
+            verdicts = self._parse_batch_judgement(content, len(batch))
+        except Exception as e:
+            self.client.metrics.count('pair_judge_failed')
+            print(f"批量判断配对失败: {str(e)}")
+            verdicts = {}
+        missing = self._record_batch_result(batch, verdicts)
+        fallback = await asyncio.gather(*(
+            self._judge_pair_async(batch[i][0], batch[i][1], image_infos[batch[i][0]], image_infos[batch[i][1]])
+            for i in missing
+        ))
+        verdicts.update(zip(missing, fallback))
+        return [verdicts[i] for i in range(len(batch))]
@@ -1,45 +1,289 @@
-import base64
 import json
-from openai import OpenAI
-from typing import Dict, List
-import json_repair
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Union
+from cache import ResponseCache
+from endpoints import Endpoint, EndpointPool
+from image_preprocessor import ImagePreprocessor
+from metrics import MetricsRecorder
+from rate_limit import RequestController
+from streaming import JsonStreamParser, aconsume_stream, consume_stream, extract_json
 
 class ModelClient:
-    def __init__(self, api_key: str, base_url: str):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
-        self.model = self.client.models.list().data[0].id
+    def __init__(self, api_key: str, base_url: Union[str, Sequence[str]], cache: ResponseCache = None,
+                 preprocessor: ImagePreprocessor = None, metrics: MetricsRecorder = None,
+                 controller: RequestController = None, hedge_percentile: float = None,
+                 model: str = None, model_cache_file: str = None,
+                 model_cache_ttl: float = 24 * 3600, stream: bool = False):
+        """
+        Args:
+            api_key: 模型服务 API Key
+            base_url: 模型服务地址，多个副本时传入地址列表
+            cache: 响应缓存，为 None 时不使用缓存
+            preprocessor: 图片预处理器
+            metrics: 运行指标
+            controller: 限速、重试和熔断层
+            hedge_percentile: 异步请求超过近期延迟的该分位数时向另一个副本发送对冲请求，为 None 时不对冲
+            model: 固定使用的模型id，提供时不再查询模型服务
+            model_cache_file: 查询到的模型id的本地缓存文件，有效期内的后续运行不再查询
+            model_cache_ttl: 本地缓存的模型id的有效期（秒）
+            stream: 是否以流式方式请求返回 JSON 的阶段，识别出完整的 JSON 后立即停止生成
+        """
+        self.api_key = api_key
+        self.base_urls = [base_url] if isinstance(base_url, str) else list(base_url)
+        self.hedge_percentile = hedge_percentile
+        # 运行指标，记录每次调用的延迟、token 数和错误类型
+        self.metrics = metrics or MetricsRecorder()
+        # 响应缓存，为 None 时不使用缓存
+        self.cache = cache
+        # 图片预处理器，负责缩放、重新编码并复用编码结果
+        self.preprocessor = preprocessor or ImagePreprocessor()
+        # 限速、自适应并发、退避重试和熔断，所有请求共用
+        self.controller = controller or RequestController()
+        self.model_cache_file = model_cache_file
+        self.model_cache_ttl = model_cache_ttl
+        self.stream = stream
+        # 模型id和 SDK 客户端都在第一次请求时才初始化，构造时不发起网络请求
+        self._model = model
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self) -> EndpointPool:
+        """各副本的客户端池，第一次使用时创建，openai 也在此时才导入"""
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    from openai import OpenAI, AsyncOpenAI
+                    # 每个副本各有一对同步/异步客户端；重试统一由 controller 负责，关闭 SDK 自带的重试
+                    self._pool = EndpointPool([
+                        Endpoint(url,
+                                 OpenAI(api_key=self.api_key, base_url=url, max_retries=0),
+                                 AsyncOpenAI(api_key=self.api_key, base_url=url, max_retries=0))
+                        for url in self.base_urls
+                    ], hedge_percentile=self.hedge_percentile, metrics=self.metrics)
+        return self._pool
+
+    @property
+    def client(self):
+        """第一个副本的同步客户端"""
+        return self.pool.endpoints[0].client
+
+    @property
+    def async_client(self):
+        """第一个副本的异步客户端，供并发分析使用"""
+        return self.pool.endpoints[0].async_client
+
+    def _load_cached_model(self) -> Optional[str]:
+        """读取本地缓存的模型id，不存在或已过期时返回 None"""
+        if not self.model_cache_file or not os.path.exists(self.model_cache_file):
+            return None
+        try:
+            with open(self.model_cache_file, 'r', encoding='utf-8') as f:
+                entry = json.load(f).get(self.base_urls[0])
+        except (OSError, ValueError):
+            return None
+        if not entry or time.time() - entry.get('fetched_at', 0) > self.model_cache_ttl:
+            return None
+        return entry.get('model')
+
+    def _save_cached_model(self, model: str):
+        if not self.model_cache_file:
+            return
+        entries = {}
+        if os.path.exists(self.model_cache_file):
+            try:
+                with open(self.model_cache_file, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                entries = {}
+        entries[self.base_urls[0]] = {'model': model, 'fetched_at': time.time()}
+        # 先写临时文件再替换，多个 worker 同时写入时不会读到半个文件
+        tmp_file = f"{self.model_cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_file, self.model_cache_file)
+
+    @property
+    def model(self) -> str:
+        """模型id：优先使用固定配置，其次是本地缓存，最后才查询模型服务"""
+        if self._model is None:
+            model = self._load_cached_model()
+            if model is None:
+                model = self.client.models.list().data[0].id
+                self._save_cached_model(model)
+            self._model = model
+        return self._model
+
+    async def _amodel(self) -> str:
+        """model 的异步版本，需要查询模型服务时不阻塞事件循环"""
+        if self._model is None:
+            model = self._load_cached_model()
+            if model is None:
+                models = await self.async_client.models.list()
+                model = models.data[0].id
+                self._save_cached_model(model)
+            self._model = model
+        return self._model
+
+    def image_content(self, image_data: bytes) -> Dict:
+        """构建请求消息中的图片内容"""
+        return {
+            'type': 'image_url',
+            'image_url': {
+                "url": self.preprocessor.to_data_url(image_data),
+            }
+        }
+
+    def _cache_key(self, stage: str, messages: List[Dict], params: Dict, use_cache: bool):
+        """返回本次请求的缓存键，不使用缓存时返回 None"""
+        if not use_cache or self.cache is None or not self.cache.enabled_for(stage):
+            return None
+        return ResponseCache.make_key(self.model, messages, params)
+
+    def _record(self, stage: str, start: float, response=None, error: Exception = None,
+                cached: bool = False, retries: int = 0):
+        """记录一次调用的指标，token 数取自响应中的 usage"""
+        usage = getattr(response, 'usage', None)
+        self.metrics.record_call(
+            stage,
+            time.perf_counter() - start,
+            prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+            completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+            retries=retries if error is None else getattr(error, 'retries', 0),
+            error=None if error is None else type(error).__name__,
+            cached=cached
+        )
+
+    def _streams(self, json_root: Optional[str]) -> bool:
+        return self.stream and json_root is not None
+
+    def _request_kwargs(self, messages: List[Dict], params: Dict, streaming: bool) -> Dict:
+        kwargs = {'model': self.model, 'messages': messages, **params}
+        if streaming:
+            # 正常结束时最后一个分块带有 usage
+            kwargs.update(stream=True, stream_options={'include_usage': True})
+        return kwargs
+
+    @staticmethod
+    def _latency_sample(response) -> bool:
+        """流式读取提前结束的请求没有生成完整回复，其耗时不作为自适应并发的延迟样本"""
+        return not getattr(response, 'stopped_early', False)
+
+    def _content(self, stage: str, response, streaming: bool) -> str:
+        if not streaming:
+            return response.choices[0].message.content
+        if response.stopped_early:
+            self.metrics.count('stream_early_stops')
+        if not response.parser.complete:
+            self.metrics.count(f'{stage}_stream_incomplete')
+        return response.content
+
+    def chat(self, messages: List[Dict], stage: str, temperature: float = 0.8,
+             top_p: float = 0.8, use_cache: bool = True, json_root: str = None,
+             required_keys: Sequence[str] = ()) -> str:
+        """发送对话请求并返回模型回复文本，所有模型调用都应经过此方法
+        Args:
+            messages: 请求消息列表
+            stage: 调用所属阶段名称，用于缓存的按阶段绕过和清理
+            temperature: 采样温度
+            top_p: 采样 top_p
+            use_cache: 是否使用响应缓存
+            json_root: 期望的回复为 JSON 时其顶层起始字符（'{' 或 '['）；开启 stream 时据此
+                流式读取，第一个有效的顶层值闭合后立即停止，只返回该 JSON 文本
+            required_keys: 流式读取时有效的顶层值必须包含的键
+        """
+        start = time.perf_counter()
+        if self._model is None:
+            # 第一次请求时才确定模型id，查询失败按退避策略重试；查询不经过并发控制，
+            # 其耗时远短于对话请求，不能作为自适应并发的延迟基准
+            self.controller.retry(lambda: self.model)
+        params = {'temperature': temperature, 'top_p': top_p}
+        key = self._cache_key(stage, messages, params, use_cache)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self._record(stage, start, cached=True)
+                return cached
+
+        streaming = self._streams(json_root)
+
+        def request(client):
+            response = client.chat.completions.create(**self._request_kwargs(messages, params, streaming))
+            if streaming:
+                return consume_stream(response, JsonStreamParser(json_root, required_keys), messages)
+            return response
+
+        try:
+            response, retries = self.controller.call(lambda: self.pool.call(request, stage),
+                                                         latency_sample=self._latency_sample, kind=stage)
+        except Exception as e:
+            self._record(stage, start, error=e)
+            raise
+        self._record(stage, start, response, retries=retries)
+        content = self._content(stage, response, streaming)
+
+        if key is not None:
+            self.cache.set(key, stage, self.model, content)
+        return content
+
+    async def achat(self, messages: List[Dict], stage: str, temperature: float = 0.8,
+                    top_p: float = 0.8, use_cache: bool = True, json_root: str = None,
+                    required_keys: Sequence[str] = ()) -> str:
+        """chat 的异步版本"""
+        start = time.perf_counter()
+        if self._model is None:
+            await self.controller.aretry(self._amodel)
+        params = {'temperature': temperature, 'top_p': top_p}
+        key = self._cache_key(stage, messages, params, use_cache)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self._record(stage, start, cached=True)
+                return cached
+
+        streaming = self._streams(json_root)
+
+        async def request(client):
+            response = await client.chat.completions.create(**self._request_kwargs(messages, params, streaming))
+            if streaming:
+                return await aconsume_stream(response, JsonStreamParser(json_root, required_keys), messages)
+            return response
+
+        try:
+            response, retries = await self.controller.acall(lambda: self.pool.acall(request, stage),
+                                                                latency_sample=self._latency_sample, kind=stage)
+        except Exception as e:
+            self._record(stage, start, error=e)
+            raise
+        self._record(stage, start, response, retries=retries)
+        content = self._content(stage, response, streaming)
+
+        if key is not None:
+            self.cache.set(key, stage, self.model, content)
+        return content
         
     def extract_image_info(self, image_data: bytes) -> Dict:
         """使用QwenVL提取图片信息"""
-        # 直接使用传入的图片数据进行base64编码
-        encoded_image = base64.b64encode(image_data).decode("utf-8")
-        
-        response = self.client.chat.completions.create(
-            model=self.model,
+        return self.chat(
             messages=[{
                 'role': 'user',
                 'content': [{
                     'type': 'text',
                     'text': '请分析图片中的：1.设备信息 2.人员穿戴 3.人员行为',
-                }, {
-                    'type': 'image_url',
-                    'image_url': {
-                        "url": f"data:image/jpeg;base64,{encoded_image}",
-                    }
-                }],
+                }, self.image_content(image_data)],
             }],
+            stage='extract_image_info',
             temperature=0.8,
             top_p=0.8
         )
-        
-        return response.choices[0].message.content
     
-    def find_matching_pairs(self, image_infos: List[Dict]) -> List[tuple]:
+    def find_matching_pairs(self, image_infos: Dict[str, Dict]) -> List[tuple]:
         """使用Qwen分析图片信息并找出合适的配对"""
         prompt = self._create_matching_prompt(image_infos)
         
-        response = self.client.chat.completions.create(
-            model=self.model,
+        content = self.chat(
             messages=[{
                 'role': 'user',
                 'content': [{
@@ -47,24 +291,26 @@ class ModelClient:
                     'text': prompt,
                 }],
             }],
+            stage='find_matching_pairs',
             temperature=0.8,
-            top_p=0.8
+            top_p=0.8,
+            json_root='['
         )
         
-        return self._parse_matching_response(response.choices[0].message.content)
+        return self._parse_matching_response(content, list(image_infos))
     
     def _encode_image(self, image_path: str) -> str:
-        """将图片转换为base64编码"""
+        """将图片预处理后转换为base64编码"""
         with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
+            return self.preprocessor.to_base64(image_file.read())
             
     def _create_matching_prompt(self, image_infos: Dict[str, Dict]) -> str:
-        """创建配对提示语"""
+        """创建配对提示语，图片用编号引用，避免文件名中的特殊字符干扰解析"""
         info_list = []
-        for img_name, info in image_infos.items():
+        for i, (img_name, info) in enumerate(image_infos.items(), 1):
             # 从标注数据中获取物体信息
             objects = info.get('objects', [])  # 这里直接使用标注的物体列表
-            info_text = f"""图片名称：{img_name}
+            info_text = f"""图片编号：{i}
 物体列表：{', '.join(objects)}"""
             info_list.append(info_text)
         
@@ -80,27 +326,35 @@ class ModelClient:
                 图片信息如下：
                 {all_info}
                 
-                请返回配对结果，格式：
-                1. [图1文件名] - [图2文件名]：[配对原因，说明物体的异同]
-                2. [图1文件名] - [图2文件名]：[配对原因，说明物体的异同]
-                ...
+                只返回JSON数组，用图片编号表示配对，格式：
+                [
+                    {{"a": 1, "b": 2, "reason": "配对原因，说明物体的异同"}},
+                    {{"a": 3, "b": 5, "reason": "配对原因，说明物体的异同"}}
+                ]
                 """
     
-    def _parse_matching_response(self, response: str) -> List[tuple]:
-        """解析配对响应"""
-        pairs = []
-        lines = response.strip().split('\n')
-        
-        for line in lines:
-            if '-' in line:  # 查找包含配对信息的行
-                # 移除序号和空格
-                pair_text = line.split('.', 1)[-1].strip()
-                # 分割两个图片名
-                img_names = pair_text.split('-')
-                if len(img_names) == 2:
-                    img1 = img_names[0].strip()
-                    img2 = img_names[1].strip()
-                    pairs.append((img1, img2))
+    def _parse_matching_response(self, response: str, image_names: List[str]) -> List[tuple]:
+        """解析配对响应，将图片编号映射回文件名，编号越界或重复的配对被丢弃
+        Args:
+            response: 模型返回的 JSON 数组
+            image_names: 按提示词中编号顺序排列的图片文件名
+        """
+        items = extract_json(response, '[')
+
+        pairs, seen = [], set()
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict):
+                continue
+            try:
+                a, b = int(item.get('a')), int(item.get('b'))
+            except (TypeError, ValueError):
+                continue
+            if a == b or not (1 <= a <= len(image_names) and 1 <= b <= len(image_names)):
+                continue
+            pair = (image_names[a - 1], image_names[b - 1])
+            if frozenset(pair) not in seen:
+                seen.add(frozenset(pair))
+                pairs.append(pair)
         
         return pairs
     
@@ -137,28 +391,27 @@ class ModelClient:
                             - 确保返回格式严格符合JSON规范"""
         
         # 发送请求获取结构化输出
-        structured_response = self.client.chat.completions.create(
-            model=self.model,
+        result = self.chat(
             messages=[{
                 'role': 'user',
                 'content': [{
                     'type': 'text',
                     'text': structured_prompt,
-                }, {
-                    'type': 'image_url',
-                    'image_url': {
-                        "url": f"data:image/jpeg;base64,{base64.b64encode(image_data).decode('utf-8')}",
-                    }
-                }],
+                }, self.image_content(image_data)],
             }],
+            stage='analyze_image',
             temperature=0.8,
-            top_p=0.8
+            top_p=0.8,
+            json_root='{',
+            required_keys=('objects',)
         )
         
-        result = structured_response.choices[0].message.content
-        
-        # 确保返回的是字典格式
-        if isinstance(result, str):
+        # 确保返回的是字典格式，多余的前后文字直接忽略，JSON 本身有误时才尝试修复
+        parsed = extract_json(result, '{', ('objects',))
+        if parsed is not None:
+            result = parsed
+        else:
+            import json_repair
             try:
                 result = json_repair.loads(result)
             except json.JSONDecodeError:
@@ -178,6 +431,8 @@ class ModelClient:
         image_infos = {}
         image_files = [f for f in os.listdir(image_dir) if f.endswith(('.jpg', '.jpeg', '.png'))]
         
+        if show_progress:
+            from tqdm import tqdm
         iterator = tqdm(image_files) if show_progress else image_files
         for image_file in iterator:
             if show_progress:
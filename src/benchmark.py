@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Dict
+
+from analyzer import ImageAnalyzer
+from api_client import ModelClient
+from main import generate_multimodal_data
+from mock_server import MockServer, add_config_args, config_from_args
+from pipeline import GenerationPipeline
+
+# 合成数据集使用的物体和场景词表
+OBJECT_VOCAB = ['塔吊', '脚手架', '安全网', '作业人员', '安全帽', '反光背心', '挖掘机', '混凝土泵车',
+                '钢筋', '模板', '围挡', '配电箱', '灭火器', '吊篮', '施工电梯', '渣土车']
+SCENE_VOCAB = ['高处作业', '基坑开挖', '主体结构施工', '临时用电', '材料堆放', '装饰装修']
+
+
+def make_synthetic_dataset(directory: str, num_images: int, image_bytes: int = 200 * 1024,
+                           seed: int = 0) -> Dict[str, Dict]:
+    """生成合成图片和标注数据，返回 {图片文件名: 标注数据}
+    图片内容为带 JPEG 文件头的随机字节，只用于测量上传和请求开销。
+    """
+    rng = random.Random(seed)
+    annotations = {}
+    for i in range(num_images):
+        name = f"synthetic_{i:06d}.jpg"
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(b'\xff\xd8\xff\xe0' + rng.randbytes(image_bytes))
+        annotations[name] = {
+            'objects': rng.sample(OBJECT_VOCAB, rng.randint(2, 6)),
+            'scene': rng.choice(SCENE_VOCAB),
+            'anomaly': rng.choice(['', '未佩戴安全帽', '安全网破损']),
+            'image_path': os.path.join(directory, name),
+        }
+    return annotations
+
+
+def pair_judgements(client: ModelClient) -> int:
+    """已判断的候选对数：逐对判断的调用次数加上批量请求中得到结论的候选对数"""
+    single = client.metrics.stages['pair_judge'].calls if 'pair_judge' in client.metrics.stages else 0
+    return single + client.metrics.counters['pairs_batched']
+
+
+def run_staged(client: ModelClient, image_dir: str, annotations: Dict, output_file: str,
+               max_concurrency: int, top_k: int, batch_tokens: int = None,
+               describe_batch_size: int = 1) -> Dict:
+    """按逐阶段模式运行，分别统计各阶段吞吐"""
+    analyzer = ImageAnalyzer(client)
+    report = {}
+
+    start = time.perf_counter()
+    image_infos = asyncio.run(analyzer.analyze_images_async(
+        image_dir, annotations=annotations, max_concurrency=max_concurrency,
+        batch_size=describe_batch_size
+    ))
+    elapsed = time.perf_counter() - start
+    report['analyze'] = {'items': len(image_infos), 'seconds': elapsed,
+                         'images_per_sec': len(image_infos) / elapsed if elapsed else 0.0}
+
+    start = time.perf_counter()
+    pairs = analyzer.create_reference_pairs(image_infos, top_k=top_k, batch_tokens=batch_tokens)
+    pair_elapsed = time.perf_counter() - start
+    judged = pair_judgements(client)
+    report['pair'] = {'items': judged, 'matched': len(pairs), 'seconds': pair_elapsed,
+                      'pairs_per_sec': judged / pair_elapsed if pair_elapsed else 0.0}
+
+    start = time.perf_counter()
+    generate_multimodal_data(pairs, image_dir, output_file, metrics=client.metrics)
+    elapsed = time.perf_counter() - start
+    with open(output_file, 'r', encoding='utf-8') as f:
+        written = sum(1 for _ in f)
+    # 问答在配对阶段的模型调用中生成，吞吐按配对阶段的耗时计算；写出数据文件单独统计
+    report['qa'] = {'items': written, 'seconds': pair_elapsed,
+                    'qa_per_sec': written / pair_elapsed if pair_elapsed else 0.0}
+    report['write'] = {'items': written, 'seconds': elapsed,
+                       'items_per_sec': written / elapsed if elapsed else 0.0}
+    return report
+
+
+def run_pipelined(client: ModelClient, image_dir: str, annotations: Dict, output_file: str,
+                  max_concurrency: int, top_k: int, batch_tokens: int = None,
+                  describe_batch_size: int = 1) -> Dict:
+    """按流水线模式运行，各阶段同时进行，吞吐按总耗时计算"""
+    pipeline = GenerationPipeline(
+        ImageAnalyzer(client), image_dir, annotations, output_file, top_k=top_k,
+        analyze_concurrency=max_concurrency, pair_concurrency=max_concurrency,
+        batch_tokens=batch_tokens, describe_batch_size=describe_batch_size
+    )
+    start = time.perf_counter()
+    stats = asyncio.run(pipeline.run())
+    elapsed = time.perf_counter() - start
+    return {
+        'analyze': {'items': stats['analyzed'], 'seconds': elapsed,
+                    'images_per_sec': stats['analyzed'] / elapsed if elapsed else 0.0},
+        'pair': {'items': stats['pairs_judged'], 'matched': stats['pairs_matched'], 'seconds': elapsed,
+                 'pairs_per_sec': stats['pairs_judged'] / elapsed if elapsed else 0.0},
+        'qa': {'items': stats['written'], 'seconds': elapsed,
+               'qa_per_sec': stats['written'] / elapsed if elapsed else 0.0},
+    }
+
+
+def format_report(report: Dict) -> str:
+    lines = [f"模式: {report['mode']}，图片数: {report['num_images']}，总耗时: {report['seconds']:.2f}s"]
+    for stage in ('analyze', 'pair', 'qa', 'write'):
+        info = report['stages'].get(stage)
+        if info is None:
+            # 流水线模式下写出与生成同时进行，不单独统计
+            continue
+        rate = next(v for k, v in info.items() if k.endswith('_per_sec'))
+        lines.append(f"  {stage:<8} {info['items']:>8} 项  {rate:>10.2f} 项/秒")
+    lines.append("  每次调用延迟（秒）:")
+    for stage, info in report['calls'].items():
+        latency = info['latency']
+        lines.append(f"    {stage:<20} 调用 {info['calls']:>6}  错误 {sum(info['errors'].values()):>4}  "
+                     f"p50 {latency['p50']:.3f}  p95 {latency['p95']:.3f}  p99 {latency['p99']:.3f}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="基于本地模拟服务的离线吞吐压测")
+    parser.add_argument('--num-images', type=int, default=200, help="合成数据集的图片数")
+    parser.add_argument('--image-bytes', type=int, default=200 * 1024, help="每张合成图片的字节数")
+    parser.add_argument('--mode', choices=['staged', 'pipeline'], default='staged',
+                        help="staged 逐阶段运行，pipeline 流水线运行")
+    parser.add_argument('--max-concurrency', type=int, default=16, help="同时进行中的模型请求数上限")
+    parser.add_argument('--top-k', type=int, default=10, help="每张图片交给模型判断的候选数")
+    parser.add_argument('--describe-batch-size', type=int, default=1, help="每个场景描述请求包含的图片数")
+    parser.add_argument('--pair-batch-tokens', type=int, default=None,
+                        help="批量判断配对时每个请求提示词的 token 预算，默认逐对判断")
+    parser.add_argument('--stream', action='store_true', help="流式请求，识别出完整的 JSON 后立即停止生成")
+    parser.add_argument('--base-url', default=None, help="压测已有的模型服务，不提供时启动本地模拟服务")
+    parser.add_argument('--json', default=None, help="将压测结果写入该 JSON 文件")
+    add_config_args(parser)
+    args = parser.parse_args(argv)
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server = MockServer(config_from_args(args)).start()
+        base_url = server.base_url
+
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            image_dir = os.path.join(workdir, 'images')
+            os.makedirs(image_dir)
+            annotations = make_synthetic_dataset(image_dir, args.num_images, args.image_bytes,
+                                                 seed=args.seed or 0)
+            # 不使用响应缓存，保证每次调用都真正请求服务
+            client = ModelClient(api_key='mock', base_url=base_url, stream=args.stream)
+            output_file = os.path.join(workdir, 'multimodal_data.jsonl')
+            run = run_staged if args.mode == 'staged' else run_pipelined
+
+            start = time.perf_counter()
+            stages = run(client, image_dir, annotations, output_file, args.max_concurrency, args.top_k,
+                         args.pair_batch_tokens, args.describe_batch_size)
+            report = {
+                'mode': args.mode,
+                'num_images': args.num_images,
+                'seconds': time.perf_counter() - start,
+                'stages': stages,
+                'calls': client.metrics.report()['stages'],
+                'counters': dict(client.metrics.counters),
+            }
+    finally:
+        if server is not None:
+            server.stop()
+
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+
+class ResponseCache:
+    """基于 SQLite 的模型响应持久化缓存
+
+    缓存键为 模型id + 请求消息（含图片base64数据）+ 采样参数 的 sha256 哈希，
+    因此只要图片内容、提示语、模型或采样参数任一发生变化，就会重新请求模型。
+    SQLite 以 WAL 模式打开，可在多个进程之间安全共享同一个缓存文件。
+    """
+
+    def __init__(self, path: str, max_entries: int = None, max_bytes: int = None,
+                 max_age_seconds: float = None, bypass_stages: Iterable[str] = None):
+        """
+        Args:
+            path: 缓存数据库文件路径
+            max_entries: 最多保留的条目数，超出时按最近访问时间淘汰
+            max_bytes: 响应内容总字节数上限，超出时按最近访问时间淘汰
+            max_age_seconds: 条目最长保留时间（秒），过期条目不再命中
+            bypass_stages: 跳过缓存的阶段名称，这些阶段总是重新请求模型
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.bypass_stages = set(bypass_stages or [])
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._writes = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_stage ON responses(stage)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)")
+        conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        """每个线程使用独立连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], params: Dict) -> str:
+        """根据模型id、请求消息和采样参数计算缓存键"""
+        payload = json.dumps(
+            {'model': model, 'messages': messages, 'params': params},
+            ensure_ascii=False, sort_keys=True, separators=(',', ':')
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def enabled_for(self, stage: str) -> bool:
+        """判断某个阶段是否使用缓存"""
+        return stage not in self.bypass_stages
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存的响应，未命中或已过期时返回 None"""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or (self.max_age_seconds is not None and now - row[1] > self.max_age_seconds):
+            self.misses += 1
+            return None
+        conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        conn.commit()
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: str, stage: str, model: str, response: str):
+        """写入一条响应"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, stage, model, response, size, created_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, stage, model, response, len(response.encode('utf-8')), now, now)
+        )
+        conn.commit()
+        self._writes += 1
+        # 每写入一定数量后检查一次淘汰，避免每次写入都扫描全表
+        if self._writes % 100 == 0:
+            self.evict()
+
+    def invalidate(self, stage: str = None) -> int:
+        """清除缓存
+        Args:
+            stage: 只清除指定阶段的缓存，为 None 时清除全部
+        Returns:
+            int: 清除的条目数
+        """
+        conn = self._connect()
+        if stage is None:
+            cursor = conn.execute("DELETE FROM responses")
+        else:
+            cursor = conn.execute("DELETE FROM responses WHERE stage = ?", (stage,))
+        conn.commit()
+        return cursor.rowcount
+
+    def evict(self) -> int:
+        """按过期时间、条目数和总大小淘汰缓存，返回淘汰的条目数"""
+        conn = self._connect()
+        removed = 0
+        if self.max_age_seconds is not None:
+            removed += conn.execute(
+                "DELETE FROM responses WHERE created_at < ?",
+                (time.time() - self.max_age_seconds,)
+            ).rowcount
+        if self.max_entries is not None:
+            removed += conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            ).rowcount
+        if self.max_bytes is not None:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # 从最久未访问的条目开始删除，直到总大小回到上限以内
+                to_delete = []
+                for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC"):
+                    if total <= self.max_bytes:
+                        break
+                    to_delete.append((key,))
+                    total -= size
+                conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+                removed += len(to_delete)
+        conn.commit()
+        return removed
+
+    def stats(self) -> Dict:
+        """返回缓存统计信息"""
+        conn = self._connect()
+        entries, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        return {'entries': entries, 'bytes': total, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,289 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# 数据分片所在的子目录和文件名格式
+DATA_DIR = 'data'
+IMAGES_DIR = 'images'
+MANIFEST_FILE = 'manifest.jsonl'
+INDEX_FILE = 'index.jsonl'
+_PART_NAME = re.compile(r'^part-(\d+)\.jsonl(\.gz)?$')
+
+# 图片写入方式：hardlink 硬链接到内容寻址目录（跨文件系统时退化为复制），
+# copy 复制到内容寻址目录，reference 不写入图片，数据中保留原始路径
+IMAGE_MODES = ('hardlink', 'copy', 'reference')
+
+
+class JsonlWriter:
+    """逐行写入单个 JSONL 文件，每条写入后立即落盘"""
+
+    def __init__(self, path: str, mode: str = 'w'):
+        self.path = path
+        self._file = open(path, mode, encoding='utf-8')
+
+    def write(self, item: Dict, on_flushed: Callable[[], None] = None):
+        """写入一条数据，落盘后调用 on_flushed"""
+        self._file.write(json.dumps(item, ensure_ascii=False) + '\n')
+        self._file.flush()
+        if on_flushed is not None:
+            on_flushed()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DatasetWriter:
+    """按内容寻址存放图片、按大小轮转分片并建立偏移索引的数据集写入器
+
+    输出目录结构：
+        images/ab/abcdef....jpg   按图片内容的 sha256 存放，同一张图片只存一份
+        data/part-00000.jsonl[.gz]  数据分片，超过 max_shard_bytes 后换新分片
+        manifest.jsonl            每条数据一行：数据 id 及其图片的文件名、哈希和存放路径
+        index.jsonl               每条数据一行：所在分片、字节偏移和长度，用于按 id 随机读取
+
+    数据中的图片路径为相对输出目录的路径。压缩分片按块写入，每块是一个独立的 gzip 成员，
+    索引记录块的偏移，读取单条数据只需解压一个块。manifest 和索引都只追加写入，
+    续跑时从新的分片开始写，不修改已有分片。
+    """
+
+    def __init__(self, output_dir: str, image_mode: str = 'hardlink',
+                 max_shard_bytes: int = 256 * 1024 * 1024, compress: bool = False,
+                 block_bytes: int = 64 * 1024):
+        """
+        Args:
+            output_dir: 数据集输出目录
+            image_mode: 图片写入方式，取值见 IMAGE_MODES
+            max_shard_bytes: 单个数据分片的字节数上限（压缩分片按压缩后计）
+            compress: 是否用 gzip 压缩数据分片
+            block_bytes: 压缩分片中每个块的未压缩字节数
+        """
+        if image_mode not in IMAGE_MODES:
+            raise ValueError(f"不支持的图片写入方式: {image_mode}")
+        self.output_dir = output_dir
+        self.image_mode = image_mode
+        self.max_shard_bytes = max_shard_bytes
+        self.compress = compress
+        self.block_bytes = block_bytes
+        self.stats = {'written': 0, 'images_stored': 0, 'images_linked': 0,
+                      'images_copied': 0, 'shards': 0}
+        os.makedirs(os.path.join(output_dir, DATA_DIR), exist_ok=True)
+        # {原始路径: 图片 sha256}，每张图片只读取一次
+        self._digests: Dict[str, str] = self._load_digests()
+        self._manifest = open(os.path.join(output_dir, MANIFEST_FILE), 'a', encoding='utf-8')
+        self._index = open(os.path.join(output_dir, INDEX_FILE), 'a', encoding='utf-8')
+        self._part_number = self._next_part_number()
+        self._part = None
+        self._part_bytes = 0
+        # 压缩分片中尚未写出的块：[(数据 id, 行文本, 写出后的回调)]
+        self._block: List[Tuple[str, bytes, Optional[Callable[[], None]]]] = []
+        self._block_size = 0
+
+    def _load_digests(self) -> Dict[str, str]:
+        """从已有的 manifest 恢复图片哈希，续跑时不再重新读取图片"""
+        digests = {}
+        path = os.path.join(self.output_dir, MANIFEST_FILE)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    for image in entry.get('images', []):
+                        digests[image['source']] = image['sha256']
+        return digests
+
+    def add_known_digests(self, digests: Dict[str, str]):
+        """预先登记图片路径对应的 sha256，合并已有数据集时不再重新读取这些图片"""
+        self._digests.update(digests)
+
+    def _next_part_number(self) -> int:
+        numbers = [int(m.group(1)) for m in map(_PART_NAME.match, os.listdir(os.path.join(self.output_dir, DATA_DIR)))
+                   if m]
+        return max(numbers) + 1 if numbers else 0
+
+    def _part_name(self) -> str:
+        return f"part-{self._part_number:05d}.jsonl" + ('.gz' if self.compress else '')
+
+    def _digest(self, source: str) -> str:
+        digest = self._digests.get(source)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(source, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            digest = self._digests[source] = h.hexdigest()
+        return digest
+
+    def _store_image(self, source: str) -> Dict:
+        """将图片放入内容寻址目录，返回其 manifest 记录"""
+        digest = self._digest(source)
+        if self.image_mode == 'reference':
+            return {'source': source, 'sha256': digest, 'path': source}
+        ext = os.path.splitext(source)[1].lower() or '.jpg'
+        relative = os.path.join(IMAGES_DIR, digest[:2], digest + ext)
+        target = os.path.join(self.output_dir, relative)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp = target + '.tmp'
+            linked = False
+            if self.image_mode == 'hardlink':
+                try:
+                    os.link(source, tmp)
+                    linked = True
+                except OSError:
+                    # 跨文件系统或不支持硬链接时复制
+                    pass
+            if not linked:
+                shutil.copyfile(source, tmp)
+            os.replace(tmp, target)
+            self.stats['images_stored'] += 1
+            self.stats['images_linked' if linked else 'images_copied'] += 1
+        return {'source': source, 'sha256': digest, 'path': relative}
+
+    def _open_part(self):
+        self._part = open(os.path.join(self.output_dir, DATA_DIR, self._part_name()), 'ab')
+        self._part_bytes = 0
+        self.stats['shards'] += 1
+
+    def _rotate_if_full(self):
+        if self._part is not None and self._part_bytes >= self.max_shard_bytes:
+            self._part.close()
+            self._part = None
+            self._part_number += 1
+
+    def write(self, item: Dict, on_flushed: Callable[[], None] = None):
+        """写入一条数据：图片放入内容寻址目录，数据写入当前分片，写出后调用 on_flushed
+        压缩分片按块写出，块写满或 close 时才调用同一块中各条数据的回调。
+        """
+        images = [self._store_image(path) for path in item.get('images', [])]
+        item = {**item, 'images': [image['path'] for image in images]}
+        self._manifest.write(json.dumps({'id': item['id'], 'images': images}, ensure_ascii=False) + '\n')
+        self._manifest.flush()
+
+        line = (json.dumps(item, ensure_ascii=False) + '\n').encode('utf-8')
+        self.stats['written'] += 1
+        if self.compress:
+            self._block.append((item['id'], line, on_flushed))
+            self._block_size += len(line)
+            if self._block_size >= self.block_bytes:
+                self._flush_block()
+            return
+
+        if self._part is None:
+            self._open_part()
+        offset = self._part.tell()
+        self._part.write(line)
+        self._part.flush()
+        self._part_bytes += len(line)
+        self._index.write(json.dumps({'id': item['id'], 'shard': self._part_name(), 'offset': offset,
+                                      'length': len(line), 'line': 0}) + '\n')
+        self._index.flush()
+        if on_flushed is not None:
+            on_flushed()
+        self._rotate_if_full()
+
+    def _flush_block(self):
+        """将缓冲的数据压缩为一个 gzip 成员写入当前分片，再写索引"""
+        if not self._block:
+            return
+        if self._part is None:
+            self._open_part()
+        member = gzip.compress(b''.join(line for _, line, _ in self._block))
+        offset = self._part.tell()
+        self._part.write(member)
+        self._part.flush()
+        self._part_bytes += len(member)
+        name = self._part_name()
+        for i, (item_id, _, _) in enumerate(self._block):
+            self._index.write(json.dumps({'id': item_id, 'shard': name, 'offset': offset,
+                                          'length': len(member), 'line': i}) + '\n')
+        self._index.flush()
+        callbacks = [callback for _, _, callback in self._block if callback is not None]
+        self._block, self._block_size = [], 0
+        for callback in callbacks:
+            callback()
+        self._rotate_if_full()
+
+    def close(self):
+        self._flush_block()
+        if self._part is not None:
+            self._part.close()
+            self._part = None
+        self._manifest.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def remove_dataset(output_dir: str):
+    """删除 DatasetWriter 写出的数据分片、manifest 和索引（内容寻址的图片保留，可被重新引用）"""
+    shutil.rmtree(os.path.join(output_dir, DATA_DIR), ignore_errors=True)
+    for name in (MANIFEST_FILE, INDEX_FILE):
+        path = os.path.join(output_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class DatasetReader:
+    """按 id 随机读取 DatasetWriter 写出的数据集"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        # {数据 id: (分片名, 偏移, 长度, 块内行号)}，同一 id 出现多次时以最后一次为准
+        self.index: Dict[str, Tuple[str, int, int, int]] = {}
+        with open(os.path.join(output_dir, INDEX_FILE), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.index[entry['id']] = (entry['shard'], entry['offset'], entry['length'], entry['line'])
+        self._cached_block = None
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self.index
+
+    def _read_block(self, shard: str, offset: int, length: int) -> List[bytes]:
+        key = (shard, offset)
+        if self._cached_block is not None and self._cached_block[0] == key:
+            return self._cached_block[1]
+        with open(os.path.join(self.output_dir, DATA_DIR, shard), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if shard.endswith('.gz'):
+            data = gzip.decompress(data)
+        lines = data.splitlines()
+        self._cached_block = (key, lines)
+        return lines
+
+    def get(self, item_id: str) -> Dict:
+        """按 id 读取一条数据，不存在时抛出 KeyError"""
+        shard, offset, length, line = self.index[item_id]
+        return json.loads(self._read_block(shard, offset, length)[line])
+
+    def __iter__(self) -> Iterator[Dict]:
+        """按写入顺序遍历全部数据"""
+        for item_id in self.index:
+            yield self.get(item_id)
+
+    def image_path(self, relative: str) -> str:
+        """将数据中的图片路径转换为绝对路径"""
+        return os.path.join(self.output_dir, relative)
@@ -0,0 +1,241 @@
+import hashlib
+import io
+import os
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from image_preprocessor import _load_pil
+from journal import RunJournal
+
+# NumPy 在第一次批量计算哈希时才导入；None 表示尚未导入，False 表示未安装
+_np = None
+
+# dHash 的缩放尺寸：(HASH_SIZE + 1) x HASH_SIZE 的灰度图，得到 HASH_SIZE * HASH_SIZE 位哈希
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def _load_numpy():
+    """延迟导入 NumPy，未安装时逐张计算哈希"""
+    global _np
+    if _np is None:
+        try:
+            import numpy
+            _np = numpy
+        except ImportError:
+            _np = False
+    return _np or None
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _grayscale_pixels(image_data: bytes) -> Optional[List[int]]:
+    """将图片缩放为 (HASH_SIZE + 1) x HASH_SIZE 的灰度图，返回按行展开的像素值；无法解码时返回 None"""
+    Image = _load_pil()
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            # 先用 draft 让 JPEG 解码器直接输出缩小的图像，大图也只需解码很少的像素
+            image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+            small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+            return list(small.getdata())
+    except Exception:
+        return None
+
+
+def _dhash(pixels: List[int]) -> int:
+    """按行比较相邻像素的亮度得到差值哈希"""
+    value = 0
+    width = HASH_SIZE + 1
+    for row in range(HASH_SIZE):
+        offset = row * width
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col + 1] > pixels[offset + col])
+    return value
+
+
+def _dhash_batch(pixel_rows: List[List[int]]) -> List[int]:
+    """用 NumPy 一次计算多张图片的差值哈希，结果与 _dhash 逐张计算一致"""
+    np = _load_numpy()
+    if np is None:
+        return [_dhash(pixels) for pixels in pixel_rows]
+    grid = np.asarray(pixel_rows, dtype=np.int16).reshape(len(pixel_rows), HASH_SIZE, HASH_SIZE + 1)
+    bits = (grid[:, :, 1:] > grid[:, :, :-1]).reshape(len(pixel_rows), HASH_BITS)
+    # 按高位在前打包为 64 位整数
+    packed = np.packbits(bits, axis=1).view('>u8').ravel()
+    return [int(v) for v in packed]
+
+
+def perceptual_hashes(image_dir: str, image_files: Iterable[str],
+                      batch_size: int = 256) -> Dict[str, str]:
+    """计算图片的感知哈希，返回 {图片文件名: 哈希}
+    安装了 Pillow 时为 64 位 dHash（形如 "d:0f3c..."），近似的图片哈希距离很小；
+    未安装或图片无法解码时退化为内容哈希（形如 "c:9ab1..."），只能识别完全相同的文件。
+    Args:
+        image_dir: 图片目录
+        image_files: 图片文件名
+        batch_size: 每批一起计算 dHash 的图片数
+    """
+    use_pil = _load_pil() is not None
+    hashes = {}
+    pending_names, pending_pixels = [], []
+
+    def flush():
+        for name, value in zip(pending_names, _dhash_batch(pending_pixels)):
+            hashes[name] = f"d:{value:016x}"
+        pending_names.clear()
+        pending_pixels.clear()
+
+    for image_file in image_files:
+        try:
+            with open(os.path.join(image_dir, image_file), 'rb') as f:
+                image_data = f.read()
+        except OSError:
+            continue
+        pixels = _grayscale_pixels(image_data) if use_pil else None
+        if pixels is None:
+            hashes[image_file] = f"c:{hashlib.sha1(image_data).hexdigest()}"
+            continue
+        pending_names.append(image_file)
+        pending_pixels.append(pixels)
+        if len(pending_names) >= batch_size:
+            flush()
+    flush()
+    return hashes
+
+
+class HammingIndex:
+    """64 位哈希的汉明距离近邻索引
+
+    按鸽巢原理把哈希切成 max_distance + 1 段，距离不超过 max_distance 的两个哈希
+    至少有一段完全相同，因此只需在各段的精确匹配桶中找候选，再逐个计算距离。
+    """
+
+    def __init__(self, max_distance: int, bits: int = HASH_BITS):
+        self.max_distance = max_distance
+        self.bits = bits
+        segments = min(max_distance + 1, bits)
+        # 各段的 (起始位, 位数)
+        size, extra = divmod(bits, segments)
+        self._segments = []
+        start = 0
+        for i in range(segments):
+            width = size + (1 if i < extra else 0)
+            self._segments.append((start, width))
+            start += width
+        self._buckets = [defaultdict(list) for _ in self._segments]
+        self._values: Dict[str, int] = {}
+
+    def _keys(self, value: int):
+        for i, (start, width) in enumerate(self._segments):
+            yield i, (value >> start) & ((1 << width) - 1)
+
+    def add(self, name: str, value: int):
+        self._values[name] = value
+        for i, key in self._keys(value):
+            self._buckets[i][key].append(name)
+
+    def nearest(self, value: int) -> Optional[Tuple[str, int]]:
+        """返回距离不超过 max_distance 的最近的已索引项 (名称, 距离)，没有时返回 None；距离相同时取先加入的"""
+        best = None
+        seen = set()
+        for i, key in self._keys(value):
+            for name in self._buckets[i].get(key, ()):
+                if name in seen:
+                    continue
+                seen.add(name)
+                distance = hamming(value, self._values[name])
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (name, distance)
+        return best
+
+
+class DuplicateClusters:
+    """近似重复图片的聚类结果：每个簇保留一张代表图，其余图片指向它"""
+
+    def __init__(self):
+        self.representatives: List[str] = []
+        # {重复图片: 代表图}
+        self.duplicate_of: Dict[str, str] = {}
+
+    def clusters(self) -> Dict[str, List[str]]:
+        """返回 {代表图: [重复图片]}，只包含有重复的簇"""
+        clusters = defaultdict(list)
+        for name, representative in self.duplicate_of.items():
+            clusters[representative].append(name)
+        return dict(clusters)
+
+
+def cluster_duplicates(hashes: Dict[str, str], max_distance: int = 6,
+                       journal: RunJournal = None) -> DuplicateClusters:
+    """按输入顺序将近似重复的图片聚类
+    每张图片与已有的代表图比较，距离不超过 max_distance 时归入最近的代表图所在的簇，
+    否则成为新的代表图。只与代表图比较，簇内任意图片与代表图的距离都不超过阈值，不会
+    因为连续帧逐渐变化而串成一个大簇。
+    Args:
+        hashes: perceptual_hashes 的结果，按图片顺序排列
+        max_distance: dHash 的最大汉明距离，内容哈希只合并完全相同的文件
+        journal: 断点续跑日志，记录每张图片的哈希和所属代表图；之前运行的聚类结果保持不变，
+            新图片与之前的代表图比较（增量运行时新图片不会与旧代表图重复分析）
+    """
+    result = DuplicateClusters()
+    index = HammingIndex(max_distance)
+    exact: Dict[str, str] = {}
+
+    def add_representative(name: str, value: str):
+        result.representatives.append(name)
+        if value.startswith('d:'):
+            index.add(name, int(value[2:], 16))
+        else:
+            exact[value] = name
+
+    previous = journal.records(RunJournal.DEDUP) if journal is not None else {}
+    for name, entry in previous.items():
+        # 内容已变化的旧代表图按新哈希重新聚类
+        if entry['duplicate_of'] is None and hashes.get(name, entry['hash']) == entry['hash']:
+            add_representative(name, entry['hash'])
+
+    for name, value in hashes.items():
+        entry = previous.get(name)
+        if entry is not None and entry['hash'] == value:
+            if entry['duplicate_of'] is not None:
+                result.duplicate_of[name] = entry['duplicate_of']
+            continue
+        if value.startswith('d:'):
+            match = index.nearest(int(value[2:], 16))
+            representative = match[0] if match else None
+        else:
+            representative = exact.get(value)
+        if representative is None:
+            add_representative(name, value)
+        else:
+            result.duplicate_of[name] = representative
+        if journal is not None:
+            journal.record(RunJournal.DEDUP, name, {'hash': value, 'duplicate_of': representative})
+
+    # 本次没有出现的旧代表图不再作为结果的一部分
+    present = set(hashes)
+    result.representatives = [name for name in result.representatives if name in present]
+    return result
+
+
+def find_duplicates(image_dir: str, image_files: Iterable[str], max_distance: int = 6,
+                    journal: RunJournal = None) -> DuplicateClusters:
+    """计算感知哈希并聚类近似重复的图片，日志中已有哈希的图片不再重新读取
+    Args:
+        image_dir: 图片目录
+        image_files: 图片文件名，聚类按此顺序进行，靠前的图片优先成为代表图
+        max_distance: dHash 的最大汉明距离
+        journal: 断点续跑日志
+    """
+    image_files = list(image_files)
+    known = journal.records(RunJournal.DEDUP) if journal is not None else {}
+    computed = perceptual_hashes(image_dir, (name for name in image_files if name not in known))
+    hashes = {}
+    for name in image_files:
+        if name in known:
+            hashes[name] = known[name]['hash']
+        elif name in computed:
+            hashes[name] = computed[name]
+    return cluster_duplicates(hashes, max_distance, journal)
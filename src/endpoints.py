@@ -0,0 +1,221 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, TypeVar
+
+from metrics import MetricsRecorder
+from rate_limit import is_retryable
+
+T = TypeVar('T')
+
+
+class Endpoint:
+    """一个模型服务副本及其负载和健康状态"""
+
+    def __init__(self, url: str, client: Any, async_client: Any):
+        self.url = url
+        self.client = client
+        self.async_client = async_client
+        # 正在进行中的请求数，用于最少未完成请求路由
+        self.outstanding = 0
+        self.failures = 0
+        self.unhealthy_until = 0.0
+        self.ewma_latency = None
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.unhealthy_until
+
+
+class EndpointPool:
+    """多个模型服务副本的负载均衡和对冲请求
+
+    每次请求发往健康副本中未完成请求数最少的一个（相同时选平滑延迟更低的）。
+    副本连续失败 failure_threshold 次后在一段时间内不再分配请求，冷却时间随连续
+    失败次数翻倍，只有限流、超时、服务端错误等可重试的失败计入，请求参数错误不影响副本状态。
+    开启对冲后，请求超过同一阶段近期延迟的 hedge_percentile 分位数仍未返回时，向另一个副本
+    发送一份相同的请求，先返回的结果生效。延迟样本按阶段分别保留，批量判断等较慢的阶段
+    不会因为单图请求的分位数而几乎每次都被对冲。异步请求中另一份被取消；同步请求在线程池中执行，
+    落后的一份无法中断，在后台完成后丢弃结果。
+    """
+
+    def __init__(self, endpoints: Sequence[Endpoint], hedge_percentile: float = None,
+                 hedge_min_samples: int = 20, failure_threshold: int = 3,
+                 unhealthy_cooldown: float = 10.0, window: int = 500,
+                 metrics: MetricsRecorder = None, hedge_workers: int = 32):
+        """
+        Args:
+            endpoints: 模型服务副本列表
+            hedge_percentile: 触发对冲请求的延迟分位数（如 95），为 None 时不对冲
+            hedge_min_samples: 一个阶段积累多少个延迟样本后才开始对冲该阶段的请求
+            failure_threshold: 连续失败多少次后将副本标记为不健康
+            unhealthy_cooldown: 不健康副本的初始冷却时间（秒）
+            window: 计算对冲阈值时每个阶段使用的最近延迟样本数
+            metrics: 运行指标，记录对冲次数
+            hedge_workers: 同步请求对冲时使用的线程数上限
+        """
+        if not endpoints:
+            raise ValueError("至少需要一个模型服务地址")
+        self.endpoints: List[Endpoint] = list(endpoints)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.unhealthy_cooldown = unhealthy_cooldown
+        self.metrics = metrics
+        self.window = window
+        # 阶段 -> 该阶段最近的延迟样本
+        self._latencies: Dict[Optional[str], Deque[float]] = {}
+        self._lock = threading.Lock()
+        self.hedge_workers = hedge_workers
+        # 同步对冲使用的线程池，第一次对冲时才创建
+        self._executor = None
+
+    def _acquire(self, exclude: Sequence[Endpoint] = ()) -> Endpoint:
+        """选出一个副本并计入其未完成请求数"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude] or list(self.endpoints)
+            healthy = [e for e in candidates if e.healthy(now)]
+            # 全部不健康时仍然选一个最早恢复的，避免请求直接失败
+            pool = healthy or sorted(candidates, key=lambda e: e.unhealthy_until)[:1]
+            endpoint = min(pool, key=lambda e: (e.outstanding, e.ewma_latency or 0.0))
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _samples(self, stage: Optional[str]) -> Deque[float]:
+        """某个阶段的延迟样本窗口，调用方持有 _lock"""
+        samples = self._latencies.get(stage)
+        if samples is None:
+            samples = self._latencies[stage] = deque(maxlen=self.window)
+        return samples
+
+    def _release(self, endpoint: Endpoint, latency: float = None, failed: bool = False, stage: str = None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.failures += 1
+                if endpoint.failures >= self.failure_threshold:
+                    backoff = 2 ** (endpoint.failures - self.failure_threshold)
+                    endpoint.unhealthy_until = time.monotonic() + self.unhealthy_cooldown * min(backoff, 32)
+            elif latency is not None:
+                endpoint.failures = 0
+                endpoint.unhealthy_until = 0.0
+                endpoint.ewma_latency = latency if endpoint.ewma_latency is None else \
+                    0.8 * endpoint.ewma_latency + 0.2 * latency
+                self._samples(stage).append(latency)
+
+    def hedge_delay(self, stage: str = None) -> Optional[float]:
+        """返回某个阶段的请求触发对冲的等待时间，未开启对冲或该阶段样本不足时返回 None"""
+        if self.hedge_percentile is None or len(self.endpoints) < 2:
+            return None
+        with self._lock:
+            samples = self._latencies.get(stage, ())
+            if len(samples) < self.hedge_min_samples:
+                return None
+            ordered = sorted(samples)
+        index = min(int(len(ordered) * self.hedge_percentile / 100), len(ordered) - 1)
+        return ordered[index]
+
+    def _fail(self, endpoint: Endpoint, error: Exception):
+        # 请求参数等不可重试的错误说明副本本身可用，只释放未完成请求数
+        self._release(endpoint, failed=is_retryable(error))
+
+    def _sync_attempt(self, endpoint: Endpoint, fn: Callable[[Any], T], stage: str = None) -> T:
+        start = time.perf_counter()
+        try:
+            result = fn(endpoint.client)
+        except Exception as e:
+            self._fail(endpoint, e)
+            raise
+        self._release(endpoint, latency=time.perf_counter() - start, stage=stage)
+        return result
+
+    def _submit(self, endpoint: Endpoint, fn: Callable[[Any], T], stage: str = None) -> concurrent.futures.Future:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.hedge_workers, thread_name_prefix='hedge')
+        return self._executor.submit(self._sync_attempt, endpoint, fn, stage)
+
+    def call(self, fn: Callable[[Any], T], stage: str = None) -> T:
+        """在选出的副本上同步执行请求，fn 接收该副本的同步客户端；超过 stage 阶段的对冲阈值时
+        向另一个副本发送相同请求"""
+        primary = self._acquire()
+        delay = self.hedge_delay(stage)
+        if delay is None:
+            return self._sync_attempt(primary, fn, stage)
+
+        first = self._submit(primary, fn, stage)
+        done, _ = concurrent.futures.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        secondary = self._acquire(exclude=[primary])
+        if self.metrics is not None:
+            self.metrics.count('hedged_requests')
+        second = self._submit(secondary, fn, stage)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second and self.metrics is not None:
+                        self.metrics.count('hedge_wins')
+                    return future.result()
+                error = future.exception()
+        # 两份请求都失败时抛出最后一个异常，交给上层重试
+        raise error
+
+    async def _attempt(self, endpoint: Endpoint, fn: Callable[[Any], Awaitable[T]], stage: str = None) -> T:
+        start = time.perf_counter()
+        try:
+            result = await fn(endpoint.async_client)
+        except asyncio.CancelledError:
+            # 被对冲请求抢先时取消，不计为失败
+            self._release(endpoint)
+            raise
+        except Exception as e:
+            self._fail(endpoint, e)
+            raise
+        self._release(endpoint, latency=time.perf_counter() - start, stage=stage)
+        return result
+
+    async def acall(self, fn: Callable[[Any], Awaitable[T]], stage: str = None) -> T:
+        """在选出的副本上异步执行请求，超过 stage 阶段的对冲阈值时向另一个副本发送相同请求"""
+        primary = self._acquire()
+        first = asyncio.ensure_future(self._attempt(primary, fn, stage))
+        delay = self.hedge_delay(stage)
+        if delay is None:
+            return await first
+
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+        except BaseException:
+            # 调用方被取消时 asyncio.wait 不会取消等待中的请求
+            first.cancel()
+            raise
+        if done:
+            return first.result()
+
+        secondary = self._acquire(exclude=[primary])
+        if self.metrics is not None:
+            self.metrics.count('hedged_requests')
+        second = asyncio.ensure_future(self._attempt(secondary, fn, stage))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second and self.metrics is not None:
+                            self.metrics.count('hedge_wins')
+                        return task.result()
+                    error = task.exception()
+            # 两份请求都失败时抛出最后一个异常，交给上层重试
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,111 @@
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+# Pillow 在第一次预处理图片时才导入；None 表示尚未导入，False 表示未安装
+_Image = None
+
+
+def _load_pil():
+    """延迟导入 Pillow，未安装时只做编码，不做缩放"""
+    global _Image
+    if _Image is None:
+        try:
+            from PIL import Image
+            _Image = Image
+        except ImportError:
+            _Image = False
+    return _Image or None
+
+
+class ImagePreprocessor:
+    """上传前的图片预处理
+
+    将图片按最长边缩放并重新编码为 JPEG，生成 data URL，并按图片内容哈希
+    缓存编码结果，同一张图片在多次请求中只编码一次。缓存按总字节数限制内存占用。
+    """
+
+    def __init__(self, max_side: int = 1280, quality: int = 85,
+                 max_cache_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+            max_side: 图片最长边上限（像素），为 None 时不缩放
+            quality: 重新编码的 JPEG 质量
+            max_cache_bytes: 编码结果缓存的总字节数上限，为 0 时不缓存
+        """
+        if max_side is not None and max_side <= 0:
+            raise ValueError(f"max_side 必须为正数: {max_side}")
+        if not 1 <= quality <= 95:
+            raise ValueError(f"quality 应在 1~95 之间: {quality}")
+        self.max_side = max_side
+        self.quality = quality
+        self.max_cache_bytes = max_cache_bytes
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sniff_mime(image_data: bytes) -> str:
+        """根据文件头判断图片类型"""
+        if image_data.startswith(b'\x89PNG'):
+            return 'image/png'
+        return 'image/jpeg'
+
+    def preprocess(self, image_data: bytes) -> Tuple[bytes, str]:
+        """缩放并重新编码图片
+        Returns:
+            Tuple[bytes, str]: 处理后的图片数据和对应的 MIME 类型
+        """
+        mime = self._sniff_mime(image_data)
+        Image = _load_pil()
+        if Image is None:
+            return image_data, mime
+
+        try:
+            with Image.open(io.BytesIO(image_data)) as image:
+                resized = False
+                if self.max_side and max(image.size) > self.max_side:
+                    image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+                    resized = True
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                buffer = io.BytesIO()
+                image.save(buffer, format='JPEG', quality=self.quality, optimize=True)
+        except Exception:
+            # 无法解码的图片原样上传，由模型服务端处理
+            return image_data, mime
+
+        encoded = buffer.getvalue()
+        # 未缩放且重新编码后反而更大时保留原图
+        if not resized and len(encoded) >= len(image_data):
+            return image_data, mime
+        return encoded, 'image/jpeg'
+
+    def to_data_url(self, image_data: bytes) -> str:
+        """返回图片的 data URL，相同内容的图片复用缓存的编码结果"""
+        key = hashlib.sha1(image_data).hexdigest()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+
+        processed, mime = self.preprocess(image_data)
+        data_url = f"data:{mime};base64,{base64.b64encode(processed).decode('utf-8')}"
+
+        if self.max_cache_bytes and len(data_url) <= self.max_cache_bytes:
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = data_url
+                    self._cache_bytes += len(data_url)
+                    while self._cache_bytes > self.max_cache_bytes:
+                        _, evicted = self._cache.popitem(last=False)
+                        self._cache_bytes -= len(evicted)
+        return data_url
+
+    def to_base64(self, image_data: bytes) -> str:
+        """返回预处理后图片的 base64 编码"""
+        return self.to_data_url(image_data).split(',', 1)[1]
@@ -0,0 +1,88 @@
+import itertools
+import json
+import os
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, Tuple, TypeVar
+
+T = TypeVar('T')
+
+# 支持的图片格式
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def iter_image_files(image_dir: str) -> Iterator[str]:
+    """逐个产出目录下的图片文件名，不一次性列出整个目录"""
+    with os.scandir(image_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                yield entry.name
+
+
+def iter_annotations(jsonl_file: str, base_dir: str = '') -> Iterator[Tuple[str, Dict]]:
+    """逐行读取标注文件，产出 (图片文件名, 标注数据)
+    Args:
+        jsonl_file: converted_annotations.jsonl 文件路径
+        base_dir: 标注中图片相对路径的根目录
+    """
+    with open(jsonl_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            yield os.path.basename(data['image']), {
+                'objects': data['objects'],
+                'scene': data['scene'],
+                'anomaly': data['anomaly'],
+                # 构建完整图片路径
+                'image_path': os.path.join(base_dir, data['image'])
+            }
+
+
+def count_lines(path: str) -> int:
+    """统计文件中的非空行数"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return sum(1 for line in f if line.strip())
+
+
+def shard_of(name: str, num_shards: int) -> int:
+    """按文件名计算稳定的分片编号，与进程、机器和遍历顺序无关"""
+    return zlib.crc32(name.encode('utf-8')) % num_shards
+
+
+def shard_items(items: Iterable[T], num_shards: int = 1, shard_index: int = 0,
+                mode: str = 'hash', total: int = None,
+                key: Callable[[T], str] = lambda item: item) -> Iterator[T]:
+    """从数据流中选出属于指定分片的元素
+    Args:
+        items: 输入数据流
+        num_shards: 分片总数
+        shard_index: 当前分片编号，从 0 开始
+        mode: 'hash' 按文件名哈希分片；'range' 按位置切分为连续区间
+        total: 数据总数，range 模式下必须提供
+        key: 从元素中取出文件名的函数，hash 模式使用
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"分片编号 {shard_index} 超出范围 [0, {num_shards})")
+    if num_shards == 1:
+        yield from items
+        return
+
+    if mode == 'hash':
+        for item in items:
+            if shard_of(key(item), num_shards) == shard_index:
+                yield item
+    elif mode == 'range':
+        if total is None:
+            raise ValueError("range 分片模式需要提供数据总数 total")
+        start = total * shard_index // num_shards
+        stop = total * (shard_index + 1) // num_shards
+        yield from itertools.islice(items, start, stop)
+    else:
+        raise ValueError(f"未知的分片模式: {mode}")
+
+
+def limit_items(items: Iterable[T], limit: int = None, offset: int = 0) -> Iterator[T]:
+    """跳过前 offset 个元素后最多取 limit 个，limit 为 None 时不限制"""
+    stop = None if limit is None else offset + limit
+    return itertools.islice(items, offset, stop)
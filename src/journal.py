@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+from typing import Dict, Iterator, Tuple
+
+
+class RunJournal:
+    """生成流程的断点续跑日志
+
+    每个阶段（图片分析、配对判断、问答输出）对应一个追加写入的 JSONL 文件，
+    每完成一项工作立即写入并落盘。进程中断后重新运行时，已完成的工作直接
+    从日志中恢复，不再重复请求模型。
+    """
+
+    # 图片分析结果，键为图片文件名
+    ANALYZE = 'analyze'
+    # 配对判断结果，键为 "参考图|测试图"
+    PAIR = 'pair'
+    # 已写入输出文件的问答，键为 "参考图|测试图"
+    QA = 'qa'
+    # 近似重复检测的感知哈希和所属代表图，键为图片文件名
+    DEDUP = 'dedup'
+
+    def __init__(self, journal_dir: str, fsync: bool = True):
+        """
+        Args:
+            journal_dir: 日志目录
+            fsync: 每次写入后是否调用 fsync，确保断电后日志不丢失
+        """
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self._records: Dict[str, Dict[str, Dict]] = {}
+        self._files = {}
+        self._lock = threading.Lock()
+        os.makedirs(journal_dir, exist_ok=True)
+
+    @staticmethod
+    def pair_key(ref_name: str, test_name: str) -> str:
+        """配对相关阶段使用的日志键"""
+        return f"{ref_name}|{test_name}"
+
+    def _path(self, stage: str) -> str:
+        return os.path.join(self.journal_dir, f"{stage}.jsonl")
+
+    def _open_for_append(self, stage: str):
+        """以追加模式打开日志，上次中断留下的半行先补上换行，避免与新记录粘连"""
+        path = self._path(stage)
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b'\n'
+        f = open(path, 'a', encoding='utf-8')
+        if needs_newline:
+            f.write('\n')
+        return f
+
+    def iter_records(self, stage: str) -> Iterator[Tuple[str, Dict]]:
+        """逐行读取某阶段日志中的记录，不缓存到内存，用于迁移等一次性遍历"""
+        path = self._path(stage)
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程中断时最后一行可能只写了一半，直接忽略
+                    continue
+                yield entry['key'], entry['value']
+
+    def records(self, stage: str) -> Dict[str, Dict]:
+        """返回某阶段已完成的全部记录，格式为 {key: value}"""
+        if stage not in self._records:
+            self._records[stage] = dict(self.iter_records(stage))
+        return self._records[stage]
+
+    def has(self, stage: str, key: str) -> bool:
+        """判断某项工作是否已完成"""
+        return key in self.records(stage)
+
+    def get(self, stage: str, key: str, default=None):
+        return self.records(stage).get(key, default)
+
+    def record(self, stage: str, key: str, value):
+        """记录一项已完成的工作并立即落盘"""
+        line = json.dumps({'key': key, 'value': value}, ensure_ascii=False) + '\n'
+        with self._lock:
+            records = self.records(stage)
+            f = self._files.get(stage)
+            if f is None:
+                f = self._files[stage] = self._open_for_append(stage)
+            f.write(line)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            records[key] = value
+
+    def reset(self):
+        """清空所有阶段的日志，从头开始运行"""
+        with self._lock:
+            self.close()
+            for name in os.listdir(self.journal_dir):
+                if name.endswith('.jsonl'):
+                    os.remove(os.path.join(self.journal_dir, name))
+            self._records = {}
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
@@ -1,134 +1,489 @@
 from api_client import ModelClient
 from analyzer import ImageAnalyzer
+from cache import ResponseCache
+from dataset_writer import IMAGE_MODES, DatasetWriter, JsonlWriter, remove_dataset
+from dedup import find_duplicates
+from image_preprocessor import ImagePreprocessor
+from ingest import count_lines, iter_annotations, shard_items
+from journal import RunJournal
+from metrics import MetricsRecorder
+from rate_limit import AdaptiveConcurrencyLimiter, RequestController
+from pipeline import GenerationPipeline, make_data_item
+from planner import DEFAULT_LATENCY, RunPlanner, format_plan, latencies_from_report
+from prompts import PromptBuilder
+from scheduler import PairScheduler
+from shards import merge_shards, shard_dir
+from store import CorpusStore, remove_store
+from functools import partial
+from typing import Dict
 import os
+import argparse
+import asyncio
 import shutil
 import json
-import json_repair
-def main():
-    # 配置路径
-    base_dir = "/data1/ljc/code/application-data-generation"
-    raw_dir = os.path.join(base_dir, "data/images/v0_100")
-    # 更新输出目录路径
-    dataset_dir = "/data1/ljc/项目/参照图数据生成/data/reference_dataset"
-    # 输入 JSONL 文件路径
-    jsonl_file = os.path.join(base_dir, "data/sample_annotation/v0_100/converted_annotations.jsonl")
-    # 更新输出文件路径
+
+# 默认路径配置
+BASE_DIR = "/data1/ljc/code/application-data-generation"
+RAW_DIR = os.path.join(BASE_DIR, "data/images/v0_100")
+DATASET_DIR = "/data1/ljc/项目/参照图数据生成/data/reference_dataset/v0"
+ANNOTATION_FILE = os.path.join(BASE_DIR, "data/sample_annotation/v0_100/converted_annotations.jsonl")
+
+# 模型调用阶段，--cache-bypass / --cache-invalidate 可以使用阶段名或下面的简称
+MODEL_STAGES = ('scene_description', 'scene_description_batch', 'pair_match', 'qa_pair',
+                'pair_judge', 'pair_judge_batch')
+STAGE_ALIASES = {
+    'describe': ('scene_description', 'scene_description_batch'),
+    'judge': ('pair_match', 'qa_pair', 'pair_judge', 'pair_judge_batch'),
+    'all': MODEL_STAGES,
+}
+
+
+def stage_list(value: str) -> set:
+    """解析逗号分隔的阶段列表，如 "describe,pair_judge"，未知的阶段名报参数错误"""
+    stages = set()
+    for name in (part.strip() for part in value.split(',')):
+        if not name:
+            continue
+        if name in STAGE_ALIASES:
+            stages.update(STAGE_ALIASES[name])
+        elif name in MODEL_STAGES:
+            stages.add(name)
+        else:
+            raise argparse.ArgumentTypeError(
+                f"未知的阶段 {name}，可选: {', '.join(list(STAGE_ALIASES) + list(MODEL_STAGES))}")
+    return stages
+
+
+def int_range(low: int, high: int = None):
+    """argparse 的整数参数类型，超出 [low, high] 时报参数错误，high 为 None 时不限上限"""
+    def parse(value: str) -> int:
+        try:
+            n = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"{value} 不是整数")
+        if n < low or (high is not None and n > high):
+            bounds = f"{low}~{high}" if high is not None else f"不小于 {low}"
+            raise argparse.ArgumentTypeError(f"{value} 超出范围，应为 {bounds}")
+        return n
+    return parse
+
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="参照图数据生成工具")
+    parser.add_argument('--base-dir', default=BASE_DIR, help="标注中图片相对路径的根目录")
+    parser.add_argument('--image-dir', default=RAW_DIR, help="原始图片目录")
+    parser.add_argument('--annotations', default=ANNOTATION_FILE, help="converted_annotations.jsonl 路径")
+    parser.add_argument('--output-dir', default=DATASET_DIR, help="数据集输出目录")
+    parser.add_argument('--limit', type=int, default=None, help="最多分析的图片数，默认不限制")
+    parser.add_argument('--offset', type=int, default=0, help="跳过的图片数")
+    parser.add_argument('--num-shards', type=int, default=1, help="输入分片总数")
+    parser.add_argument('--shard-index', type=int, default=0, help="本次处理的分片编号，从 0 开始")
+    parser.add_argument('--shard-mode', choices=['hash', 'range'], default='hash',
+                        help="分片方式：hash 按文件名哈希，range 按标注文件中的位置切分")
+    parser.add_argument('--api-key', default='YOUR_API_KEY', help="模型服务 API Key")
+    parser.add_argument('--base-url', default='http://140.207.201.5:60070/v1',
+                        help="模型服务地址，多个副本用逗号分隔")
+    parser.add_argument('--model', default=None, help="固定使用的模型id，默认查询模型服务并缓存到输出目录")
+    parser.add_argument('--hedge-percentile', type=float, default=None,
+                        help="请求超过近期延迟的该分位数（如 95）时向另一个副本发送对冲请求，默认不对冲")
+    parser.add_argument('--max-concurrency', type=int, default=16, help="图片分析阶段同时进行中的模型请求数上限")
+    parser.add_argument('--rate-limit', type=float, default=None, help="每秒最多发送的模型请求数，默认不限速")
+    parser.add_argument('--stream', action='store_true',
+                        help="流式请求返回 JSON 的阶段，JSON 闭合后立即停止生成，多余的尾部输出不再等待也不影响解析")
+    parser.add_argument('--cache-bypass', type=stage_list, default=set(),
+                        help="逗号分隔的阶段，这些阶段跳过响应缓存、总是重新请求模型，如 describe,pair_judge")
+    parser.add_argument('--cache-invalidate', type=stage_list, default=set(),
+                        help="逗号分隔的阶段，运行前清除这些阶段的缓存（all 为全部阶段）")
+    parser.add_argument('--max-retries', type=int, default=5, help="限流、超时和服务端错误的最大重试次数")
+    parser.add_argument('--merge', action='store_true',
+                        help="合并 output-dir 下各分片的输出并去重，不调用模型")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="流水线模式：分析、配对和问答生成同时进行，结果随完成随写入")
+    parser.add_argument('--queue-size', type=int, default=64, help="流水线模式下阶段之间队列的容量")
+    parser.add_argument('--dedup-distance', type=int, default=None,
+                        help="近似重复检测的感知哈希最大汉明距离（如 6），重复图片只分析代表图，默认不检测")
+    parser.add_argument('--prompt-token-budget', type=int, default=None,
+                        help="单个配对请求提示词的 token 上限，超出时截短场景描述，默认不限制")
+    parser.add_argument('--image-max-side', type=int_range(0), default=1280,
+                        help="上传前图片最长边上限（像素），超出时等比缩放，0 表示不缩放")
+    parser.add_argument('--image-quality', type=int_range(1, 95), default=85,
+                        help="上传前重新编码的 JPEG 质量（1~95）")
+    parser.add_argument('--describe-batch-size', type=int, default=1,
+                        help="每个场景描述请求包含的图片数，大于 1 时多张图片合并为一次请求")
+    parser.add_argument('--pair-batch-tokens', type=int, default=None,
+                        help="批量判断配对：每个请求提示词的 token 预算，默认逐对判断")
+    parser.add_argument('--pair-batch-size', type=int, default=32, help="批量判断时每个请求最多的候选对数")
+    parser.add_argument('--target-pairs', type=int, default=None,
+                        help="目标问答数：候选对按本地优先级依次判断，达到后停止请求模型，默认判断全部候选对")
+    parser.add_argument('--budget-tokens', type=int, default=None,
+                        help="配对阶段的 token 预算（提示词与生成合计），用完后停止，默认不限制")
+    parser.add_argument('--budget-calls', type=int, default=None,
+                        help="配对阶段实际发送的请求数预算，命中缓存的请求不计入，默认不限制")
+    parser.add_argument('--max-pairs-per-image', type=int, default=None,
+                        help="每张图片最多参与的问答数，使问答分布在更多图片上，默认不限制")
+    parser.add_argument('--max-pairs-per-scene', type=int, default=None, help="每个场景最多的问答数，默认不限制")
+    parser.add_argument('--dataset-layout', choices=['jsonl', 'sharded'], default='jsonl',
+                        help="jsonl 写入单个 multimodal_data.jsonl；sharded 图片按内容存放一份，数据写入轮转分片并建立索引")
+    parser.add_argument('--image-mode', choices=IMAGE_MODES, default='hardlink',
+                        help="sharded 布局下图片的写入方式：硬链接、复制或只引用原始路径")
+    parser.add_argument('--shard-max-mb', type=int, default=256, help="sharded 布局下单个数据分片的大小上限（MB）")
+    parser.add_argument('--compress', action='store_true', help="sharded 布局下用 gzip 压缩数据分片")
+    parser.add_argument('--state-store', choices=['journal', 'sqlite'], default='journal',
+                        help="图片分析结果和配对结论的保存方式：journal 为 JSONL 日志并全部载入内存；"
+                             "sqlite 写入 state.sqlite 并按需读取，适合百万级图片")
+    parser.add_argument('--fresh', action='store_true', help="清空断点续跑日志和输出文件，从头开始运行")
+    parser.add_argument('--incremental', action='store_true',
+                        help="增量运行：只为上次运行之后新增的图片生成配对")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="只估计本次运行的请求数、token 数和耗时并写入 run_plan.json，不调用模型")
+    parser.add_argument('--plan-latency', type=float, default=None,
+                        help="估计耗时使用的单次请求延迟（秒），默认取上次运行的 run_report.json，没有时为 2 秒")
+    parser.add_argument('--plan-match-rate', type=float, default=0.5, help="估计时假设的候选对配对成功比例")
+    parser.add_argument('--plan-image-tokens', type=int, default=1024, help="估计时每张图片的 token 数")
+    parser.add_argument('--plan-description-tokens', type=int, default=150,
+                        help="估计时每张图片场景描述的 token 数")
+    return parser.parse_args(argv)
+
+
+def load_annotations(jsonl_file: str, base_dir: str, num_shards: int = 1,
+                     shard_index: int = 0, shard_mode: str = 'hash') -> Dict[str, Dict]:
+    """流式读取标注文件，只保留属于当前分片的标注数据"""
+    total = count_lines(jsonl_file) if shard_mode == 'range' and num_shards > 1 else None
+    return dict(shard_items(
+        iter_annotations(jsonl_file, base_dir),
+        num_shards=num_shards,
+        shard_index=shard_index,
+        mode=shard_mode,
+        total=total,
+        key=lambda item: item[0]
+    ))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    raw_dir = args.image_dir
+    dataset_dir = args.output_dir
+    
+    if args.merge:
+        merged_file = os.path.join(dataset_dir, "multimodal_data.jsonl")
+        num_shards = args.num_shards if args.num_shards > 1 else None
+        stats = merge_shards(dataset_dir, merged_file, num_shards=num_shards, image_mode=args.image_mode,
+                             compress=args.compress, max_shard_bytes=args.shard_max_mb * 1024 * 1024)
+        if stats['missing_shards']:
+            print(f"警告：缺少分片 {stats['missing_shards']} 的输出")
+        merged = merged_file if stats['layout'] == 'jsonl' else os.path.join(dataset_dir, "data")
+        print(f"合并完成: {merged}，统计: {stats}")
+        return
+    
+    if args.num_shards > 1:
+        # worker 模式：日志和输出写入分片自己的目录，最后用 --merge 合并
+        dataset_dir = shard_dir(args.output_dir, args.shard_index, args.num_shards)
     multimodal_file = os.path.join(dataset_dir, "multimodal_data.jsonl")
+
+    # 读取注释文件
+    image_annotations = load_annotations(
+        args.annotations, args.base_dir,
+        num_shards=args.num_shards, shard_index=args.shard_index, shard_mode=args.shard_mode
+    )
+
+    if args.dry_run:
+        plan_run(args, raw_dir, dataset_dir, image_annotations)
+        return
     
     # 确保输出目录存在
     os.makedirs(dataset_dir, exist_ok=True)
+
+    # 断点续跑日志，进程中断后重新运行时跳过已完成的工作
+    journal = RunJournal(os.path.join(dataset_dir, "journal"))
+    store_file = os.path.join(dataset_dir, "state.sqlite")
+    if args.fresh:
+        journal.reset()
+        if os.path.exists(multimodal_file):
+            os.remove(multimodal_file)
+        remove_dataset(dataset_dir)
+        remove_store(store_file)
+    # sqlite 存储代替日志中的图片分析和配对判断阶段，结果按需从磁盘读取
+    store = CorpusStore(store_file) if args.state_store == 'sqlite' else None
+    if store is not None and not store.has_written():
+        # 已写入的问答改由存储记录，之前运行记在日志中的逐行迁移过来
+        for key, value in journal.iter_records(RunJournal.QA):
+            store.mark_written(*key.split('|', 1), value.get('id'))
+    # 上次运行已分析过的图片，增量模式下只为其余图片生成配对（使用存储时由存储记录）
+    previous_images = set(journal.records(RunJournal.ANALYZE)) if store is None else None
+
+    # 模型响应缓存，重复运行时未变化的请求直接复用结果，同一台机器上的各分片共享
+    cache_file = os.path.join(args.output_dir, "response_cache.sqlite")
     
-    # 读取注释文件
-    image_annotations = {}
-    with open(jsonl_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            data = json.loads(line)
-            # 构建完整图片路径
-            full_image_path = os.path.join(base_dir, data['image'])
-            image_annotations[os.path.basename(data['image'])] = {
-                'objects': data['objects'],
-                'scene': data['scene'],
-                'anomaly': data['anomaly'],
-                'image_path': full_image_path
-            }
-
-    #try:
-        # 配置
-    raw_dir = "/data1/ljc/code/application-data-generation/data/images/v0_100"
-    dataset_dir = "/data1/ljc/项目/参照图数据生成/data/reference_dataset/v0"
-    multimodal_file = os.path.join(dataset_dir, "multimodal_data.jsonl")
+    cache = ResponseCache(
+        cache_file,
+        max_bytes=1024 * 1024 * 1024,
+        max_age_seconds=30 * 24 * 3600,
+        bypass_stages=args.cache_bypass
+    )
+    for stage in sorted(args.cache_invalidate):
+        removed = cache.invalidate(stage)
+        if removed:
+            print(f"已清除 {stage} 阶段的 {removed} 条缓存")
+    
+    # 运行指标，结束时写入 run_report.json 和 metrics.prom
+    metrics = MetricsRecorder()
     
     # 初始化API客户端
     client = ModelClient(
-        api_key='YOUR_API_KEY',
-        base_url='http://140.207.201.5:60070/v1'
+        api_key=args.api_key,
+        base_url=[url.strip() for url in args.base_url.split(',') if url.strip()],
+        cache=cache,
+        preprocessor=ImagePreprocessor(max_side=args.image_max_side or None, quality=args.image_quality),
+        metrics=metrics,
+        controller=RequestController(
+            rate=args.rate_limit,
+            max_retries=args.max_retries,
+            # 并发上限从 --max-concurrency 开始，按服务端的延迟和错误率自适应调整
+            concurrency=AdaptiveConcurrencyLimiter(initial=args.max_concurrency,
+                                                   max_limit=2 * args.max_concurrency)
+        ),
+        hedge_percentile=args.hedge_percentile,
+        model=args.model,
+        model_cache_file=os.path.join(args.output_dir, "model_id.json"),
+        stream=args.stream
     )
-    analyzer = ImageAnalyzer(client)
-    
-    # 分析所有图片
-    print("开始分析图片...")
-    image_infos = analyzer.analyze_images(raw_dir, annotations=image_annotations)
-    if not image_infos:
-        raise Exception("没有成功分析任何图片")
+    prompts = PromptBuilder(token_budget=args.prompt_token_budget, metrics=metrics)
+    analyzer = ImageAnalyzer(client, journal=journal, prompts=prompts, store=store)
+    # 设置了目标或预算时按优先级安排候选对，达到后停止请求模型
+    scheduler = None
+    if any(v is not None for v in (args.target_pairs, args.budget_tokens, args.budget_calls,
+                                   args.max_pairs_per_image, args.max_pairs_per_scene)):
+        scheduler = PairScheduler(
+            target_pairs=args.target_pairs, token_budget=args.budget_tokens, call_budget=args.budget_calls,
+            max_per_image=args.max_pairs_per_image, max_per_scene=args.max_pairs_per_scene, metrics=metrics
+        )
+        seed_scheduler(scheduler, journal, store)
+    # sharded 布局：图片按内容存放一份，数据写入轮转分片，并生成 manifest 和偏移索引
+    writer = None
+    if args.dataset_layout == 'sharded':
+        writer = DatasetWriter(dataset_dir, image_mode=args.image_mode,
+                               max_shard_bytes=args.shard_max_mb * 1024 * 1024, compress=args.compress)
+        multimodal_file = os.path.join(dataset_dir, "data")
+
+    try:
+        if args.dedup_distance is not None:
+            # 近似重复的连续帧只保留代表图，重复图片不分析也不参与配对
+            with metrics.phase('dedup'):
+                duplicates = find_duplicates(raw_dir, image_annotations, args.dedup_distance, journal)
+            for name in duplicates.duplicate_of:
+                image_annotations.pop(name, None)
+            metrics.count('duplicates_skipped', len(duplicates.duplicate_of))
+            with open(os.path.join(dataset_dir, "duplicates.json"), 'w', encoding='utf-8') as f:
+                json.dump(duplicates.clusters(), f, ensure_ascii=False, indent=2)
+            print(f"近似重复检测：{len(duplicates.duplicate_of)} 张图片与代表图重复，已跳过")
+
+        if args.pipeline:
+            print(f"流水线模式，结果写入 {multimodal_file}")
+            pipeline = GenerationPipeline(
+                analyzer, raw_dir, image_annotations, multimodal_file,
+                analyze_concurrency=args.max_concurrency, pair_concurrency=args.max_concurrency,
+                queue_size=args.queue_size, batch_tokens=args.pair_batch_tokens,
+                max_batch_pairs=args.pair_batch_size, describe_batch_size=args.describe_batch_size,
+                writer=writer, scheduler=scheduler
+            )
+            # 增量模式下历次运行分析过的图片只作为新图片的配对候选
+            seed_infos = None
+            if args.incremental:
+                seed_infos = (store.infos(current_run=False) if store is not None
+                              else dict(journal.records(RunJournal.ANALYZE)))
+            with metrics.phase('pipeline'):
+                stats = asyncio.run(pipeline.run(limit=args.limit, offset=args.offset, seed_infos=seed_infos))
+            for name, n in stats.items():
+                metrics.count(name, n)
+            metrics.count('images_failed', len(analyzer.failed_images))
+            print(f"处理完成！流水线统计: {stats}，缓存统计: {cache.stats()}")
+            return
         
-    # 创建参照图对
-    print("开始创建参照图对...")
-    pairs = analyzer.create_reference_pairs(image_infos)
-    if not pairs:
-        raise Exception("没有找到合适的参照图对")
+        # 分析所有图片
+        print("开始分析图片...")
+        with metrics.phase('analyze'):
+            image_infos = asyncio.run(analyzer.analyze_images_async(
+                raw_dir, annotations=image_annotations, max_concurrency=args.max_concurrency,
+                limit=args.limit, offset=args.offset, batch_size=args.describe_batch_size
+            ))
+        metrics.count('analyzed', len(image_infos))
+        metrics.count('images_failed', len(analyzer.failed_images))
+        if analyzer.failed_images:
+            print(f"{len(analyzer.failed_images)} 张图片分析失败")
+        new_images = None
+        if args.incremental:
+            # 新图片需要与历次运行分析过的全部图片配对
+            if store is not None:
+                new_images = store.new_image_names()
+                image_infos = store.infos(current_run=False)
+            else:
+                new_images = [name for name in image_infos if name not in previous_images]
+                image_infos = {**journal.records(RunJournal.ANALYZE), **image_infos}
+            print(f"增量模式：{len(new_images)} 张新图片")
+            if not new_images:
+                print("没有新增图片，无需生成配对")
+                return
+        if not image_infos:
+            raise Exception("没有成功分析任何图片")
+            
+        # 创建参照图对
+        print("开始创建参照图对...")
+        with metrics.phase('pair'):
+            pairs = analyzer.create_reference_pairs(
+                image_infos, only_images=new_images, batch_tokens=args.pair_batch_tokens,
+                max_batch_pairs=args.pair_batch_size, scheduler=scheduler
+            )
+        metrics.count('pairs_matched', len(pairs))
+        if scheduler is not None and scheduler.stop_reason is not None:
+            print(f"已达到{'目标问答数' if scheduler.stop_reason == 'target' else '预算'}，"
+                  f"停止判断剩余候选对，配对阶段消耗: {scheduler.spent()}")
+        if not pairs:
+            if scheduler is not None and scheduler.produced and scheduler.stop_reason == 'target':
+                print("之前运行已写出的问答已达到目标，无需生成")
+                return
+            raise Exception("没有找到合适的参照图对")
+            
+        # 生成多模态训练数据
+        print(f"开始生成多模态训练数据到 {multimodal_file}")
+        with metrics.phase('qa'):
+            generate_multimodal_data(pairs, raw_dir, multimodal_file, journal=journal, metrics=metrics,
+                                     writer=writer, store=store)
         
-    # 生成多模态训练数据
-    print(f"开始生成多模态训练数据到 {multimodal_file}")
-    generate_multimodal_data(pairs, image_infos, raw_dir, multimodal_file, client)
-    
-    print("处理完成！")
+        print(f"处理完成！缓存统计: {cache.stats()}")
+    finally:
+        if writer is not None:
+            # 先写出缓冲中的数据，其日志记录在写出后才落盘
+            writer.close()
+            for name, n in writer.stats.items():
+                metrics.count(f'dataset_{name}', n)
+        if store is not None:
+            store.close()
+            for name, n in store.stats.items():
+                metrics.count(f'store_{name}', n)
+        journal.close()
+        metrics.write_json(os.path.join(dataset_dir, "run_report.json"))
+        metrics.write_prometheus(os.path.join(dataset_dir, "metrics.prom"))
         
     # except Exception as e:
     #     print(f"发生错误: {str(e)}")
     #     return
 
-def generate_multimodal_data(pairs, image_infos, raw_dir, output_file, client):
-    """生成多模态训练数据"""
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for i, (ref_name, test_name) in enumerate(pairs):
-            # 获取两张图片的分析信息
-            ref_info = image_infos[ref_name]
-            test_info = image_infos[test_name]
-            
-            # 构建提示词，包含两张图片的详细分析信息
-            prompt = f"""基于以下两张工地场景图片的分析信息，生成一个专业的问答对：
+def plan_run(args, raw_dir: str, dataset_dir: str, image_annotations: Dict):
+    """估计按当前参数运行所需的请求数、token 数和耗时，不调用模型，也不修改日志、存储和输出文件
+    Args:
+        args: 命令行参数
+        raw_dir: 原始图片目录
+        dataset_dir: 本次运行的输出目录，已有的日志或存储中完成的工作不计入
+        image_annotations: 图片标注数据字典
+    """
+    journal_dir = os.path.join(dataset_dir, "journal")
+    store_file = os.path.join(dataset_dir, "state.sqlite")
+    # --fresh 会清空之前的结果，按从头运行估计
+    journal = store = None
+    if not args.fresh:
+        if args.state_store == 'sqlite':
+            store = CorpusStore(store_file) if os.path.exists(store_file) else None
+        elif os.path.isdir(journal_dir):
+            journal = RunJournal(journal_dir)
 
-                    参考图信息：
-                    {json.dumps(ref_info, ensure_ascii=False, indent=2)}
+    if args.dedup_distance is not None:
+        # 近似重复检测只读取本地图片，哈希不写入日志
+        duplicates = find_duplicates(raw_dir, image_annotations, args.dedup_distance)
+        for name in duplicates.duplicate_of:
+            image_annotations.pop(name, None)
+        print(f"近似重复检测：{len(duplicates.duplicate_of)} 张图片与代表图重复，将被跳过")
 
-                    测试图信息：
-                    {json.dumps(test_info, ensure_ascii=False, indent=2)}
+    latencies = {} if args.plan_latency is not None else latencies_from_report(
+        os.path.join(dataset_dir, "run_report.json"))
+    planner = RunPlanner(
+        prompts=PromptBuilder(token_budget=args.prompt_token_budget),
+        image_tokens=args.plan_image_tokens, description_tokens=args.plan_description_tokens,
+        match_rate=args.plan_match_rate
+    )
+    try:
+        plan = planner.plan(
+            raw_dir, image_annotations, limit=args.limit, offset=args.offset,
+            pipeline=args.pipeline, batch_tokens=args.pair_batch_tokens,
+            max_batch_pairs=args.pair_batch_size, describe_batch_size=args.describe_batch_size,
+            target_pairs=args.target_pairs, token_budget=args.budget_tokens, call_budget=args.budget_calls,
+            max_per_image=args.max_pairs_per_image, max_per_scene=args.max_pairs_per_scene,
+            incremental=args.incremental, journal=journal, store=store,
+            concurrency=args.max_concurrency, rate=args.rate_limit, latencies=latencies,
+            default_latency=DEFAULT_LATENCY if args.plan_latency is None else args.plan_latency
+        )
+    finally:
+        if store is not None:
+            store.close()
+        if journal is not None:
+            journal.close()
 
-                    请生成一个问答对，要求：
-                    1. 问题应该从参考图的场景出发，询问测试图的相关情况
-                    2. 回答应该详细对比两张图片中物体的异同
-                    3. 回答要突出重点，使用专业的描述方式
+    print(format_plan(plan))
+    os.makedirs(dataset_dir, exist_ok=True)
+    plan_file = os.path.join(dataset_dir, "run_plan.json")
+    with open(plan_file, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, ensure_ascii=False, indent=2)
+    print(f"估计结果已写入 {plan_file}")
 
-                    请以下面的JSON格式返回：
-                    {{
-                        "question": "您的问题",
-                        "answer": "您的回答"
-                    }}"""
-            
-            # 调用模型生成问答对
-            response = client.client.chat.completions.create(
-                model=client.model,
-                messages=[{
-                    'role': 'user',
-                    'content': [{
-                        'type': 'text',
-                        'text': prompt,
-                    }],
-                }],
-                temperature=0.8,
-                top_p=0.8
-            )
+def seed_scheduler(scheduler: PairScheduler, journal: RunJournal, store: CorpusStore = None):
+    """续跑时把之前运行已写出的问答计入调度器，目标问答数和各图片、场景的上限包含这些问答
+    Args:
+        scheduler: 配对调度器
+        journal: 断点续跑日志，不使用存储时从其中读取已写出的问答和图片信息
+        store: 状态存储，提供时从其中读取已写出的问答和图片信息
+    """
+    if store is not None:
+        scheduler.seed(store.written_pairs(), store.infos(current_run=False))
+    else:
+        written = (tuple(key.split('|', 1)) for key in journal.records(RunJournal.QA))
+        scheduler.seed(written, journal.records(RunJournal.ANALYZE))
+    if scheduler.produced:
+        print(f"之前运行已写出 {scheduler.produced} 个问答，计入目标")
+
+def generate_multimodal_data(pairs, raw_dir, output_file, journal: RunJournal = None,
+                             metrics: MetricsRecorder = None, writer=None, store: CorpusStore = None):
+    """将 create_reference_pairs 生成的问答写为多模态训练数据，不再调用模型
+    Args:
+        pairs: create_reference_pairs 返回的配对列表，每项包含 reference、test 和 qa_pair
+        raw_dir: 原始图片目录
+        output_file: 输出的 JSONL 文件路径
+        journal: 断点续跑日志，提供时跳过已写入的配对并追加写入输出文件
+        metrics: 运行指标，记录写入和解析失败的条数
+        writer: 数据写入器（如 DatasetWriter），由调用方负责关闭；为 None 时写入 output_file
+        store: 状态存储，提供时已写入的配对记在存储中，逐条查询而不把日志整体载入内存
+    """
+    mode = 'w' if journal is None and store is None else 'a'
+    f = writer or JsonlWriter(output_file, mode)
+    try:
+        for pair in pairs:
+            ref_name, test_name = pair['reference'], pair['test']
+            key = RunJournal.pair_key(ref_name, test_name)
+            if store is not None:
+                if store.is_written(ref_name, test_name):
+                    continue
+            elif journal is not None and journal.has(RunJournal.QA, key):
+                continue
             
             try:
-                qa_pair = json.loads(response.choices[0].message.content)
                 # 构建完整的数据条目
-                data_item = {
-                    "id": f"pair_{i}",
-                    "images": [
-                        os.path.join(raw_dir, ref_name),
-                        os.path.join(raw_dir, test_name)
-                    ],
-                    "conversations": [
-                        {"from": "human", "value": qa_pair["question"]},
-                        {"from": "assistant", "value": qa_pair["answer"]}
-                    ]
-                }
-                # 写入JSONL文件
-                f.write(json.dumps(data_item, ensure_ascii=False) + '\n')
-                
-            except json.JSONDecodeError as e:
+                data_item = make_data_item(raw_dir, ref_name, test_name, pair['qa_pair'])
+            except (KeyError, TypeError) as e:
+                if metrics is not None:
+                    metrics.count('multimodal_qa_parse_failed')
                 print(f"解析问答对失败: {str(e)}")
                 continue
+            # 先落盘再记日志，中断时最多重复写入尚未记录的几条
+            on_flushed = None
+            if store is not None:
+                on_flushed = partial(store.mark_written, ref_name, test_name, data_item['id'])
+            elif journal is not None:
+                on_flushed = partial(journal.record, RunJournal.QA, key, {'id': data_item['id']})
+            f.write(data_item, on_flushed)
+            if metrics is not None:
+                metrics.count('written')
+    finally:
+        if f is not writer:
+            f.close()
 
 def _generate_comparison_text(ref_info, test_info):
     """根据两张图片的分析信息生成比较文本"""
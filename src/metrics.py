@@ -0,0 +1,225 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+# Prometheus 直方图的延迟分桶上界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class StageMetrics:
+    """单个阶段的模型调用统计"""
+
+    def __init__(self, max_samples: int, rng: random.Random):
+        self.calls = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.errors = Counter()
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        # 蓄水池采样保留的延迟样本，用于估计百分位数，内存占用与调用次数无关
+        self.samples: List[float] = []
+        self._max_samples = max_samples
+        self._rng = rng
+
+    def add(self, latency: float, prompt_tokens: int, completion_tokens: int,
+            retries: int, error: str, cached: bool):
+        self.calls += 1
+        if cached:
+            # 命中缓存的调用只计数，其耗时不代表模型请求，不计入延迟统计
+            self.cache_hits += 1
+            return
+        self.retries += retries
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        if error is not None:
+            self.errors[error] += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+                break
+        if len(self.samples) < self._max_samples:
+            self.samples.append(latency)
+        else:
+            slot = self._rng.randrange(self.requests)
+            if slot < self._max_samples:
+                self.samples[slot] = latency
+
+    @property
+    def requests(self) -> int:
+        """实际发送的请求数，即延迟统计覆盖的调用数"""
+        return self.calls - self.cache_hits
+
+    def percentile(self, q: float) -> float:
+        """线性插值计算延迟百分位数，q 取值 0~100"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        pos = (len(ordered) - 1) * q / 100
+        low = int(pos)
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+    def summary(self) -> Dict:
+        return {
+            'calls': self.calls,
+            'cache_hits': self.cache_hits,
+            'errors': dict(self.errors),
+            'retries': self.retries,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'latency': {
+                'mean': self.latency_sum / self.requests if self.requests else 0.0,
+                'max': self.latency_max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+            },
+        }
+
+
+class MetricsRecorder:
+    """模型调用和流程阶段的运行指标
+
+    ModelClient 的每次调用都会记录延迟、提示词/生成 token 数、重试次数和错误类型，
+    并按阶段（scene_description、pair_match 等）汇总；流程各阶段的总耗时和处理数量
+    由调用方通过 phase / count 记录。结果可导出为 JSON 运行报告或 Prometheus 文本格式。
+    """
+
+    def __init__(self, max_samples: int = 10000, seed: int = 0):
+        """
+        Args:
+            max_samples: 每个阶段保留的延迟样本数上限
+            seed: 蓄水池采样的随机种子
+        """
+        self.max_samples = max_samples
+        self.started_at = time.time()
+        self.stages: Dict[str, StageMetrics] = {}
+        self.phases: Dict[str, float] = {}
+        self.counters = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def record_call(self, stage: str, latency: float, prompt_tokens: int = 0,
+                    completion_tokens: int = 0, retries: int = 0, error: str = None,
+                    cached: bool = False):
+        """记录一次模型调用
+        Args:
+            stage: 调用所属阶段
+            latency: 调用耗时（秒）
+            prompt_tokens: 提示词 token 数，取自响应中的 usage
+            completion_tokens: 生成 token 数，取自响应中的 usage
+            retries: 本次调用的重试次数
+            error: 调用失败时的异常类名
+            cached: 是否命中响应缓存
+        """
+        with self._lock:
+            metrics = self.stages.get(stage)
+            if metrics is None:
+                metrics = self.stages[stage] = StageMetrics(self.max_samples, self._rng)
+            metrics.add(latency, prompt_tokens, completion_tokens, retries, error, cached)
+
+    @contextmanager
+    def phase(self, name: str):
+        """记录一个流程阶段（如全部图片分析）的总耗时，同名阶段累加"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name: str, n: int = 1):
+        """累加一个处理数量计数，如成功分析的图片数、写入的问答数"""
+        with self._lock:
+            self.counters[name] += n
+
+    def usage(self, stages: Iterable[str] = None) -> Dict[str, int]:
+        """返回指定阶段（为 None 时为全部阶段）实际发送的请求数和消耗的 token 数，命中缓存的调用不计入"""
+        with self._lock:
+            selected = [m for name, m in self.stages.items() if stages is None or name in stages]
+            return {
+                'calls': sum(m.requests for m in selected),
+                'tokens': sum(m.prompt_tokens + m.completion_tokens for m in selected),
+            }
+
+    def report(self) -> Dict:
+        """返回 JSON 格式的运行报告"""
+        with self._lock:
+            stages = {name: m.summary() for name, m in sorted(self.stages.items())}
+            phases = dict(self.phases)
+            counters = dict(self.counters)
+        return {
+            'started_at': self.started_at,
+            'elapsed_seconds': time.time() - self.started_at,
+            'phases': phases,
+            'counters': counters,
+            'stages': stages,
+            'totals': {
+                'calls': sum(s['calls'] for s in stages.values()),
+                'prompt_tokens': sum(s['prompt_tokens'] for s in stages.values()),
+                'completion_tokens': sum(s['completion_tokens'] for s in stages.values()),
+                'errors': sum(sum(s['errors'].values()) for s in stages.values()),
+            },
+        }
+
+    def write_json(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+
+    def to_prometheus(self, prefix: str = 'refgen') -> str:
+        """导出为 Prometheus 文本格式"""
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        with self._lock:
+            stages = sorted(self.stages.items())
+            metric('model_calls_total', 'counter', 'Model calls per stage')
+            for stage, m in stages:
+                lines.append(f'{prefix}_model_calls_total{{stage="{stage}"}} {m.calls}')
+            metric('model_cache_hits_total', 'counter', 'Model calls served from the response cache')
+            for stage, m in stages:
+                lines.append(f'{prefix}_model_cache_hits_total{{stage="{stage}"}} {m.cache_hits}')
+            metric('model_retries_total', 'counter', 'Retried model requests')
+            for stage, m in stages:
+                lines.append(f'{prefix}_model_retries_total{{stage="{stage}"}} {m.retries}')
+            metric('model_errors_total', 'counter', 'Failed model calls by error class')
+            for stage, m in stages:
+                for error, n in sorted(m.errors.items()):
+                    lines.append(f'{prefix}_model_errors_total{{stage="{stage}",error="{error}"}} {n}')
+            metric('model_tokens_total', 'counter', 'Prompt and completion tokens')
+            for stage, m in stages:
+                lines.append(f'{prefix}_model_tokens_total{{stage="{stage}",kind="prompt"}} {m.prompt_tokens}')
+                lines.append(f'{prefix}_model_tokens_total{{stage="{stage}",kind="completion"}} {m.completion_tokens}')
+            metric('model_latency_seconds', 'histogram', 'Model request latency, excluding cache hits')
+            for stage, m in stages:
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, m.buckets):
+                    cumulative += n
+                    lines.append(f'{prefix}_model_latency_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_model_latency_seconds_bucket{{stage="{stage}",le="+Inf"}} {m.requests}')
+                lines.append(f'{prefix}_model_latency_seconds_sum{{stage="{stage}"}} {m.latency_sum}')
+                lines.append(f'{prefix}_model_latency_seconds_count{{stage="{stage}"}} {m.requests}')
+            metric('phase_seconds', 'gauge', 'Wall-clock time per pipeline phase')
+            for name, seconds in sorted(self.phases.items()):
+                lines.append(f'{prefix}_phase_seconds{{phase="{name}"}} {seconds}')
+            metric('items_total', 'counter', 'Items processed by the pipeline')
+            for name, n in sorted(self.counters.items()):
+                lines.append(f'{prefix}_items_total{{kind="{name}"}} {n}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
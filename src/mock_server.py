@@ -0,0 +1,348 @@
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from prompts import estimate_tokens as text_tokens
+
+# 根据提示语中的关键词识别请求所属阶段
+STAGE_MARKERS = [
+    ('scene_description_batch', '请按图片编号分别描述'),
+    ('scene_description', '对以下标注物体描述'),
+    ('pair_judge_batch', '请逐一判断以下候选图片对'),
+    ('pair_judge', '适合时同时生成'),
+    ('pair_match', '是否适合作为参照图对'),
+    ('qa_pair', '生成一个专业的问答对'),
+    ('extract_image_info', '请分析图片中的'),
+    ('analyze_image', '请参考以下标准分析图片'),
+]
+
+# 各阶段的默认模拟回复
+DEFAULT_RESPONSES = {
+    'scene_description': json.dumps({"塔吊": "黄色高大塔吊，正在进行钢构件吊装",
+                                     "安全网": "绿色密织安全网，完整覆盖外立面"}, ensure_ascii=False),
+    'qa_pair': json.dumps({"question": "测试图中的塔吊与参考图相比有什么不同？",
+                           "answer": "测试图中的塔吊处于停机状态，参考图中正在吊装钢构件。"}, ensure_ascii=False),
+    'extract_image_info': "1.设备信息：塔吊 2.人员穿戴：安全帽 3.人员行为：正常作业",
+    'analyze_image': json.dumps({"objects": {"塔吊": "黄色塔吊，正在作业"}}, ensure_ascii=False),
+    'default': "好的",
+}
+
+
+class MockConfig:
+    """模拟服务的延迟、错误率和回复配置"""
+
+    def __init__(self, latency_dist: str = 'lognormal', latency_mean: float = 0.5,
+                 latency_std: float = 0.2, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 match_rate: float = 0.5, responses: Dict[str, str] = None,
+                 model: str = 'mock-qwen-vl', seed: int = None, trailing_text: str = '',
+                 chunk_chars: int = 8, chunk_latency: float = 0.0):
+        """
+        Args:
+            latency_dist: 延迟分布，fixed / uniform / lognormal
+            latency_mean: 平均延迟（秒）
+            latency_std: 延迟标准差（秒），uniform 分布下为半宽
+            error_rate: 返回 500 的请求比例
+            rate_limit_rate: 返回 429 的请求比例
+            match_rate: 配对判断回复 "是" 的比例
+            responses: 按阶段覆盖默认回复
+            model: /models 接口返回的模型id
+            seed: 随机种子，为 None 时不固定
+            trailing_text: 追加在 JSON 回复之后的多余文字，模拟模型在 JSON 之后继续输出
+            chunk_chars: 流式回复每个分块的字符数
+            chunk_latency: 流式回复每个分块之间的间隔（秒），模拟逐 token 生成
+        """
+        if latency_dist not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError(f"未知的延迟分布: {latency_dist}")
+        self.latency_dist = latency_dist
+        self.latency_mean = latency_mean
+        self.latency_std = latency_std
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.match_rate = match_rate
+        self.responses = {**DEFAULT_RESPONSES, **(responses or {})}
+        self.model = model
+        self.trailing_text = trailing_text
+        self.chunk_chars = max(1, chunk_chars)
+        self.chunk_latency = chunk_latency
+        # 客户端提前断开的流式请求数
+        self.streams_aborted = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def random(self) -> float:
+        with self._lock:
+            return self._rng.random()
+
+    def sample_latency(self) -> float:
+        """按配置的分布采样一次请求延迟"""
+        mean, std = self.latency_mean, self.latency_std
+        with self._lock:
+            if self.latency_dist == 'fixed' or mean <= 0:
+                return max(mean, 0.0)
+            if self.latency_dist == 'uniform':
+                return max(self._rng.uniform(mean - std, mean + std), 0.0)
+            # 对数正态分布，参数换算使其均值和标准差与配置一致
+            sigma2 = math.log(1 + (std / mean) ** 2)
+            mu = math.log(mean) - sigma2 / 2
+            return self._rng.lognormvariate(mu, sigma2 ** 0.5)
+
+
+def message_text(messages: List[Dict]) -> str:
+    """拼接请求消息中的全部文本"""
+    texts = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts.extend(part.get('text', '') for part in content if isinstance(part, dict))
+    return '\n'.join(texts)
+
+
+def detect_stage(messages: List[Dict]) -> str:
+    """根据请求消息中的文本识别调用阶段"""
+    text = message_text(messages)
+    for stage, marker in STAGE_MARKERS:
+        if marker in text:
+            return stage
+    return 'default'
+
+
+def estimate_tokens(messages: List[Dict]) -> int:
+    """粗略估计提示词 token 数：文本与客户端使用相同的估计，每张图片按固定数量计"""
+    tokens = 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            tokens += text_tokens(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'image_url':
+                    tokens += 1024
+                else:
+                    tokens += text_tokens(part.get('text', ''))
+    return tokens
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """OpenAI 兼容接口的最小实现：GET /models 和 POST /chat/completions"""
+
+    config: MockConfig = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # 压测时不打印每条请求日志
+        pass
+
+    def _send_json(self, status: int, payload: Dict, headers: Dict = None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {'object': 'list', 'data': [
+                {'id': self.config.model, 'object': 'model', 'owned_by': 'mock'}
+            ]})
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+    def _verdict(self) -> Dict:
+        """按配对率随机生成一个配对结论，配对时附带问答"""
+        if self.config.random() < self.config.match_rate:
+            return {'match': True, **json.loads(self.config.responses['qa_pair'])}
+        return {'match': False}
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'not found'}})
+            return
+
+        config = self.config
+        time.sleep(config.sample_latency())
+        roll = config.random()
+        if roll < config.rate_limit_rate:
+            self._send_json(429, {'error': {'message': 'rate limited', 'type': 'rate_limit'}},
+                            headers={'Retry-After': '1'})
+            return
+        if roll < config.rate_limit_rate + config.error_rate:
+            self._send_json(500, {'error': {'message': 'mock server error', 'type': 'server_error'}})
+            return
+
+        messages = request.get('messages', [])
+        stage = detect_stage(messages)
+        if stage == 'pair_match':
+            content = "是" if config.random() < config.match_rate else "否"
+        elif stage == 'scene_description_batch':
+            # 按提示词中的图片编号逐一回复
+            image_ids = re.findall(r'^图片 (I\d+)，', message_text(messages), re.MULTILINE)
+            description = json.loads(config.responses['scene_description'])
+            content = json.dumps({image_id: description for image_id in image_ids}, ensure_ascii=False)
+        elif stage == 'pair_judge':
+            content = json.dumps(self._verdict(), ensure_ascii=False)
+        elif stage == 'pair_judge_batch':
+            # 按提示词中的候选对编号逐一回复
+            pair_ids = re.findall(r'^\s*(P\d+):', message_text(messages), re.MULTILINE)
+            content = json.dumps([{'id': pair_id, **self._verdict()} for pair_id in pair_ids],
+                                 ensure_ascii=False)
+        else:
+            content = config.responses.get(stage, config.responses['default'])
+        if config.trailing_text and content.lstrip()[:1] in ('{', '['):
+            content += config.trailing_text
+        prompt_tokens = estimate_tokens(messages)
+        completion_tokens = text_tokens(content)
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+        if request.get('stream'):
+            include_usage = (request.get('stream_options') or {}).get('include_usage', False)
+            self._send_stream(request, content, usage if include_usage else None)
+            return
+        self._send_json(200, {
+            'id': f"chatcmpl-mock-{time.time_ns()}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', config.model),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': usage,
+        })
+
+    def _send_stream(self, request: Dict, content: str, usage: Dict = None):
+        """以 SSE 分块发送回复，客户端提前断开时停止生成"""
+        config = self.config
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        base = {
+            'id': f"chatcmpl-mock-{time.time_ns()}",
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': request.get('model', config.model),
+        }
+
+        def event(choices: List[Dict], **extra):
+            payload = json.dumps({**base, 'choices': choices, **extra}, ensure_ascii=False)
+            self.wfile.write(f"data: {payload}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        try:
+            for i in range(0, len(content), config.chunk_chars):
+                if config.chunk_latency:
+                    time.sleep(config.chunk_latency)
+                event([{'index': 0, 'delta': {'content': content[i:i + config.chunk_chars]},
+                        'finish_reason': None}])
+            event([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+            if usage is not None:
+                event([], usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            with config._lock:
+                config.streams_aborted += 1
+
+
+class MockServer:
+    """在后台线程中运行的模拟模型服务"""
+
+    def __init__(self, config: MockConfig = None, host: str = '127.0.0.1', port: int = 0):
+        """
+        Args:
+            config: 模拟服务配置
+            host: 监听地址
+            port: 监听端口，为 0 时自动选择空闲端口
+        """
+        self.config = config or MockConfig()
+        handler = type('BoundMockHandler', (MockHandler,), {'config': self.config})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> 'MockServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_config_args(parser: argparse.ArgumentParser):
+    """添加模拟服务配置相关的命令行参数，供独立运行和压测脚本共用"""
+    parser.add_argument('--latency-dist', choices=['fixed', 'uniform', 'lognormal'], default='lognormal',
+                        help="模拟请求延迟的分布")
+    parser.add_argument('--latency-mean', type=float, default=0.5, help="平均延迟（秒）")
+    parser.add_argument('--latency-std', type=float, default=0.2, help="延迟标准差（秒），uniform 分布下为半宽")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回 500 的请求比例")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="返回 429 的请求比例")
+    parser.add_argument('--match-rate', type=float, default=0.5, help="配对判断回复“是”的比例")
+    parser.add_argument('--responses', default=None, help="按阶段覆盖默认回复的 JSON 文件，格式为 {stage: text}")
+    parser.add_argument('--seed', type=int, default=None, help="随机种子")
+    parser.add_argument('--trailing-text', default='', help="追加在 JSON 回复之后的多余文字")
+    parser.add_argument('--chunk-latency', type=float, default=0.0, help="流式回复每个分块之间的间隔（秒）")
+
+
+def config_from_args(args) -> MockConfig:
+    responses = None
+    if args.responses:
+        with open(args.responses, 'r', encoding='utf-8') as f:
+            responses = json.load(f)
+    return MockConfig(
+        latency_dist=args.latency_dist, latency_mean=args.latency_mean, latency_std=args.latency_std,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, match_rate=args.match_rate,
+        responses=responses, seed=args.seed, trailing_text=args.trailing_text,
+        chunk_latency=args.chunk_latency
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的本地模拟模型服务")
+    parser.add_argument('--host', default='127.0.0.1', help="监听地址")
+    parser.add_argument('--port', type=int, default=8000, help="监听端口")
+    add_config_args(parser)
+    args = parser.parse_args(argv)
+
+    server = MockServer(config_from_args(args), host=args.host, port=args.port)
+    print(f"模拟模型服务已启动: {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
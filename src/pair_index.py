@@ -0,0 +1,199 @@
+import heapq
+import random
+import zlib
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+# MinHash 使用的梅森素数
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+class CandidatePairIndex:
+    """基于标注物体和场景标签的本地候选配对索引
+
+    每张图片被表示为一组特征词（标注物体 + 场景标签），通过倒排索引找出
+    与其共享特征词的图片，并按 Jaccard 相似度打分，只为每张图片保留
+    top_k 个最有希望的候选，交给模型判断。
+    出现在大量图片中的高频特征词（如"作业人员"）不走倒排表，改用 MinHash
+    LSH 分桶召回，避免倒排表退化为全量两两比较。
+    """
+
+    def __init__(self, max_posting: int = 1000, num_perm: int = 32,
+                 bands: int = 8, seed: int = 42):
+        """
+        Args:
+            max_posting: 倒排表长度上限，超过该数量的特征词视为高频词，不再用于召回
+            num_perm: MinHash 签名长度
+            bands: LSH 分段数，每段 num_perm // bands 行
+            seed: MinHash 随机种子，保证结果可复现
+        """
+        if num_perm % bands != 0:
+            raise ValueError("num_perm 必须能被 bands 整除")
+        self.max_posting = max_posting
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+
+        self.names: List[str] = []
+        self.features: Dict[str, Set[str]] = {}
+        self._order: Dict[str, int] = {}
+        self._postings: Dict[str, List[str]] = defaultdict(list)
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], List[str]] = defaultdict(list)
+
+    @staticmethod
+    def extract_features(info: Dict) -> Set[str]:
+        """从图片信息中提取特征词：标注物体和场景标签
+        Args:
+            info: analyze_images 返回的单张图片信息，或直接为标注数据
+        """
+        annotation = info.get('annotation', info)
+        features = set()
+        for obj in annotation.get('objects', []) or []:
+            obj = str(obj).strip().lower()
+            if obj:
+                features.add(f"obj:{obj}")
+        scene = annotation.get('scene')
+        if isinstance(scene, str):
+            scene = [scene]
+        for label in scene or []:
+            label = str(label).strip().lower()
+            if label:
+                features.add(f"scene:{label}")
+        return features
+
+    def _minhash(self, features: Set[str]) -> List[int]:
+        """计算特征集合的 MinHash 签名"""
+        hashes = [zlib.crc32(f.encode('utf-8')) for f in features]
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self._perms]
+
+    def add(self, name: str, info: Dict):
+        """将一张图片加入索引"""
+        if name in self.features:
+            return
+        features = self.extract_features(info)
+        self._order[name] = len(self.names)
+        self.names.append(name)
+        self.features[name] = features
+        for feature in features:
+            self._postings[feature].append(name)
+        if features:
+            signature = self._minhash(features)
+            for band in range(self.bands):
+                chunk = tuple(signature[band * self.rows:(band + 1) * self.rows])
+                self._buckets[(band, chunk)].append(name)
+
+    def add_all(self, image_infos: Dict[str, Dict]):
+        """批量加入图片"""
+        for name, info in image_infos.items():
+            self.add(name, info)
+
+    @staticmethod
+    def jaccard(a: Set[str], b: Set[str]) -> float:
+        """计算两个特征集合的 Jaccard 相似度"""
+        if not a or not b:
+            return 0.0
+        inter = len(a & b)
+        return inter / (len(a) + len(b) - inter)
+
+    def _recall(self, name: str) -> Counter:
+        """召回与指定图片可能相似的图片，返回 {图片名: 低频特征词重合数}"""
+        features = self.features[name]
+        overlap = Counter()
+        for feature in features:
+            posting = self._postings[feature]
+            if len(posting) <= self.max_posting:
+                overlap.update(posting)
+        if features:
+            signature = self._minhash(features)
+            for band in range(self.bands):
+                chunk = tuple(signature[band * self.rows:(band + 1) * self.rows])
+                for other in self._buckets.get((band, chunk), []):
+                    overlap[other] += 0
+        overlap.pop(name, None)
+        return overlap
+
+    def query(self, name: str, top_k: int = 10) -> List[Tuple[str, float]]:
+        """返回与指定图片最相似的 top_k 张已索引图片及其 Jaccard 相似度"""
+        features = self.features[name]
+        size = len(features)
+        # 高频特征词未参与倒排计数，单独补上其重合数
+        frequent = [f for f in features if len(self._postings[f]) > self.max_posting]
+        all_features = self.features
+        scored = []
+        for other, inter in self._recall(name).items():
+            other_features = all_features[other]
+            for feature in frequent:
+                if feature in other_features:
+                    inter += 1
+            if inter:
+                scored.append((inter / (size + len(other_features) - inter), other))
+        # 相似度相同时按加入顺序排序，保证结果稳定
+        order = self._order
+        best = heapq.nsmallest(top_k, scored, key=lambda x: (-x[0], order[x[1]]))
+        return [(other, score) for score, other in best]
+
+    def iter_candidate_pairs(self, top_k: int = 10,
+                             names: Iterable[str] = None) -> Iterator[Tuple[str, str, float]]:
+        """逐张图片查询候选，边查询边产出去重后的候选对，不保存全部候选对
+        Args:
+            top_k: 每张图片保留的候选数
+            names: 只为这些图片生成候选，为 None 时使用全部图片
+        Returns:
+            Iterator[Tuple[str, str, float]]: (参考图, 测试图, 相似度)，参考图为先加入索引的图片，
+            按查询图片的顺序产出
+        """
+        order = self._order
+        # 已查询图片的第 top_k 个候选的排序键，候选不足 top_k 个时为 None；
+        # 召回和相似度都是对称的，对方已查询且本图在其 top_k 内时，这个候选对已经产出过
+        kth = {}
+        for name in (self.names if names is None else names):
+            if name in kth:
+                continue
+            results = self.query(name, top_k)
+            for other, score in results:
+                if other in kth and (kth[other] is None or (-score, order[name]) <= kth[other]):
+                    continue
+                ref, test = (name, other) if order[name] < order[other] else (other, name)
+                yield ref, test, score
+            kth[name] = (-results[-1][1], order[results[-1][0]]) if len(results) >= top_k else None
+
+    def candidate_pairs(self, top_k: int = 10, names: Iterable[str] = None) -> List[Tuple[str, str, float]]:
+        """为每张图片生成 top_k 个候选，合并为去重后的候选对列表
+        Args:
+            top_k: 每张图片保留的候选数
+            names: 只为这些图片生成候选，为 None 时使用全部图片
+        Returns:
+            List[Tuple[str, str, float]]: (参考图, 测试图, 相似度)，参考图为先加入索引的图片
+        """
+        return sorted(
+            self.iter_candidate_pairs(top_k, names),
+            key=lambda x: (self._order[x[0]], self._order[x[1]])
+        )
+
+
+def iter_candidate_pairs(image_infos: Dict, top_k: int = None,
+                         only_images: Iterable[str] = None) -> Iterator[Tuple[str, str]]:
+    """逐个产出交给模型判断的候选图片对 (参考图, 测试图)，不保存全部候选对
+    Args:
+        image_infos: 图片信息字典，可以是 CorpusStore.infos() 返回的视图
+        top_k: 每张图片保留的候选数，为 None 时产出全部两两组合
+        only_images: 只保留至少包含其中一张图片的候选对，为 None 时不限制
+    """
+    image_names = list(image_infos.keys())
+    only = None if only_images is None else set(only_images)
+    if top_k is None:
+        for i in range(len(image_names)):
+            for j in range(i + 1, len(image_names)):
+                if only is None or image_names[i] in only or image_names[j] in only:
+                    yield image_names[i], image_names[j]
+        return
+
+    # 使用本地索引预筛选，模型调用次数随图片数量近似线性增长
+    index = CandidatePairIndex()
+    index.add_all(image_infos)
+    names = None if only is None else (name for name in image_names if name in only)
+    for ref, test, _ in index.iter_candidate_pairs(top_k, names=names):
+        yield ref, test
@@ -0,0 +1,370 @@
+import asyncio
+import hashlib
+import itertools
+import os
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from analyzer import ImageAnalyzer
+from dataset_writer import JsonlWriter
+from journal import RunJournal
+from pair_index import CandidatePairIndex
+from scheduler import PairScheduler
+
+# 各阶段之间队列的结束标记
+_DONE = object()
+
+
+def pair_id(ref_name: str, test_name: str) -> str:
+    """由图片对计算稳定的数据 id，与运行顺序、分片和机器无关"""
+    digest = hashlib.sha1(RunJournal.pair_key(ref_name, test_name).encode('utf-8')).hexdigest()
+    return f"pair_{digest[:16]}"
+
+
+def make_data_item(raw_dir: str, ref_name: str, test_name: str, qa_pair: Dict) -> Dict:
+    """构建 multimodal_data.jsonl 中的一条数据"""
+    return {
+        "id": pair_id(ref_name, test_name),
+        "images": [
+            os.path.join(raw_dir, ref_name),
+            os.path.join(raw_dir, test_name)
+        ],
+        "conversations": [
+            {"from": "human", "value": qa_pair["question"]},
+            {"from": "assistant", "value": qa_pair["answer"]}
+        ]
+    }
+
+
+class GenerationPipeline:
+    """流水线方式执行图片分析、配对判断和问答生成
+
+    三个阶段之间通过有界队列连接：每张图片的描述一生成，就与已分析过的图片
+    在本地索引中检索候选并送去判断，配对成功的问答立即追加写入输出文件。
+    与逐阶段执行相比，第一条数据在分析第一批图片后即可产出，模型服务的负载也更平稳。
+
+    配对阶段按分析完成的顺序处理图片，描述一到就与已加入索引的图片检索候选，个别慢请求
+    不会阻塞其后的图片，也不需要缓存先完成的结果。候选对的参考图和测试图按输入顺序确定，
+    与完成顺序无关，续跑时已判断过的配对照常复用；候选集合取决于完成顺序，与
+    ImageAnalyzer.create_reference_pairs 的双向 top_k 并集略有不同。
+    任一阶段出错时其余阶段立即取消，异常由 run 抛出，不会因队列两端有一方退出而挂起。
+    """
+
+    def __init__(self, analyzer: ImageAnalyzer, image_dir: str, annotations: Dict,
+                 output_file: str, top_k: int = 10, analyze_concurrency: int = 8,
+                 pair_concurrency: int = 8, queue_size: int = 64, show_progress: bool = False,
+                 fused: bool = True, batch_tokens: int = None, max_batch_pairs: int = 32,
+                 describe_batch_size: int = 1, writer=None, scheduler: PairScheduler = None):
+        """
+        Args:
+            analyzer: 图片分析器，其 journal 同时用于断点续跑
+            image_dir: 原始图片目录
+            annotations: 图片标注数据字典
+            output_file: 输出的 JSONL 文件路径，以追加方式写入
+            top_k: 每张新图片交给模型判断的候选数
+            analyze_concurrency: 分析阶段同时进行中的请求数上限
+            pair_concurrency: 配对判断与问答生成阶段同时进行中的配对数上限
+            queue_size: 阶段之间队列的容量，队列满时上游阶段等待
+            show_progress: 是否打印各阶段进度
+            fused: 是否用一次请求同时完成配对判断和问答生成
+            batch_tokens: 批量判断时每个请求提示词的 token 预算，为 None 时逐对判断（仅在 fused 时生效）
+            max_batch_pairs: 批量判断时每个请求最多的候选对数
+            describe_batch_size: 每个场景描述请求包含的图片数，大于 1 时多张图片合并为一次请求
+            writer: 数据写入器（如 DatasetWriter），由调用方负责关闭；为 None 时写入 output_file
+            scheduler: 每张新图片的候选对按优先级排列，达到目标问答数或预算后停止分析新图片、
+                不再发起新的判断；为 None 时处理全部图片和候选对
+        """
+        self.analyzer = analyzer
+        self.journal = analyzer.journal
+        self.image_dir = image_dir
+        self.annotations = annotations or {}
+        self.output_file = output_file
+        self.writer = writer
+        self.scheduler = scheduler
+        self.top_k = top_k
+        self.analyze_concurrency = analyze_concurrency
+        self.pair_concurrency = pair_concurrency
+        self.queue_size = queue_size
+        self.show_progress = show_progress
+        self.fused = fused
+        self.batch_tokens = batch_tokens if fused else None
+        self.max_batch_pairs = max_batch_pairs
+        self.describe_batch_size = max(1, describe_batch_size)
+        # 使用存储时图片信息按需从数据库读取，不在内存中保留全部图片
+        self.store = analyzer.store
+        self.image_infos = self.store.infos(current_run=False) if self.store is not None else {}
+        # 增量模式下作为种子加入索引的图片
+        self._seeded = set()
+        # 已加入索引的图片的输入序号，决定候选对中哪张作为参考图；种子图片为 -1
+        self._seq: Dict[str, int] = {}
+        self.stats = {'analyzed': 0, 'pairs_judged': 0, 'pairs_matched': 0, 'pairs_skipped': 0, 'written': 0}
+        # 调度器的名额在每组请求完成后释放，等待名额的 worker 由此唤醒
+        self._capacity = asyncio.Condition()
+        self._released = 0
+
+    async def run(self, limit: int = None, offset: int = 0, image_files: Iterable[str] = None,
+                  seed_infos: Dict[str, Dict] = None) -> Dict[str, int]:
+        """运行流水线，返回各阶段的计数
+        Args:
+            limit: 最多分析的图片数，为 None 时不限制
+            offset: 跳过的图片数
+            image_files: 指定待分析的文件名序列，为 None 时遍历 image_dir
+            seed_infos: 已分析过的图片信息，只作为新图片的配对候选，彼此之间不再配对（增量模式）；
+                可以是 CorpusStore.infos() 返回的视图
+        """
+        analyzed = asyncio.Queue(maxsize=self.queue_size)
+        pairs = asyncio.Queue(maxsize=self.queue_size)
+        index = CandidatePairIndex()
+        for name, info in (seed_infos or {}).items():
+            if self.store is None:
+                self.image_infos[name] = info
+            self._seeded.add(name)
+            self._seq[name] = -1
+            index.add(name, info)
+
+        pending_files = enumerate(self.analyzer._iter_image_files(
+            self.image_dir, self.annotations, limit, offset, image_files
+        ))
+        mode = 'w' if self.journal is None else 'a'
+        output = self.writer or JsonlWriter(self.output_file, mode)
+        try:
+            tasks = [asyncio.ensure_future(self._analyze_stage(pending_files, analyzed)),
+                     asyncio.ensure_future(self._pair_stage(index, analyzed, pairs))]
+            tasks += [asyncio.ensure_future(self._judge_worker(pairs, output))
+                      for _ in range(self.pair_concurrency)]
+            await self._run_stages(tasks)
+        finally:
+            if output is not self.writer:
+                output.close()
+        return self.stats
+
+    @staticmethod
+    async def _run_stages(tasks: List[asyncio.Future]):
+        """等待全部阶段完成；任一阶段抛出异常时取消其余阶段并抛出该异常"""
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _analyze_stage(self, pending_files, analyzed: asyncio.Queue):
+        """运行全部分析 worker，结束后通知配对阶段"""
+        workers = [asyncio.ensure_future(self._analyze_worker(pending_files, analyzed))
+                   for _ in range(self.analyze_concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        await analyzed.put(_DONE)
+
+    async def _analyze_worker(self, pending_files, analyzed: asyncio.Queue):
+        """分析阶段：从文件流中取出图片生成描述，完成后连同输入序号送入配对阶段"""
+        while True:
+            if self.scheduler is not None and self.scheduler.done:
+                # 已达到目标或预算，剩余图片不再分析
+                break
+            # 每次取出一组图片，取出过程中不让出事件循环，各 worker 之间不会重复
+            group = list(itertools.islice(pending_files, self.describe_batch_size))
+            if not group:
+                break
+            pending = []
+            for seq, image_file in group:
+                if image_file in self._seeded:
+                    # 增量模式下已作为种子加入索引的图片
+                    await analyzed.put((seq, None, None))
+                    continue
+                info = self.analyzer._restore_image_info(image_file)
+                if info is not None:
+                    self.stats['analyzed'] += 1
+                    await analyzed.put((seq, image_file, info))
+                    continue
+                pending.append((seq, image_file))
+            if not pending:
+                continue
+
+            if len(pending) > 1:
+                results = await self.analyzer._describe_images_batch_async(
+                    self.image_dir, [image_file for _, image_file in pending], self.annotations
+                )
+            else:
+                results = [await self._describe_one(pending[0][1])]
+            for (seq, _), (image_file, description, error) in zip(pending, results):
+                if error is not None:
+                    # 单张图片失败不影响整个流水线
+                    self.analyzer.failed_images[image_file] = str(error)
+                    print(f"处理图片 {image_file} 时发生错误: {str(error)}")
+                    await analyzed.put((seq, None, None))
+                    continue
+                info = {'annotation': self.annotations[image_file], 'description': description}
+                self.analyzer._save_image_info(image_file, info)
+                self.stats['analyzed'] += 1
+                await analyzed.put((seq, image_file, info))
+
+    async def _describe_one(self, image_file: str) -> Tuple[str, Optional[str], Optional[Exception]]:
+        """描述单张图片，返回 (图片文件名, 描述, 异常)"""
+        try:
+            description = await self.analyzer._describe_image_async(
+                self.image_dir, image_file, self.annotations[image_file]
+            )
+            return image_file, description, None
+        except Exception as e:
+            return image_file, None, e
+
+    async def _pair_stage(self, index: CandidatePairIndex, analyzed: asyncio.Queue, pairs: asyncio.Queue):
+        """配对阶段：图片描述一完成就加入索引，并立即与已加入的图片检索候选"""
+        while True:
+            item = await analyzed.get()
+            if item is _DONE:
+                break
+            seq, image_file, info = item
+            if image_file is None:
+                continue
+            if self.store is None:
+                self.image_infos[image_file] = info
+            self._seq[image_file] = seq
+            index.add(image_file, info)
+            # 输入顺序靠前的图片作为参考图，与批量模式保持一致
+            candidates = [self._oriented(other, image_file) for other, _ in index.query(image_file, self.top_k)]
+            if self.scheduler is not None:
+                if self.scheduler.done:
+                    # 继续取出分析结果，避免分析阶段阻塞在队列上
+                    self.stats['pairs_skipped'] += len(candidates)
+                    continue
+                candidates = self.scheduler.order(candidates, self.image_infos)
+            for batch in self._batches(candidates):
+                await pairs.put(batch)
+        for _ in range(self.pair_concurrency):
+            await pairs.put(_DONE)
+
+    def _oriented(self, a: str, b: str) -> Tuple[str, str]:
+        """按输入序号排列候选对，返回 (参考图, 测试图)"""
+        return (a, b) if self._seq[a] <= self._seq[b] else (b, a)
+
+    def _batches(self, candidates: List[Tuple[str, str]]) -> List[List[Tuple[str, str]]]:
+        """将一张新图片的候选对分组，逐对判断时每组一个候选对"""
+        if not candidates:
+            return []
+        if not self.batch_tokens:
+            return [[pair] for pair in candidates]
+        return list(self.analyzer.prompts.iter_pair_batches(candidates, self.image_infos,
+                                                             self.batch_tokens, self.max_batch_pairs))
+
+    async def _judge_worker(self, pairs: asyncio.Queue, output):
+        """判断与问答阶段：判断配对并生成问答，成功后立即写入输出文件"""
+        while True:
+            batch = await pairs.get()
+            if batch is _DONE:
+                break
+            while batch:
+                if self.scheduler is not None:
+                    # 超出剩余名额的候选对留到本组请求完成后再判断
+                    admitted, batch = await self._admit(batch)
+                    if not admitted:
+                        continue
+                else:
+                    admitted, batch = batch, []
+                if len(admitted) == 1:
+                    results = [await self._judge_pair(*admitted[0])]
+                else:
+                    results = await self._judge_pair_batch(admitted)
+                for (ref_name, test_name), qa_pair in zip(admitted, results):
+                    if self.scheduler is not None:
+                        self.scheduler.record(ref_name, test_name, qa_pair, self.image_infos)
+                    if qa_pair:
+                        self._write(output, ref_name, test_name, qa_pair)
+                if self.scheduler is not None:
+                    self._released += 1
+                    async with self._capacity:
+                        self._capacity.notify_all()
+                if self.show_progress:
+                    print(f"流水线进度: {self.stats}")
+
+    async def _admit(self, batch: List[Tuple[str, str]]) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+        """按调度器的剩余名额接纳一组候选对，返回 (接纳的候选对, 暂缓的候选对)
+        名额全部被其他 worker 进行中的请求占用时，等其中一组请求有了结果再尝试。
+        """
+        while True:
+            if self.scheduler.done:
+                self.stats['pairs_skipped'] += len(batch)
+                return [], []
+            released = self._released
+            admitted, deferred = self.scheduler.admit_batch(batch, self.image_infos)
+            self.stats['pairs_skipped'] += len(batch) - len(admitted) - len(deferred)
+            if admitted or not deferred:
+                return admitted, deferred
+            if not self.scheduler.in_flight:
+                # 没有进行中的请求可以释放名额
+                self.stats['pairs_skipped'] += len(deferred)
+                return [], []
+            async with self._capacity:
+                await self._capacity.wait_for(lambda: self._released != released)
+            batch = deferred
+
+    async def _judge_pair_batch(self, batch: List[Tuple[str, str]]) -> List[Dict]:
+        """用一次请求判断一组配对，按输入顺序返回问答对（不匹配时为 None）"""
+        results, pending = {}, []
+        for i, (ref_name, test_name) in enumerate(batch):
+            restored = self.analyzer._restore_pair(ref_name, test_name)
+            if restored is not None:
+                results[i] = restored['qa_pair']
+            else:
+                pending.append(i)
+        if pending:
+            verdicts = await self.analyzer._judge_pair_batch_async([batch[i] for i in pending], self.image_infos)
+            for i, (is_match, qa_pair) in zip(pending, verdicts):
+                self.stats['pairs_judged'] += 1
+                if is_match:
+                    self.stats['pairs_matched'] += 1
+                self.analyzer._save_pair(batch[i][0], batch[i][1], is_match, qa_pair)
+                results[i] = qa_pair
+        return [results[i] for i in range(len(batch))]
+
+    async def _judge_pair(self, ref_name: str, test_name: str) -> Dict:
+        """判断单个配对，匹配时返回问答对"""
+        restored = self.analyzer._restore_pair(ref_name, test_name)
+        if restored is not None:
+            # 上次运行已判断过，直接复用
+            return restored['qa_pair']
+
+        ref_info, test_info = self.image_infos[ref_name], self.image_infos[test_name]
+        if self.fused:
+            is_match, qa_pair = await self.analyzer._judge_pair_async(ref_name, test_name, ref_info, test_info)
+        else:
+            is_match = await self.analyzer._check_pair_match_async(ref_name, test_name, ref_info, test_info)
+            qa_pair = None
+            if is_match:
+                qa_pair = await self.analyzer._generate_qa_pair_async(ref_name, test_name, ref_info, test_info)
+        self.stats['pairs_judged'] += 1
+        if is_match:
+            self.stats['pairs_matched'] += 1
+        self.analyzer._save_pair(ref_name, test_name, is_match, qa_pair)
+        return qa_pair
+
+    def _write(self, output, ref_name: str, test_name: str, qa_pair: Dict):
+        """将问答写入输出文件并记入日志，已写入过的配对跳过"""
+        key = RunJournal.pair_key(ref_name, test_name)
+        if self.store is not None:
+            if self.store.is_written(ref_name, test_name):
+                return
+        elif self.journal is not None and self.journal.has(RunJournal.QA, key):
+            return
+        try:
+            data_item = make_data_item(self.image_dir, ref_name, test_name, qa_pair)
+        except (KeyError, TypeError) as e:
+            self.analyzer.client.metrics.count('multimodal_qa_parse_failed')
+            print(f"解析问答对失败: {str(e)}")
+            return
+        # 数据落盘后才记入日志，中断时最多重复写入尚未记录的几条
+        on_flushed = None
+        if self.store is not None:
+            # 使用存储时已写入的配对记在数据库中，不把日志整体载入内存
+            on_flushed = partial(self.store.mark_written, ref_name, test_name, data_item['id'])
+        elif self.journal is not None:
+            on_flushed = partial(self.journal.record, RunJournal.QA, key, {'id': data_item['id']})
+        output.write(data_item, on_flushed)
+        self.stats['written'] += 1
@@ -0,0 +1,409 @@
+import json
+import math
+import os
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from ingest import iter_image_files, limit_items
+from journal import RunJournal
+from pair_index import CandidatePairIndex, iter_candidate_pairs
+from prompts import CJK_TOKENS_PER_CHAR, PromptBuilder, estimate_tokens
+from scheduler import PairScheduler
+from store import CorpusStore
+
+# 没有历史运行报告时假设的单次请求平均延迟（秒）
+DEFAULT_LATENCY = 2.0
+
+
+def latencies_from_report(path: str) -> Dict[str, float]:
+    """从之前运行的 run_report.json 读取各阶段的平均请求延迟，文件不存在时返回空字典"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            stages = json.load(f).get('stages', {})
+    except (OSError, ValueError):
+        return {}
+    # 延迟只统计实际发送的请求，全部来自缓存的阶段没有延迟数据，不采用
+    return {stage: info['latency']['mean'] for stage, info in stages.items()
+            if info.get('calls', 0) > info.get('cache_hits', 0) and info['latency']['mean'] > 0}
+
+
+class _PlannedUsage:
+    """规划时模拟的配对阶段消耗，代替 MetricsRecorder 供 PairScheduler 判断预算"""
+
+    def __init__(self):
+        self.calls = 0
+        self.tokens = 0
+
+    def add(self, calls: int, tokens: int):
+        self.calls += calls
+        self.tokens += tokens
+
+    def usage(self, stages: Sequence[str]) -> Dict[str, int]:
+        return {'calls': self.calls, 'tokens': self.tokens}
+
+
+class RunPlanner:
+    """不调用模型，根据标注数据和图片目录估计一次运行的请求数、token 数和耗时
+
+    候选对用与正式运行相同的本地索引生成，提示词用同一个 PromptBuilder 构建后计算 token 数，
+    批量判断的打包也与正式运行相同。设置目标问答数、预算或每张图片、每个场景的上限时，
+    用同样的 PairScheduler 按期望配对率模拟判断过程，估计实际会判断的候选对。尚未生成的
+    场景描述用固定长度的占位文本代替，图片 token 数、回复长度和配对率按给定的假设估计。
+    候选对很多时只抽样构建部分提示词，按平均值推算总量。
+    """
+
+    def __init__(self, prompts: PromptBuilder = None, image_tokens: int = 1024,
+                 description_tokens: int = 150, qa_tokens: int = 120, verdict_tokens: int = 10,
+                 match_rate: float = 0.5, sample_size: int = 2000):
+        """
+        Args:
+            prompts: 与正式运行配置相同的提示词构建器（如相同的 token 预算）
+            image_tokens: 每张图片的 token 数
+            description_tokens: 每张图片场景描述的 token 数，也是描述请求的回复长度
+            qa_tokens: 一个问答对的回复 token 数
+            verdict_tokens: 不配对结论的回复 token 数
+            match_rate: 候选对判断为配对的比例
+            sample_size: 估计配对阶段提示词 token 数时最多构建的提示词数
+        """
+        self.prompts = prompts or PromptBuilder()
+        self.image_tokens = image_tokens
+        self.description_tokens = description_tokens
+        self.qa_tokens = qa_tokens
+        self.verdict_tokens = verdict_tokens
+        self.match_rate = match_rate
+        self.sample_size = sample_size
+
+    def _sum_tokens(self, items: Sequence, prompt: Callable) -> int:
+        """items 中每项构建的提示词 token 数之和，超过 sample_size 时均匀抽样推算"""
+        if not items:
+            return 0
+        if len(items) <= self.sample_size:
+            return sum(estimate_tokens(prompt(item)) for item in items)
+        step = len(items) / self.sample_size
+        sampled = [items[int(i * step)] for i in range(self.sample_size)]
+        return round(sum(estimate_tokens(prompt(item)) for item in sampled) * len(items) / len(sampled))
+
+    def plan(self, image_dir: str, annotations: Dict, limit: int = None, offset: int = 0,
+             top_k: int = 10, fused: bool = True, pipeline: bool = False, batch_tokens: int = None,
+             max_batch_pairs: int = 32, describe_batch_size: int = 1, target_pairs: int = None,
+             token_budget: int = None, call_budget: int = None, max_per_image: int = None,
+             max_per_scene: int = None, incremental: bool = False, journal: RunJournal = None, store: CorpusStore = None,
+             concurrency: int = 16, rate: float = None, latencies: Dict[str, float] = None,
+             default_latency: float = DEFAULT_LATENCY) -> Dict:
+        """估计一次运行的请求数、token 数和耗时，参数与 main 的命令行参数一一对应
+        Args:
+            image_dir: 原始图片目录
+            annotations: 图片标注数据字典（已去掉近似重复的图片）
+            limit: 最多分析的图片数
+            offset: 跳过的图片数
+            top_k: 每张图片交给模型判断的候选数
+            fused: 是否用一次请求同时完成配对判断和问答生成
+            pipeline: 是否为流水线模式
+            batch_tokens: 批量判断时每个请求提示词的 token 预算
+            max_batch_pairs: 批量判断时每个请求最多的候选对数
+            describe_batch_size: 每个场景描述请求包含的图片数
+            target_pairs: 目标问答数，达到后不再判断剩余候选对
+            token_budget: 配对阶段的 token 预算
+            call_budget: 配对阶段的请求数预算
+            max_per_image: 每张图片最多参与的问答数
+            max_per_scene: 每个场景最多的问答数
+            incremental: 是否为增量运行
+            journal: 断点续跑日志，已完成的工作不计入
+            store: 状态存储，提供时代替日志判断已完成的图片分析和配对判断
+            concurrency: 同时进行中的请求数上限
+            rate: 每秒最多发送的请求数
+            latencies: 各阶段单次请求的平均延迟（秒），如 latencies_from_report 的返回值
+            default_latency: latencies 中缺少的阶段使用的延迟（秒）
+        """
+        def restored_info(name: str) -> Optional[Dict]:
+            if store is not None:
+                return store.get_image(name)
+            return journal.get(RunJournal.ANALYZE, name) if journal is not None else None
+
+        def restored_pair(ref_name: str, test_name: str) -> Optional[Dict]:
+            if store is not None:
+                return store.get_pair(ref_name, test_name)
+            if journal is None:
+                return None
+            return journal.get(RunJournal.PAIR, RunJournal.pair_key(ref_name, test_name))
+
+        images = list(limit_items((f for f in iter_image_files(image_dir) if f in annotations), limit, offset))
+        # 占位描述的估计 token 数与假设的描述长度一致
+        placeholder = '描' * math.ceil(self.description_tokens / CJK_TOKENS_PER_CHAR)
+        infos: Dict[str, Dict] = OrderedDict()
+        to_describe = []
+        for name in images:
+            info = restored_info(name)
+            if info is None:
+                to_describe.append(name)
+                info = {'annotation': annotations[name], 'description': placeholder}
+            infos[name] = info
+
+        # 增量模式下历次运行分析过的图片只作为新图片的候选
+        seeds: Dict[str, Dict] = OrderedDict()
+        if incremental:
+            previous = (store.infos(current_run=False).items() if store is not None
+                        else (journal.records(RunJournal.ANALYZE).items() if journal is not None else []))
+            seeds.update(previous)
+        new_images = [name for name in images if name not in seeds] if incremental else None
+
+        stages = OrderedDict()
+
+        # 场景描述
+        groups = [to_describe[i:i + describe_batch_size] for i in range(0, len(to_describe), describe_batch_size)]
+        single = [group for group in groups if len(group) == 1]
+        batched = [group for group in groups if len(group) > 1]
+        if single:
+            stages['scene_description'] = {
+                'calls': len(single),
+                'prompt_tokens': sum(estimate_tokens(self.prompts.scene_description(annotations[g[0]].get('objects', [])))
+                                     for g in single) + len(single) * self.image_tokens,
+                'completion_tokens': len(single) * self.description_tokens,
+            }
+        if batched:
+            prompt_tokens = 0
+            for group in batched:
+                header, labels = self.prompts.scene_description_batch(
+                    [annotations[name].get('objects', []) for name in group])
+                prompt_tokens += estimate_tokens(header + ''.join(labels)) + len(group) * self.image_tokens
+            stages['scene_description_batch'] = {
+                'calls': len(batched),
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': sum(len(group) for group in batched) * self.description_tokens,
+            }
+
+        # 候选对
+        all_infos = OrderedDict(seeds)
+        all_infos.update(infos)
+        if pipeline:
+            # 流水线模式下每张新图片加入索引时与已有图片生成候选，各自排序和打包
+            index = CandidatePairIndex()
+            for name, info in seeds.items():
+                index.add(name, info)
+            groups = []
+            for name in images:
+                if name in seeds:
+                    continue
+                index.add(name, infos[name])
+                groups.append([(other, name) for other, _ in index.query(name, top_k)])
+        else:
+            groups = [list(iter_candidate_pairs(all_infos, top_k, new_images))]
+        candidates = sum(len(group) for group in groups)
+
+        scheduler = usage = None
+        if any(v is not None for v in (target_pairs, token_budget, call_budget, max_per_image, max_per_scene)):
+            usage = _PlannedUsage()
+            scheduler = PairScheduler(target_pairs=target_pairs, token_budget=token_budget,
+                                      call_budget=call_budget, max_per_image=max_per_image,
+                                      max_per_scene=max_per_scene, metrics=usage)
+        batching = bool(fused and batch_tokens)
+        # 按期望配对率累计，每满 1 记一个配对成功的问答
+        credit = [0.0]
+
+        def outcome() -> Optional[Dict]:
+            credit[0] += self.match_rate
+            if credit[0] >= 1:
+                credit[0] -= 1
+                return {'question': '', 'answer': ''}
+            return None
+
+        def pair_cost(pair: Tuple[str, str], qa_pair: Optional[Dict]) -> Tuple[int, int]:
+            """逐对判断一个候选对的请求数和 token 数，只在设置 token 预算时构建提示词"""
+            ref_name, test_name = pair
+            calls = 1 if fused or not qa_pair else 2
+            if token_budget is None:
+                return calls, 0
+            ref_info, test_info = all_infos[ref_name], all_infos[test_name]
+            if fused:
+                tokens = estimate_tokens(self.prompts.pair_judge(ref_name, ref_info, test_name, test_info))
+                return calls, tokens + (self.qa_tokens if qa_pair else self.verdict_tokens)
+            tokens = estimate_tokens(self.prompts.pair_match(ref_name, ref_info, test_name, test_info)) + 1
+            if qa_pair:
+                tokens += estimate_tokens(self.prompts.qa_pair(ref_name, ref_info, test_name, test_info)) \
+                    + self.qa_tokens
+            return calls, tokens
+
+        counts = {'judged_before': 0, 'matched_before': 0, 'skipped': 0}
+
+        def pending(group: List[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+            """与 create_reference_pairs 相同地逐个产出需要请求模型的候选对，已判断过的直接复用"""
+            if scheduler is not None:
+                group = scheduler.order(group, all_infos)
+            for ref_name, test_name in group:
+                if scheduler is not None and (scheduler.done or not scheduler.admit(ref_name, test_name, all_infos)):
+                    counts['skipped'] += 1
+                    continue
+                restored = restored_pair(ref_name, test_name)
+                if restored is not None:
+                    counts['judged_before'] += 1
+                    counts['matched_before'] += 1 if restored.get('qa_pair') else 0
+                    if scheduler is not None:
+                        scheduler.record(ref_name, test_name, restored.get('qa_pair'), all_infos)
+                    continue
+                if batching and scheduler is not None:
+                    scheduler.release(ref_name, test_name)
+                yield ref_name, test_name
+
+        single_pairs: List[Tuple[str, str]] = []
+        batches: List[List[Tuple[str, str]]] = []
+        for group in groups:
+            if batching:
+                judged, dropped = self._schedule_batches(pending(group), all_infos, batch_tokens, max_batch_pairs,
+                                                         scheduler, usage, outcome, token_budget is not None)
+                batches.extend(judged)
+                counts['skipped'] += dropped
+                continue
+            for pair in pending(group):
+                single_pairs.append(pair)
+                if scheduler is not None:
+                    qa_pair = outcome()
+                    usage.add(*pair_cost(pair, qa_pair))
+                    scheduler.record(*pair, qa_pair, all_infos)
+        judged_before, matched_before, skipped = counts['judged_before'], counts['matched_before'], counts['skipped']
+
+        # 配对判断与问答生成
+        judged_pairs = len(single_pairs) + sum(len(batch) for batch in batches)
+        matched = self.match_rate * judged_pairs
+        if batching:
+            single_pairs = [batch[0] for batch in batches if len(batch) == 1]
+            multi = [batch for batch in batches if len(batch) > 1]
+            if multi:
+                stages['pair_judge_batch'] = {
+                    'calls': len(multi),
+                    'prompt_tokens': self._sum_tokens(multi, lambda b: self.prompts.pair_judge_batch(b, all_infos)),
+                    'completion_tokens': round(sum(len(b) for b in multi) * self._verdict_tokens()),
+                }
+        if single_pairs:
+            if fused:
+                stages['pair_judge'] = {
+                    'calls': len(single_pairs),
+                    'prompt_tokens': self._sum_tokens(single_pairs, lambda p: self.prompts.pair_judge(
+                        p[0], all_infos[p[0]], p[1], all_infos[p[1]])),
+                    'completion_tokens': round(len(single_pairs) * self._verdict_tokens()),
+                }
+            else:
+                stages['pair_match'] = {
+                    'calls': len(single_pairs),
+                    'prompt_tokens': self._sum_tokens(single_pairs, lambda p: self.prompts.pair_match(
+                        p[0], all_infos[p[0]], p[1], all_infos[p[1]])),
+                    'completion_tokens': len(single_pairs),
+                }
+                qa_calls = round(len(single_pairs) * self.match_rate)
+                qa_prompt = self._sum_tokens(single_pairs, lambda p: self.prompts.qa_pair(
+                    p[0], all_infos[p[0]], p[1], all_infos[p[1]]))
+                stages['qa_pair'] = {
+                    'calls': qa_calls,
+                    'prompt_tokens': round(qa_prompt * self.match_rate),
+                    'completion_tokens': qa_calls * self.qa_tokens,
+                }
+
+        # 耗时：逐阶段模式下图片分析并发进行、配对判断逐个进行；流水线模式下全部请求共用并发上限
+        latencies = latencies or {}
+        for stage, info in stages.items():
+            info['latency'] = latencies.get(stage, default_latency)
+            parallel = concurrency if pipeline or stage.startswith('scene_description') else 1
+            seconds = info['calls'] * info['latency'] / parallel
+            if rate:
+                seconds = max(seconds, info['calls'] / rate)
+            info['seconds'] = seconds
+        if pipeline:
+            busy = sum(info['calls'] * info['latency'] for info in stages.values()) / concurrency
+            total_calls = sum(info['calls'] for info in stages.values())
+            projected = max(busy, total_calls / rate) if rate else busy
+        else:
+            projected = sum(info['seconds'] for info in stages.values())
+
+        return {
+            'images': {
+                'planned': len(images),
+                'already_analyzed': len(images) - len(to_describe),
+                'to_describe': len(to_describe),
+                'seed_images': len(seeds),
+            },
+            'pairs': {
+                'candidates': candidates,
+                'already_judged': judged_before,
+                'to_judge': judged_pairs,
+                'skipped': skipped,
+            },
+            'stages': stages,
+            'totals': {
+                'calls': sum(info['calls'] for info in stages.values()),
+                'prompt_tokens': sum(info['prompt_tokens'] for info in stages.values()),
+                'completion_tokens': sum(info['completion_tokens'] for info in stages.values()),
+            },
+            'expected_qa_pairs': scheduler.produced if scheduler is not None else matched_before + round(matched),
+            'projected_seconds': projected,
+            'assumptions': {
+                'image_tokens': self.image_tokens,
+                'description_tokens': self.description_tokens,
+                'qa_tokens': self.qa_tokens,
+                'match_rate': self.match_rate,
+                'concurrency': concurrency,
+                'rate': rate,
+                'mode': 'pipeline' if pipeline else 'staged',
+            },
+        }
+
+    def _schedule_batches(self, pairs: Iterable[Tuple[str, str]], image_infos: Dict, batch_tokens: int,
+                          max_batch_pairs: int, scheduler: Optional[PairScheduler], usage: Optional[_PlannedUsage],
+                          outcome: Callable[[], Optional[Dict]],
+                          count_tokens: bool) -> Tuple[List[List[Tuple[str, str]]], int]:
+        """与 create_reference_pairs 相同地用 PairScheduler.iter_admitted_batches 打包批量判断请求，并模拟结果
+        Returns:
+            (会发送的批次, 被调度器跳过的候选对数)
+        """
+        def pack(group: Iterable[Tuple[str, str]]) -> Iterator[List[Tuple[str, str]]]:
+            return self.prompts.iter_pair_batches(group, image_infos, batch_tokens, max_batch_pairs)
+
+        if scheduler is None:
+            return list(pack(pairs)), 0
+        batches, skipped = [], [0]
+
+        def skip(n: int):
+            skipped[0] += n
+
+        for admitted in scheduler.iter_admitted_batches(pairs, image_infos, pack, skip):
+            batches.append(admitted)
+            results = [outcome() for _ in admitted]
+            tokens = 0
+            if count_tokens:
+                tokens = estimate_tokens(self.prompts.pair_judge_batch(admitted, image_infos)) + sum(
+                    self.qa_tokens if qa_pair else self.verdict_tokens for qa_pair in results)
+            usage.add(1, tokens)
+            for (ref_name, test_name), qa_pair in zip(admitted, results):
+                scheduler.record(ref_name, test_name, qa_pair, image_infos)
+        return batches, skipped[0]
+
+    def _verdict_tokens(self) -> float:
+        """每个候选对结论的平均回复 token 数"""
+        return self.match_rate * self.qa_tokens + (1 - self.match_rate) * self.verdict_tokens
+
+
+def _format_seconds(seconds: float) -> str:
+    hours, rest = divmod(int(round(seconds)), 3600)
+    minutes, secs = divmod(rest, 60)
+    return f"{hours}h{minutes:02d}m{secs:02d}s"
+
+
+def format_plan(plan: Dict) -> str:
+    """将 RunPlanner.plan 的结果格式化为便于阅读的文本"""
+    images, pairs = plan['images'], plan['pairs']
+    lines = [
+        f"图片: 计划 {images['planned']} 张，已分析 {images['already_analyzed']} 张，"
+        f"待描述 {images['to_describe']} 张" + (f"，增量种子 {images['seed_images']} 张" if images['seed_images'] else ''),
+        f"候选对: {pairs['candidates']} 个，已判断 {pairs['already_judged']} 个，待判断 {pairs['to_judge']} 个"
+        + (f"，按调度限制跳过 {pairs['skipped']} 个" if pairs['skipped'] else ''),
+        "各阶段（请求数 / 提示词 token / 生成 token / 单次延迟 / 预计耗时）:",
+    ]
+    for stage, info in plan['stages'].items():
+        lines.append(f"  {stage:<24} {info['calls']:>9} {info['prompt_tokens']:>13} {info['completion_tokens']:>11}"
+                     f"  {info['latency']:>6.2f}s  {_format_seconds(info['seconds'])}")
+    totals = plan['totals']
+    lines.append(f"合计: {totals['calls']} 次请求，提示词 {totals['prompt_tokens']} token，"
+                 f"生成 {totals['completion_tokens']} token")
+    lines.append(f"预计问答数: {plan['expected_qa_pairs']}，预计耗时: {_format_seconds(plan['projected_seconds'])}"
+                 f"（{plan['assumptions']['mode']} 模式）")
+    return '\n'.join(lines)
@@ -0,0 +1,328 @@
+import json
+import math
+import re
+import string
+import textwrap
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# 配对相关阶段交给模型的图片字段，image_path 等本地字段不进入提示词
+PAIR_FIELDS = ('objects', 'scene', 'anomaly', 'description')
+
+
+# 估计 token 数时每个字符折算的 token 数：中日韩文字和全角标点与其余字符（英文、数字、JSON 符号）分开计算，
+# 取 Qwen 系列分词器在中文提示词和紧凑 JSON 上的大致比例，略偏保守
+CJK_TOKENS_PER_CHAR = 0.75
+OTHER_TOKENS_PER_CHAR = 0.35
+_CJK = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """估计文本的 token 数，中文字符与其余字符按不同比例折算"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return math.ceil(cjk * CJK_TOKENS_PER_CHAR + (len(text) - cjk) * OTHER_TOKENS_PER_CHAR)
+
+
+def compact_description(description: str):
+    """将模型返回的场景描述整理为紧凑形式
+    描述是 JSON 时返回解析后的对象，嵌入提示词时不必转义引号；否则返回合并空白后的文本。
+    """
+    text = description.strip()
+    if text.startswith('```'):
+        # 去掉 markdown 代码块标记
+        text = text.strip('`').strip()
+        if text.startswith('json'):
+            text = text[4:]
+    try:
+        return json.loads(text)
+    except (json.JSONDecodeError, ValueError):
+        return re.sub(r'\s+', ' ', text).strip()
+
+
+def _freeze(value):
+    """将字段值转为可比较的不可变形式"""
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class PromptTemplate:
+    """预先编译的提示词模板
+
+    构造时去掉源码中的缩进、检查占位符，并统计固定文本的 token 数，
+    渲染时只需填入字段值。
+    """
+
+    def __init__(self, text: str):
+        self.text = textwrap.dedent(text).strip()
+        self.fields = tuple(name for _, name, _, _ in string.Formatter().parse(self.text) if name)
+        # 占位符以外的固定文本的 token 数，用于批量打包时估计请求大小
+        self.base_tokens = estimate_tokens(self.text.format(**{name: '' for name in self.fields}))
+
+    def render(self, **values) -> str:
+        return self.text.format(**values)
+
+
+SCENE_DESCRIPTION = PromptTemplate("""
+    对以下标注物体描述其颜色、外观和行为，并以JSON格式返回：
+    物体列表：{objects}
+    返回格式示例：
+    {{"塔吊": "黄色高大塔吊，正在进行钢构件吊装", "安全网": "绿色密织安全网，完整覆盖外立面"}}
+    要求：
+    1. 使用简洁的专业用语描述外观和行为
+    2. 只返回JSON格式数据
+    """)
+
+SCENE_DESCRIPTION_BATCH = PromptTemplate("""
+    以下共有 {count} 张工地图片，请按图片编号分别描述每张图片中标注物体的颜色、外观和行为。
+    返回格式示例（只返回JSON，每张图片一项，键为图片编号）：
+    {{"I1": {{"塔吊": "黄色高大塔吊，正在进行钢构件吊装"}}, "I2": {{"脚手架": "银灰色金属脚手架，已完成搭设并固定"}}}}
+    要求：
+    1. 使用简洁的专业用语描述外观和行为
+    2. 每张图片只描述其物体列表中的物体
+    3. 只返回JSON格式数据
+    """)
+
+PAIR_MATCH = PromptTemplate("""
+    请分析这两张图片是否适合作为参照图对进行配对：
+    参考图信息：{ref}
+    测试图信息：{test}
+    配对原则：
+    1. 两张图片应该包含相似的主要物体或场景
+    2. 两张图片之间应该存在有意义的对比点
+    3. 两张图片的内容应该具有关联性
+    请直接返回 "是" 或 "否"，表示是否适合配对。
+    """)
+
+QA_PAIR = PromptTemplate("""
+    基于以下两张工地场景图片的分析信息，生成一个专业的问答对：
+    参考图信息：{ref}
+    测试图信息：{test}
+    要求：
+    1. 问题应该从参考图的场景出发，询问测试图的相关情况
+    2. 回答应该详细对比两张图片中物体的异同
+    3. 回答要突出重点，使用专业的描述方式
+    以JSON格式返回：{{"question": "您的问题", "answer": "您的回答"}}
+    """)
+
+PAIR_JUDGE = PromptTemplate("""
+    请判断以下两张工地场景图片是否适合作为参照图对，适合时同时生成一个专业的问答对：
+    参考图信息：{ref}
+    测试图信息：{test}
+    配对原则：
+    1. 两张图片应该包含相似的主要物体或场景
+    2. 两张图片之间应该存在有意义的对比点
+    3. 两张图片的内容应该具有关联性
+    问答要求（仅在适合配对时生成）：
+    1. 问题应该从参考图的场景出发，询问测试图的相关情况
+    2. 回答应该详细对比两张图片中物体的异同
+    3. 回答要突出重点，使用专业的描述方式
+    只返回JSON：{{"match": true, "question": "您的问题", "answer": "您的回答"}}
+    不适合配对时返回 {{"match": false}}。
+    """)
+
+PAIR_JUDGE_BATCH = PromptTemplate("""
+    请逐一判断以下候选图片对是否适合作为参照图对，适合时同时生成一个专业的问答对。
+    图片信息（按编号引用）：
+    {images}
+    候选图片对：
+    {pairs}
+    配对原则：
+    1. 两张图片应该包含相似的主要物体或场景
+    2. 两张图片之间应该存在有意义的对比点
+    3. 两张图片的内容应该具有关联性
+    问答要求（仅在适合配对时生成）：
+    1. 问题应该从参考图的场景出发，询问测试图的相关情况
+    2. 回答应该详细对比两张图片中物体的异同
+    3. 回答要突出重点，使用专业的描述方式
+    只返回JSON数组，每个候选图片对一项，用候选对编号标识：
+    [{{"id": "P1", "match": true, "question": "您的问题", "answer": "您的回答"}}, {{"id": "P2", "match": false}}]
+    """)
+
+# 批量判断中每个候选对的编号行（如 "P12: 参考图 I3，测试图 I7"）的估计 token 数，按较长的编号计
+PAIR_LINE_TOKENS = estimate_tokens("P9999: 参考图 I9999，测试图 I9999\n")
+
+
+class PromptBuilder:
+    """按阶段构建紧凑的提示词，并统计和限制每个请求的 token 数
+
+    配对相关阶段只放入 PAIR_FIELDS 中的字段，用无缩进的紧凑 JSON 序列化，场景描述
+    解析后内嵌为对象。每张图片的序列化片段按文件名缓存，并记录生成片段时的字段内容，
+    同一张图片出现在多个候选对中时只序列化一次，信息从存储中重新读出（内容相同的新对象）
+    也能命中。设置 token_budget 后，超出预算的提示词会按比例截短其中的场景描述。
+    """
+
+    def __init__(self, token_budget: int = None, metrics=None, cache_size: int = 50000,
+                 fields: Sequence[str] = PAIR_FIELDS):
+        """
+        Args:
+            token_budget: 单个请求提示词的 token 上限，为 None 时不限制
+            metrics: MetricsRecorder，记录各阶段提示词的估计 token 数和截短次数
+            cache_size: 缓存的图片片段数上限，超出时淘汰最久未使用的
+            fields: 配对阶段放入提示词的图片字段
+        """
+        self.token_budget = token_budget
+        self.metrics = metrics
+        self.cache_size = cache_size
+        self.fields = tuple(fields)
+        # 文件名 -> (字段内容, 片段)
+        self._fragments: 'OrderedDict[str, Tuple[tuple, str]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = Counter()
+
+    def _payload(self, info: Dict) -> Dict:
+        annotation = info.get('annotation') or {}
+        payload = {}
+        for field in self.fields:
+            value = info.get(field, annotation.get(field))
+            if field == 'description' and isinstance(value, str):
+                value = compact_description(value)
+            if value not in (None, '', [], {}):
+                payload[field] = value
+        return payload
+
+    def _content_key(self, info: Dict) -> tuple:
+        """片段依赖的原始字段内容，用于判断缓存的片段是否仍然有效"""
+        annotation = info.get('annotation') or {}
+        return tuple(_freeze(info.get(field, annotation.get(field))) for field in self.fields)
+
+    def image_fragment(self, name: str, info: Dict) -> str:
+        """返回一张图片的紧凑序列化片段，按文件名缓存；同名图片的字段内容变化时重新序列化"""
+        key = self._content_key(info)
+        with self._lock:
+            cached = self._fragments.get(name)
+            if cached is not None and cached[0] == key:
+                self._fragments.move_to_end(name)
+                return cached[1]
+        fragment = json.dumps(self._payload(info), ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._fragments[name] = (key, fragment)
+            self._fragments.move_to_end(name)
+            while len(self._fragments) > self.cache_size:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def fragment_tokens(self, name: str, info: Dict) -> int:
+        return estimate_tokens(self.image_fragment(name, info))
+
+    def _truncated_fragment(self, info: Dict, cut: int) -> Tuple[str, bool]:
+        """场景描述截去 cut 个字符后的片段，描述以文本形式放入；返回 (片段, 描述是否已截空)"""
+        payload = self._payload(info)
+        description = payload.get('description')
+        if description is None:
+            return json.dumps(payload, ensure_ascii=False, separators=(',', ':')), True
+        if not isinstance(description, str):
+            description = json.dumps(description, ensure_ascii=False, separators=(',', ':'))
+        payload['description'] = description[:max(len(description) - cut, 0)]
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':')), cut >= len(description)
+
+    def _finish(self, stage: str, prompt: str) -> str:
+        tokens = estimate_tokens(prompt)
+        self._count(f'{stage}_prompts')
+        self._count(f'{stage}_prompt_tokens', tokens)
+        if self.token_budget is not None and tokens > self.token_budget:
+            # 截短后仍超出预算（如物体列表本身过长）时照常发送，只做记录
+            self._count(f'{stage}_prompts_over_budget')
+        return prompt
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+        if self.metrics is not None:
+            self.metrics.count(name, n)
+
+    def _pair_prompt(self, stage: str, template: PromptTemplate, ref_name: str, ref_info: Dict,
+                     test_name: str, test_info: Dict) -> str:
+        ref = self.image_fragment(ref_name, ref_info)
+        test = self.image_fragment(test_name, test_info)
+        prompt = template.render(ref=ref, test=test)
+        excess = estimate_tokens(prompt) - self.token_budget if self.token_budget is not None else 0
+        if excess > 0:
+            self._count(f'{stage}_prompts_truncated')
+        cut = 0
+        while excess > 0:
+            # 两张图片的描述各截去一半超出量，描述转为文本后引号需要转义，可能需要多截几次
+            cut += (excess + 1) // 2
+            (ref, ref_empty), (test, test_empty) = (self._truncated_fragment(ref_info, cut),
+                                                    self._truncated_fragment(test_info, cut))
+            prompt = template.render(ref=ref, test=test)
+            excess = estimate_tokens(prompt) - self.token_budget
+            if ref_empty and test_empty:
+                break
+        return self._finish(stage, prompt)
+
+    def scene_description(self, objects: List[str]) -> str:
+        return self._finish('scene_description', SCENE_DESCRIPTION.render(objects='、'.join(objects)))
+
+    def scene_description_batch(self, objects_list: List[List[str]]) -> Tuple[str, List[str]]:
+        """返回多图描述请求的说明文本和每张图片前的编号文本"""
+        header = SCENE_DESCRIPTION_BATCH.render(count=len(objects_list))
+        labels = [f"图片 I{i}，物体列表：{'、'.join(objects)}" for i, objects in enumerate(objects_list, 1)]
+        self._finish('scene_description_batch', header + ''.join(labels))
+        return header, labels
+
+    def pair_match(self, ref_name: str, ref_info: Dict, test_name: str, test_info: Dict) -> str:
+        return self._pair_prompt('pair_match', PAIR_MATCH, ref_name, ref_info, test_name, test_info)
+
+    def qa_pair(self, ref_name: str, ref_info: Dict, test_name: str, test_info: Dict) -> str:
+        return self._pair_prompt('qa_pair', QA_PAIR, ref_name, ref_info, test_name, test_info)
+
+    def pair_judge(self, ref_name: str, ref_info: Dict, test_name: str, test_info: Dict) -> str:
+        return self._pair_prompt('pair_judge', PAIR_JUDGE, ref_name, ref_info, test_name, test_info)
+
+    def pair_judge_batch(self, batch: List[Tuple[str, str]], image_infos: Dict) -> str:
+        """批量判断的提示词，图片和候选对都用编号引用，每张图片的信息只出现一次"""
+        image_ids = {}
+        for pair in batch:
+            for name in pair:
+                if name not in image_ids:
+                    image_ids[name] = f"I{len(image_ids) + 1}"
+        images = "\n".join(
+            f"{image_id}: {self.image_fragment(name, image_infos[name])}"
+            for name, image_id in image_ids.items()
+        )
+        pairs = "\n".join(
+            f"P{i + 1}: 参考图 {image_ids[ref_name]}，测试图 {image_ids[test_name]}"
+            for i, (ref_name, test_name) in enumerate(batch)
+        )
+        return self._finish('pair_judge_batch', PAIR_JUDGE_BATCH.render(images=images, pairs=pairs))
+
+    def iter_pair_batches(self, pairs: Iterable[Tuple[str, str]], image_infos: Dict,
+                          batch_tokens: int, max_batch_pairs: int = 32) -> Iterator[List[Tuple[str, str]]]:
+        """按批量判断提示词的 token 预算将候选对依次装入批次，每装满一批就产出，同一批次内的图片信息只出现一次
+        Args:
+            pairs: 候选对，可以是生成器
+            image_infos: 图片信息字典
+            batch_tokens: 每个批次提示词的 token 预算
+            max_batch_pairs: 每个批次最多的候选对数，限制单次回复的长度
+        """
+        batch, images = [], set()
+        tokens = PAIR_JUDGE_BATCH.base_tokens
+        for ref_name, test_name in pairs:
+            added = PAIR_LINE_TOKENS + sum(
+                self.fragment_tokens(name, image_infos[name])
+                for name in {ref_name, test_name} if name not in images
+            )
+            if batch and (tokens + added > batch_tokens or len(batch) >= max_batch_pairs):
+                yield batch
+                batch, images = [], set()
+                tokens = PAIR_JUDGE_BATCH.base_tokens
+                added = PAIR_LINE_TOKENS + sum(
+                    self.fragment_tokens(name, image_infos[name])
+                    for name in {ref_name, test_name}
+                )
+            batch.append((ref_name, test_name))
+            images.update((ref_name, test_name))
+            tokens += added
+        if batch:
+            yield batch
+
+    def stats(self) -> Dict:
+        """各阶段的提示词数、估计 token 总数和截短次数"""
+        with self._lock:
+            return dict(self.counters)
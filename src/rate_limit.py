@@ -0,0 +1,407 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar, Union
+
+T = TypeVar('T')
+
+# 视为服务端过载或暂时不可用、可以重试的 HTTP 状态码
+RETRYABLE_STATUS = (408, 409, 429, 500, 502, 503, 504)
+# 视为超时或连接失败、可以重试的异常类名（openai 的异常类型不在此模块中导入）
+RETRYABLE_ERRORS = ('APITimeoutError', 'APIConnectionError', 'Timeout', 'ConnectTimeout', 'ReadTimeout')
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求未发送直接失败"""
+
+
+def is_retryable(error: Exception) -> bool:
+    """判断异常是否为限流、超时或服务端错误等可重试的失败"""
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+def is_overload(error: Exception) -> bool:
+    """判断异常是否表示服务端过载（限流或超时），用于自适应并发的乘性减小"""
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in (408, 429, 503, 504)
+    return isinstance(error, TimeoutError) or 'Timeout' in type(error).__name__
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """从异常携带的响应头中读取 Retry-After（秒数或 HTTP 日期），没有时返回 None"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """令牌桶限速：平均每秒 rate 个请求，最多允许 burst 个请求的突发"""
+
+    def __init__(self, rate: float, burst: int = None):
+        """
+        Args:
+            rate: 每秒补充的令牌数，即长期平均请求速率
+            burst: 桶容量，默认与 rate 相同（至少为 1）
+        """
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """预订一个令牌，返回需要等待的秒数，调用方等待后即可发送请求"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class _LatencyBaseline:
+    """一类请求的平滑延迟及最近 window 个样本中平滑延迟的最小值（基准延迟）"""
+
+    def __init__(self, window: int):
+        self.window = window
+        self.ewma = None
+        # 单调队列，元素为 (样本序号, 平滑延迟)，队首为窗口内的最小值
+        self._queue = deque()
+        self._samples = 0
+
+    def add(self, latency: float) -> float:
+        """加入一个延迟样本，返回平滑延迟与基准延迟之比"""
+        self.ewma = latency if self.ewma is None else 0.8 * self.ewma + 0.2 * latency
+        self._samples += 1
+        while self._queue and self._queue[-1][1] >= self.ewma:
+            self._queue.pop()
+        self._queue.append((self._samples, self.ewma))
+        while self._queue[0][0] <= self._samples - self.window:
+            self._queue.popleft()
+        return self.ewma / self._queue[0][1] if self._queue[0][1] > 0 else 1.0
+
+    @property
+    def minimum(self) -> float:
+        return self._queue[0][1]
+
+
+class AdaptiveConcurrencyLimiter:
+    """按 AIMD 方式自适应调整同时进行中的请求数上限
+
+    请求成功且延迟未明显上升时，每完成约 limit 个请求上限加 1（加性增大）；
+    遇到限流、超时，或平滑延迟超过基准延迟的 latency_tolerance 倍时，上限乘以
+    backoff_ratio（乘性减小）。每个冷却期内最多减小一次，避免一次突发被重复惩罚。
+    基准延迟取最近 min_window 个样本中平滑延迟的最小值，个别异常快的请求移出窗口后
+    不再影响判断，上限随之恢复。平滑延迟和基准延迟按请求类别（如阶段）分别统计，
+    单图分析与批量判断等耗时不同的请求不会互相拉低基准或被误判为拥塞。
+    """
+
+    def __init__(self, initial: int = 16, min_limit: int = 1, max_limit: int = 64,
+                 backoff_ratio: float = 0.5, latency_tolerance: float = 2.0,
+                 cooldown: float = 1.0, poll_interval: float = 0.01, min_window: int = 256):
+        """
+        Args:
+            initial: 初始并发上限
+            min_limit: 并发上限的下界
+            max_limit: 并发上限的上界
+            backoff_ratio: 乘性减小的比例
+            latency_tolerance: 平滑延迟超过基准延迟多少倍时视为拥塞
+            cooldown: 两次减小之间的最短间隔（秒）
+            poll_interval: 异步等待空闲槽位时的轮询间隔（秒）
+            min_window: 计算基准延迟的样本窗口大小
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.poll_interval = poll_interval
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self.min_window = min_window
+        # 请求类别 -> 该类请求的延迟基准
+        self._baselines: Dict[Optional[str], _LatencyBaseline] = {}
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        # 同步与异步调用共用同一份计数，异步侧以短间隔轮询，避免阻塞事件循环
+        while not self.try_acquire():
+            await asyncio.sleep(self.poll_interval)
+
+    def release(self, latency: float = None, overloaded: bool = False, kind: str = None):
+        """释放槽位并根据本次结果调整上限
+        Args:
+            latency: 成功请求的耗时（秒），失败时为 None
+            overloaded: 本次请求是否遇到限流或超时
+            kind: 请求类别，延迟只与同类请求的基准比较
+        """
+        with self._cond:
+            self.in_flight -= 1
+            congested = overloaded
+            if latency is not None:
+                baseline = self._baselines.get(kind)
+                if baseline is None:
+                    baseline = self._baselines[kind] = _LatencyBaseline(self.min_window)
+                if baseline.add(latency) > self.latency_tolerance:
+                    congested = True
+            now = time.monotonic()
+            if congested:
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self._last_decrease = now
+            elif latency is not None:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+    def baseline(self, kind: str = None) -> Optional[float]:
+        """某类请求当前窗口内的基准延迟，尚无样本时为 None"""
+        with self._cond:
+            baseline = self._baselines.get(kind)
+            return baseline.minimum if baseline is not None else None
+
+    @property
+    def min_latency(self) -> Optional[float]:
+        """各类请求基准延迟中的最小值，尚无样本时为 None"""
+        with self._cond:
+            return min((b.minimum for b in self._baselines.values()), default=None)
+
+
+class CircuitBreaker:
+    """熔断器：连续 failure_threshold 次可重试失败后打开，reset_timeout 秒内直接拒绝请求，
+    之后进入半开状态放行一个试探请求，成功则关闭，失败则重新打开"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 20, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """请求发送前调用，熔断时抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError("模型服务连续失败，熔断器已打开")
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN:
+                # 试探请求被取消时不会回报结果，超过 reset_timeout 后允许重新试探
+                if self._trial_in_flight and time.monotonic() - self._trial_started < self.reset_timeout:
+                    raise CircuitOpenError("熔断器半开，等待试探请求结果")
+                self._trial_in_flight = True
+                self._trial_started = time.monotonic()
+
+    def on_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+            self._trial_in_flight = False
+
+    def on_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def remaining_open(self) -> float:
+        """熔断器打开状态的剩余秒数，未打开时为 0"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(self.reset_timeout - (time.monotonic() - self._opened_at), 0.0)
+
+
+class RequestController:
+    """ModelClient 所有请求共用的限速、并发控制、重试和熔断层"""
+
+    def __init__(self, rate: float = None, burst: int = None, max_retries: int = 5,
+                 base_delay: float = 0.5, max_delay: float = 30.0,
+                 concurrency: AdaptiveConcurrencyLimiter = None,
+                 breaker: CircuitBreaker = None):
+        """
+        Args:
+            rate: 每秒最多发送的请求数，为 None 时不限速
+            burst: 令牌桶容量
+            max_retries: 可重试失败的最大重试次数
+            base_delay: 指数退避的初始等待（秒）
+            max_delay: 单次退避等待的上限（秒）
+            concurrency: 自适应并发控制器，默认使用 AdaptiveConcurrencyLimiter()
+            breaker: 熔断器，默认使用 CircuitBreaker()
+        """
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = concurrency or AdaptiveConcurrencyLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self._rng = random.Random()
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """第 attempt 次重试前的等待时间：优先遵守 Retry-After，否则为带全抖动的指数退避"""
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    @staticmethod
+    def _latency(start: float, result, latency_sample) -> Optional[float]:
+        """成功请求的耗时，不作为延迟样本时为 None"""
+        sampled = latency_sample(result) if callable(latency_sample) else latency_sample
+        return time.perf_counter() - start if sampled else None
+
+    def _should_retry(self, error: Exception, attempt: int) -> bool:
+        return attempt < self.max_retries and is_retryable(error)
+
+    def retry(self, fn: Callable[[], T]) -> T:
+        """只按退避策略重试执行 fn，不经过限速、并发控制和熔断，用于查询模型id 等辅助请求，
+        其耗时不作为自适应并发的延迟样本"""
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    e.retries = attempt
+                    raise
+                time.sleep(self.backoff(attempt, e))
+                attempt += 1
+
+    async def aretry(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """retry 的异步版本"""
+        attempt = 0
+        while True:
+            try:
+                return await fn()
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    e.retries = attempt
+                    raise
+                await asyncio.sleep(self.backoff(attempt, e))
+                attempt += 1
+
+    def call(self, fn: Callable[[], T], latency_sample: Union[bool, Callable[[T], bool]] = True,
+             kind: str = None) -> Tuple[T, int]:
+        """同步执行一次请求，返回 (结果, 重试次数)，重试耗尽后抛出最后一次的异常
+        Args:
+            fn: 发送请求的函数
+            latency_sample: 成功时的耗时是否作为自适应并发的延迟样本，也可以是根据结果判断的函数；
+                耗时不代表正常请求的调用（如流式提前结束的请求）应为 False，只释放槽位
+            kind: 请求类别（如阶段名称），自适应并发按类别分别维护基准延迟
+        """
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                # 熔断期间不发送请求，等到半开或试探请求有结果后再试；等待不计入重试次数，
+                # 服务持续不可用时由各自的试探请求失败耗尽重试
+                time.sleep(max(self.breaker.remaining_open(), self.base_delay))
+                continue
+            if self.bucket is not None:
+                time.sleep(self.bucket.reserve())
+            self.concurrency.acquire()
+            start = time.perf_counter()
+            try:
+                result = fn()
+            except Exception as e:
+                self.concurrency.release(overloaded=is_overload(e), kind=kind)
+                if is_retryable(e):
+                    self.breaker.on_failure()
+                else:
+                    # 请求参数等错误说明服务本身可用
+                    self.breaker.on_success()
+                if not self._should_retry(e, attempt):
+                    # 记录已重试次数，供调用方统计
+                    e.retries = attempt
+                    raise
+                time.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            self.concurrency.release(latency=self._latency(start, result, latency_sample), kind=kind)
+            self.breaker.on_success()
+            return result, attempt
+
+    async def acall(self, fn: Callable[[], Awaitable[T]],
+                    latency_sample: Union[bool, Callable[[T], bool]] = True, kind: str = None) -> Tuple[T, int]:
+        """call 的异步版本"""
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                await asyncio.sleep(max(self.breaker.remaining_open(), self.base_delay))
+                continue
+            if self.bucket is not None:
+                await asyncio.sleep(self.bucket.reserve())
+            await self.concurrency.acquire_async()
+            start = time.perf_counter()
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                self.concurrency.release()
+                raise
+            except Exception as e:
+                self.concurrency.release(overloaded=is_overload(e), kind=kind)
+                if is_retryable(e):
+                    self.breaker.on_failure()
+                else:
+                    # 请求参数等错误说明服务本身可用
+                    self.breaker.on_success()
+                if not self._should_retry(e, attempt):
+                    # 记录已重试次数，供调用方统计
+                    e.retries = attempt
+                    raise
+                await asyncio.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            self.concurrency.release(latency=self._latency(start, result, latency_sample), kind=kind)
+            self.breaker.on_success()
+            return result, attempt
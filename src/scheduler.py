@@ -0,0 +1,285 @@
+import threading
+from collections import Counter, deque
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pair_index import CandidatePairIndex
+
+# 配对判断和问答生成相关的模型调用阶段，预算只统计这些阶段的消耗
+PAIR_STAGES = ('pair_match', 'qa_pair', 'pair_judge', 'pair_judge_batch')
+
+
+def _anomaly(info: Dict) -> str:
+    annotation = info.get('annotation', info)
+    anomaly = annotation.get('anomaly')
+    if isinstance(anomaly, (list, tuple)):
+        anomaly = '、'.join(str(a) for a in anomaly)
+    return str(anomaly or '').strip()
+
+
+def scene_of(info: Dict) -> str:
+    """图片的场景标签，多个标签时取第一个"""
+    annotation = info.get('annotation', info)
+    scene = annotation.get('scene')
+    if isinstance(scene, (list, tuple)):
+        scene = scene[0] if scene else None
+    return str(scene or '').strip()
+
+
+def pair_priority(ref_info: Dict, test_info: Dict, contrast_weight: float = 0.5) -> float:
+    """只用标注数据估计候选对成为好样本的可能性，分数越高越先交给模型判断
+    分数为标注物体和场景的 Jaccard 相似度，加上异常对比：一张有异常另一张正常时加
+    contrast_weight，两张的异常不同时加一半。参照图对需要场景相近、又有可对比之处。
+    Args:
+        ref_info: 参考图信息或标注数据
+        test_info: 测试图信息或标注数据
+        contrast_weight: 异常对比的权重
+    """
+    similarity = CandidatePairIndex.jaccard(CandidatePairIndex.extract_features(ref_info),
+                                            CandidatePairIndex.extract_features(test_info))
+    ref_anomaly, test_anomaly = _anomaly(ref_info), _anomaly(test_info)
+    if bool(ref_anomaly) != bool(test_anomaly):
+        contrast = 1.0
+    elif ref_anomaly != test_anomaly:
+        contrast = 0.5
+    else:
+        contrast = 0.0
+    return similarity + contrast_weight * contrast
+
+
+class PairScheduler:
+    """按本地优先级安排候选对的判断顺序，达到目标数量或预算后停止发起请求
+
+    候选对先按 pair_priority 从高到低排列；每得到一个配对成功的问答调用 record，
+    问答数达到 target_pairs、或配对阶段消耗的 token 数或请求数达到预算后，done 变为
+    True，调用方不再发起新的请求。
+    接纳的候选对在 record 之前一直占用名额：进行中的候选对计入目标问答数和各图片、场景的
+    上限，每个请求按已有的平均消耗计入预算，因此并发判断时写出的问答数不会超过目标。
+    设置 max_per_image / max_per_scene 时，已有足够问答的图片或场景不再参与新的候选对，
+    使问答均匀分布在各图片和场景上。续跑时先用 seed 计入之前运行已写出的问答。
+    """
+
+    def __init__(self, target_pairs: int = None, token_budget: int = None, call_budget: int = None,
+                 max_per_image: int = None, max_per_scene: int = None, contrast_weight: float = 0.5,
+                 metrics=None):
+        """
+        Args:
+            target_pairs: 目标问答数，为 None 时不限制
+            token_budget: 配对阶段的 token 预算（提示词与生成合计），为 None 时不限制
+            call_budget: 配对阶段实际发送的请求数预算，命中缓存的请求不计入，为 None 时不限制
+            max_per_image: 每张图片最多参与的问答数，为 None 时不限制
+            max_per_scene: 每个场景（按参考图的场景标签）最多的问答数，为 None 时不限制
+            contrast_weight: pair_priority 中异常对比的权重
+            metrics: MetricsRecorder，用于读取配对阶段已消耗的 token 数和请求数；设置预算时必须提供
+        """
+        if (token_budget is not None or call_budget is not None) and metrics is None:
+            raise ValueError("设置 token 或请求数预算时需要提供 metrics")
+        self.target_pairs = target_pairs
+        self.token_budget = token_budget
+        self.call_budget = call_budget
+        self.max_per_image = max_per_image
+        self.max_per_scene = max_per_scene
+        self.contrast_weight = contrast_weight
+        self.metrics = metrics
+        # 预算从调度器创建时开始计算，之前各阶段的消耗不计入
+        self._baseline = metrics.usage(PAIR_STAGES) if metrics is not None else None
+        self._lock = threading.Lock()
+        self.produced = 0
+        self._per_image = Counter()
+        self._per_scene = Counter()
+        # 已接纳、尚未 record 的候选对：{候选对: (所属请求的剩余候选对数, 场景)}，以及它们占用的名额
+        self._reservations: Dict[Tuple[str, str], Tuple[List[int], Optional[str]]] = {}
+        self._reserved_image = Counter()
+        self._reserved_scene = Counter()
+        self._reserved_calls = 0
+        # seed 计入的、之前运行已写出的配对，再次遇到时不重复计数
+        self._seeded = set()
+        # 停止原因，未停止时为 None
+        self.stop_reason: Optional[str] = None
+
+    def order(self, pairs: Iterable[Tuple[str, str]], image_infos: Dict) -> List[Tuple[str, str]]:
+        """按优先级从高到低排列候选对，分数相同时保持原有顺序"""
+        scored = [(pair_priority(image_infos[ref], image_infos[test], self.contrast_weight), i, (ref, test))
+                  for i, (ref, test) in enumerate(pairs)]
+        scored.sort(key=lambda x: (-x[0], x[1]))
+        return [pair for _, _, pair in scored]
+
+    def spent(self) -> Dict[str, int]:
+        """调度器创建以来配对阶段实际发送的请求数和消耗的 token 数"""
+        if self.metrics is None:
+            return {'calls': 0, 'tokens': 0}
+        usage = self.metrics.usage(PAIR_STAGES)
+        return {name: usage[name] - self._baseline[name] for name in usage}
+
+    @property
+    def done(self) -> bool:
+        """是否已达到目标问答数或预算"""
+        if self.stop_reason is None:
+            if self.target_pairs is not None and self.produced >= self.target_pairs:
+                self.stop_reason = 'target'
+            elif self.token_budget is not None or self.call_budget is not None:
+                spent = self.spent()
+                if self.token_budget is not None and spent['tokens'] >= self.token_budget:
+                    self.stop_reason = 'token_budget'
+                elif self.call_budget is not None and spent['calls'] >= self.call_budget:
+                    self.stop_reason = 'call_budget'
+        return self.stop_reason is not None
+
+    @property
+    def in_flight(self) -> int:
+        """已接纳、尚未 record 的候选对数"""
+        return len(self._reservations)
+
+    def _over_budget(self) -> bool:
+        """已消耗加上进行中请求的估计消耗是否达到预算，须持有锁"""
+        if self.token_budget is None and self.call_budget is None:
+            return False
+        spent = self.spent()
+        if self.call_budget is not None and spent['calls'] + self._reserved_calls >= self.call_budget:
+            return True
+        if self.token_budget is not None:
+            # 进行中的请求按已完成请求的平均 token 数估计
+            per_call = spent['tokens'] / spent['calls'] if spent['calls'] else 0
+            return spent['tokens'] + per_call * self._reserved_calls >= self.token_budget
+        return False
+
+    def admit_batch(self, pairs: Iterable[Tuple[str, str]],
+                    image_infos: Dict) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+        """按顺序接纳将用一次请求判断的一组候选对，接纳的候选对占用名额直到 record
+        Args:
+            pairs: 候选对
+            image_infos: 图片信息字典
+        Returns:
+            (接纳的候选对, 暂缓的候选对)：暂缓的候选对只是名额被进行中的候选对占用，等它们
+            record 后可以再次尝试；图片或场景已有足够问答的候选对两者都不包含，不再判断
+        """
+        if self.done:
+            return [], []
+        admitted, deferred, scenes = [], [], []
+        with self._lock:
+            room = None if self.target_pairs is None else \
+                self.target_pairs - self.produced - len(self._reservations)
+            over_budget = self._over_budget()
+            for ref_name, test_name in pairs:
+                scene = scene_of(image_infos[ref_name]) if self.max_per_scene is not None else None
+                if self.max_per_image is not None and max(
+                        self._per_image[ref_name], self._per_image[test_name]) >= self.max_per_image:
+                    continue
+                if scene is not None and self._per_scene[scene] >= self.max_per_scene:
+                    continue
+                if over_budget or (room is not None and len(admitted) >= room) or (
+                        self.max_per_image is not None and max(
+                            self._per_image[ref_name] + self._reserved_image[ref_name],
+                            self._per_image[test_name] + self._reserved_image[test_name]
+                        ) >= self.max_per_image) or (
+                        scene is not None
+                        and self._per_scene[scene] + self._reserved_scene[scene] >= self.max_per_scene):
+                    deferred.append((ref_name, test_name))
+                    continue
+                admitted.append((ref_name, test_name))
+                self._reserved_image[ref_name] += 1
+                self._reserved_image[test_name] += 1
+                if scene is not None:
+                    self._reserved_scene[scene] += 1
+                scenes.append(scene)
+            if admitted:
+                # 同一请求的候选对共用一个计数，全部 record 后才释放这个请求占用的预算
+                call = [len(admitted)]
+                self._reserved_calls += 1
+                for pair, scene in zip(admitted, scenes):
+                    self._reservations[pair] = (call, scene)
+        return admitted, deferred
+
+    def iter_admitted_batches(self, pairs: Iterable[Tuple[str, str]], image_infos: Dict,
+                              pack: Callable[[Iterable[Tuple[str, str]]], Iterable[List[Tuple[str, str]]]],
+                              skip: Callable[[int], None] = None) -> Iterator[List[Tuple[str, str]]]:
+        """用 pack 将候选对打包成批次，每批用 admit_batch 截断到剩余名额内后产出
+
+        暂缓的候选对排在尚未遍历的候选对之前重新打包，调用方须在取下一批之前 record
+        这一批的结果；最后一批暂缓的候选对在遍历结束后重新打包，直到全部判断或跳过。
+        Args:
+            pairs: 需要判断的候选对，可以是生成器
+            image_infos: 图片信息字典
+            pack: 将候选对依次装入批次的函数，如按 token 预算打包的 PromptBuilder.iter_pair_batches
+            skip: 接收被跳过的候选对数的回调
+        """
+        deferred = deque()
+        remaining = iter(pairs)
+
+        def source() -> Iterator[Tuple[str, str]]:
+            while True:
+                if deferred:
+                    yield deferred.popleft()
+                    continue
+                pair = next(remaining, None)
+                if pair is None:
+                    return
+                yield pair
+
+        def skipped(n: int):
+            if n and skip is not None:
+                skip(n)
+
+        while True:
+            for batch in pack(source()):
+                if self.done:
+                    skipped(len(batch))
+                    continue
+                admitted, rest = self.admit_batch(batch, image_infos)
+                skipped(len(batch) - len(admitted) - len(rest))
+                if not admitted:
+                    skipped(len(rest))
+                    continue
+                deferred.extend(rest)
+                yield admitted
+            if not deferred:
+                return
+
+    def admit(self, ref_name: str, test_name: str, image_infos: Dict) -> bool:
+        """接纳单独用一次请求判断的候选对，接纳后占用名额直到 record；名额被占用时同样返回 False"""
+        admitted, _ = self.admit_batch([(ref_name, test_name)], image_infos)
+        return bool(admitted)
+
+    def release(self, ref_name: str, test_name: str):
+        """释放候选对占用的名额而不记录结果，未接纳过的候选对直接忽略"""
+        with self._lock:
+            reservation = self._reservations.pop((ref_name, test_name), None)
+            if reservation is None:
+                return
+            call, scene = reservation
+            self._reserved_image[ref_name] -= 1
+            self._reserved_image[test_name] -= 1
+            if scene is not None:
+                self._reserved_scene[scene] -= 1
+            call[0] -= 1
+            if not call[0]:
+                self._reserved_calls -= 1
+
+    def seed(self, pairs: Iterable[Tuple[str, str]], image_infos: Dict):
+        """计入之前运行已写出的问答，续跑时目标和各图片、场景的上限从这些问答开始计算
+        Args:
+            pairs: 已写出问答的配对 (参考图, 测试图)
+            image_infos: 图片信息字典，用于确定场景；缺少的图片不计入场景上限
+        """
+        with self._lock:
+            for ref_name, test_name in pairs:
+                if (ref_name, test_name) in self._seeded:
+                    continue
+                self._seeded.add((ref_name, test_name))
+                self.produced += 1
+                self._per_image[ref_name] += 1
+                self._per_image[test_name] += 1
+                info = image_infos.get(ref_name)
+                if self.max_per_scene is not None and info is not None:
+                    self._per_scene[scene_of(info)] += 1
+
+    def record(self, ref_name: str, test_name: str, qa_pair: Optional[Dict], image_infos: Dict):
+        """记录一个候选对的结果并释放其名额，配对成功并有问答时计入目标，seed 计入过的不重复计数"""
+        self.release(ref_name, test_name)
+        if not qa_pair or (ref_name, test_name) in self._seeded:
+            return
+        with self._lock:
+            self.produced += 1
+            self._per_image[ref_name] += 1
+            self._per_image[test_name] += 1
+            if self.max_per_scene is not None:
+                self._per_scene[scene_of(image_infos[ref_name])] += 1
@@ -0,0 +1,154 @@
+import json
+import os
+import re
+from typing import Dict, List
+
+from dataset_writer import INDEX_FILE, MANIFEST_FILE, DatasetReader, DatasetWriter, remove_dataset
+
+# 各分片输出所在的子目录
+SHARDS_DIR = 'shards'
+_SHARD_NAME = re.compile(r'^shard-(\d+)-of-(\d+)$')
+
+
+def shard_dir(output_dir: str, shard_index: int, num_shards: int) -> str:
+    """返回某个分片的输出目录，不同分片的日志和输出互不干扰"""
+    return os.path.join(output_dir, SHARDS_DIR, f"shard-{shard_index:05d}-of-{num_shards:05d}")
+
+
+def list_shard_dirs(output_dir: str) -> List[str]:
+    """按分片编号列出输出目录下已有的分片目录"""
+    root = os.path.join(output_dir, SHARDS_DIR)
+    if not os.path.isdir(root):
+        return []
+    names = sorted(name for name in os.listdir(root) if _SHARD_NAME.match(name))
+    return [os.path.join(root, name) for name in names]
+
+
+def shard_layout(directory: str, filename: str = "multimodal_data.jsonl") -> str:
+    """判断分片目录的数据集布局：'sharded'、'jsonl'，尚无输出时为 None"""
+    if os.path.exists(os.path.join(directory, INDEX_FILE)):
+        return 'sharded'
+    if os.path.exists(os.path.join(directory, filename)):
+        return 'jsonl'
+    return None
+
+
+def merge_shards(output_dir: str, output_file: str, num_shards: int = None,
+                 filename: str = "multimodal_data.jsonl", image_mode: str = 'hardlink',
+                 compress: bool = False, max_shard_bytes: int = 256 * 1024 * 1024) -> Dict:
+    """将各分片的输出去重后合并为一个数据集
+    各分片须使用相同的布局：jsonl 布局合并为 output_file；sharded 布局通过 DatasetReader 读取各分片，
+    由 DatasetWriter 写入 output_dir 下新的数据分片、manifest 和索引，图片重新放入 output_dir 的
+    内容寻址目录，数据中的图片路径改为相对 output_dir。
+    Args:
+        output_dir: 各 worker 共用的输出根目录，分片输出位于其 shards/ 子目录下
+        output_file: jsonl 布局合并后的 JSONL 文件路径
+        num_shards: 期望的分片总数，提供时检查是否有分片缺失
+        filename: jsonl 布局下每个分片目录中的输出文件名
+        image_mode: sharded 布局下合并后图片的写入方式
+        compress: sharded 布局下是否用 gzip 压缩合并后的数据分片
+        max_shard_bytes: sharded 布局下合并后单个数据分片的字节数上限
+    Returns:
+        Dict: 合并统计，包含布局、读取条数、写入条数、重复条数和缺失的分片编号
+    """
+    shard_dirs = list_shard_dirs(output_dir)
+    missing = []
+    if num_shards is not None:
+        # 只合并与期望分片数一致的目录，忽略以其他分片数运行留下的输出
+        expected = [shard_dir(output_dir, i, num_shards) for i in range(num_shards)]
+        missing = [i for i, d in enumerate(expected) if d not in shard_dirs]
+        shard_dirs = [d for d in expected if d in shard_dirs]
+
+    layouts = {d: shard_layout(d, filename) for d in shard_dirs}
+    found = set(layout for layout in layouts.values() if layout is not None)
+    if len(found) > 1:
+        raise ValueError(f"各分片的数据集布局不一致，无法合并: {sorted(found)}")
+    layout = found.pop() if found else 'jsonl'
+    shard_dirs = [d for d in shard_dirs if layouts[d] is not None]
+
+    stats = {'layout': layout, 'shards': len(shard_dirs), 'read': 0, 'written': 0, 'duplicates': 0,
+             'invalid': 0, 'missing_shards': missing}
+    if layout == 'sharded':
+        _merge_sharded(shard_dirs, output_dir, stats, image_mode, compress, max_shard_bytes)
+    else:
+        _merge_jsonl(shard_dirs, output_file, filename, stats)
+    return stats
+
+
+def _merge_jsonl(shard_dirs: List[str], output_file: str, filename: str, stats: Dict):
+    seen = set()
+    # 先写入临时文件，合并完成后再替换，避免中断时留下不完整的数据集
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as out:
+        for directory in shard_dirs:
+            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    stats['read'] += 1
+                    try:
+                        item_id = json.loads(line)['id']
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        # worker 中断时最后一行可能只写了一半
+                        stats['invalid'] += 1
+                        continue
+                    if item_id in seen:
+                        stats['duplicates'] += 1
+                        continue
+                    seen.add(item_id)
+                    out.write(line if line.endswith('\n') else line + '\n')
+                    stats['written'] += 1
+    os.replace(tmp_file, output_file)
+
+
+def _shard_images(directory: str) -> Dict[str, Dict]:
+    """读取分片的 manifest，返回 {分片中的图片绝对路径: manifest 中的图片记录}"""
+    images = {}
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return images
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            for image in entry.get('images', []):
+                images[os.path.join(directory, image['path'])] = image
+    return images
+
+
+def _merge_sharded(shard_dirs: List[str], output_dir: str, stats: Dict, image_mode: str,
+                   compress: bool, max_shard_bytes: int):
+    # 重新合并时替换上次的合并结果；内容寻址的图片保留并被重新引用
+    remove_dataset(output_dir)
+    seen = set()
+    writer = DatasetWriter(output_dir, image_mode=image_mode, max_shard_bytes=max_shard_bytes,
+                           compress=compress)
+    try:
+        for directory in shard_dirs:
+            reader = DatasetReader(directory)
+            images = _shard_images(directory)
+            # 原始图片仍在时以其为来源，保留 manifest 中的原始路径；否则使用分片中存放的副本
+            sources = {}
+            for stored, image in images.items():
+                source = image['source'] if os.path.exists(image['source']) else stored
+                sources[stored] = source
+            writer.add_known_digests({sources[stored]: image['sha256'] for stored, image in images.items()})
+            for item_id in reader.index:
+                stats['read'] += 1
+                if item_id in seen:
+                    stats['duplicates'] += 1
+                    continue
+                try:
+                    item = reader.get(item_id)
+                except (OSError, EOFError, ValueError, IndexError):
+                    # worker 中断时最后一个块可能不完整
+                    stats['invalid'] += 1
+                    continue
+                seen.add(item_id)
+                paths = [reader.image_path(path) for path in item.get('images', [])]
+                writer.write({**item, 'images': [sources.get(path, path) for path in paths]})
+                stats['written'] += 1
+    finally:
+        writer.close()
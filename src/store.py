@@ -0,0 +1,363 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# 按顺序遍历时每次从数据库读取的行数
+_PAGE_SIZE = 1000
+
+
+class CorpusStore:
+    """基于 SQLite 的图片分析结果和配对结论存储
+
+    替代内存中的 image_infos 字典和配对结果列表：图片信息按文件名从数据库读取，
+    最近使用的条目保留在 LRU 缓存中；写入先进入缓冲区，攒够 batch_size 条后在一个
+    事务中批量写入。配对和问答阶段按页遍历数据库，内存占用不随图片数量增长。
+
+    每次打开存储算作一次新的运行，本次分析或复用的图片、判断或复用的配对会标记为
+    本次运行，供 infos() 和 matched_pairs() 只遍历本次运行涉及的数据。
+    进程中断时缓冲区中尚未写入的结果会丢失，下次运行重新请求模型。
+    """
+
+    def __init__(self, path: str, batch_size: int = 256, cache_size: int = 10000):
+        """
+        Args:
+            path: 数据库文件路径
+            batch_size: 缓冲的写入条数，达到后批量写入数据库
+            cache_size: 缓存的图片信息条数上限，超出时淘汰最久未使用的
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self._lock = threading.RLock()
+        self._cache: 'OrderedDict[str, Dict]' = OrderedDict()
+        # 尚未写入数据库的图片信息、配对结论和本次运行复用的条目
+        self._pending_images: Dict[str, Dict] = {}
+        self._pending_pairs: Dict[Tuple[str, str], Dict] = {}
+        self._touched_images: List[str] = []
+        self._touched_pairs: List[Tuple[str, str]] = []
+        self._pending_written: Dict[Tuple[str, str], str] = {}
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # 同一进程内的分析线程和事件循环共用一个连接，由锁保证串行访问
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                seq INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE,
+                info TEXT NOT NULL,
+                first_run INTEGER NOT NULL,
+                run INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pairs (
+                seq INTEGER PRIMARY KEY,
+                ref TEXT NOT NULL,
+                test TEXT NOT NULL,
+                match INTEGER NOT NULL,
+                qa_pair TEXT,
+                run INTEGER NOT NULL,
+                UNIQUE (ref, test)
+            )
+        """)
+        # 已写入输出文件的问答，替代 journal 中的 qa 阶段，续跑时按配对查询而不整体载入内存
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS written (
+                ref TEXT NOT NULL,
+                test TEXT NOT NULL,
+                id TEXT,
+                PRIMARY KEY (ref, test)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_run ON images(run)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_pairs_run ON pairs(run)")
+        self._conn.commit()
+        last_run = self._conn.execute(
+            "SELECT MAX(m) FROM (SELECT MAX(run) AS m FROM images UNION ALL SELECT MAX(run) FROM pairs)"
+        ).fetchone()[0]
+        # 本次运行的编号
+        self.run = (last_run or 0) + 1
+        self.stats = {'images_written': 0, 'pairs_written': 0, 'flushes': 0,
+                      'cache_hits': 0, 'cache_misses': 0}
+
+    # ---- 图片信息 ----
+
+    def _cache_put(self, name: str, info: Dict):
+        self._cache[name] = info
+        self._cache.move_to_end(name)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get_image(self, name: str) -> Optional[Dict]:
+        """按文件名读取图片信息，不存在时返回 None"""
+        with self._lock:
+            info = self._pending_images.get(name)
+            if info is not None:
+                return info
+            info = self._cache.get(name)
+            if info is not None:
+                self._cache.move_to_end(name)
+                self.stats['cache_hits'] += 1
+                return info
+            self.stats['cache_misses'] += 1
+            row = self._conn.execute("SELECT info FROM images WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            info = json.loads(row[0])
+            self._cache_put(name, info)
+            return info
+
+    def restore_image(self, name: str) -> Optional[Dict]:
+        """读取之前运行的图片信息并标记为本次运行使用，不存在时返回 None"""
+        info = self.get_image(name)
+        if info is not None:
+            with self._lock:
+                self._touched_images.append(name)
+                self._maybe_flush()
+        return info
+
+    def save_image(self, name: str, info: Dict):
+        """写入一张图片的分析结果"""
+        with self._lock:
+            self._pending_images[name] = info
+            self._cache_put(name, info)
+            self._maybe_flush()
+
+    # ---- 配对结论 ----
+
+    def get_pair(self, ref_name: str, test_name: str) -> Optional[Dict]:
+        """读取配对结论，格式为 {'match': bool, 'qa_pair': dict}，未判断过时返回 None"""
+        with self._lock:
+            value = self._pending_pairs.get((ref_name, test_name))
+            if value is not None:
+                return value
+            row = self._conn.execute(
+                "SELECT match, qa_pair FROM pairs WHERE ref = ? AND test = ?", (ref_name, test_name)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'match': bool(row[0]), 'qa_pair': json.loads(row[1]) if row[1] is not None else None}
+
+    def restore_pair(self, ref_name: str, test_name: str) -> Optional[Dict]:
+        """读取之前运行的配对结论并标记为本次运行使用，未判断过时返回 None"""
+        value = self.get_pair(ref_name, test_name)
+        if value is not None:
+            with self._lock:
+                self._touched_pairs.append((ref_name, test_name))
+                self._maybe_flush()
+        return value
+
+    def save_pair(self, ref_name: str, test_name: str, is_match: bool, qa_pair: Optional[Dict]):
+        """写入一个配对的判断结论"""
+        with self._lock:
+            self._pending_pairs[(ref_name, test_name)] = {'match': is_match, 'qa_pair': qa_pair}
+            self._maybe_flush()
+
+    # ---- 已写入的问答 ----
+
+    def is_written(self, ref_name: str, test_name: str) -> bool:
+        """判断配对的问答是否已写入输出文件"""
+        with self._lock:
+            if (ref_name, test_name) in self._pending_written:
+                return True
+            return self._conn.execute(
+                "SELECT 1 FROM written WHERE ref = ? AND test = ?", (ref_name, test_name)
+            ).fetchone() is not None
+
+    def mark_written(self, ref_name: str, test_name: str, data_id: str = None):
+        """记录配对的问答已写入输出文件，应在数据落盘后调用"""
+        with self._lock:
+            self._pending_written[(ref_name, test_name)] = data_id
+            self._maybe_flush()
+
+    def written_pairs(self) -> Iterator[Tuple[str, str]]:
+        """按页遍历已写入输出文件的配对 (参考图, 测试图)"""
+        self.flush()
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT rowid, ref, test FROM written WHERE rowid > ? ORDER BY rowid LIMIT ?", (last, _PAGE_SIZE)
+                ).fetchall()
+            if not rows:
+                return
+            for _, ref, test in rows:
+                yield ref, test
+            last = rows[-1][0]
+
+    def has_written(self) -> bool:
+        """是否记录过已写入的问答，用于判断是否需要从 journal 迁移"""
+        with self._lock:
+            return bool(self._pending_written) or self._conn.execute(
+                "SELECT 1 FROM written LIMIT 1"
+            ).fetchone() is not None
+
+    # ---- 批量写入 ----
+
+    def _pending_count(self) -> int:
+        return (len(self._pending_images) + len(self._pending_pairs)
+                + len(self._touched_images) + len(self._touched_pairs) + len(self._pending_written))
+
+    def _maybe_flush(self):
+        if self._pending_count() >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """将缓冲区中的写入在一个事务中提交"""
+        with self._lock:
+            if not self._pending_count():
+                return
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO images (name, info, first_run, run) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET info = excluded.info, run = excluded.run",
+                    ((name, json.dumps(info, ensure_ascii=False), self.run, self.run)
+                     for name, info in self._pending_images.items())
+                )
+                self._conn.executemany(
+                    "INSERT INTO pairs (ref, test, match, qa_pair, run) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(ref, test) DO UPDATE SET match = excluded.match, "
+                    "qa_pair = excluded.qa_pair, run = excluded.run",
+                    ((ref, test, int(value['match']),
+                      json.dumps(value['qa_pair'], ensure_ascii=False) if value['qa_pair'] else None, self.run)
+                     for (ref, test), value in self._pending_pairs.items())
+                )
+                self._conn.executemany("UPDATE images SET run = ? WHERE name = ?",
+                                       ((self.run, name) for name in self._touched_images))
+                self._conn.executemany("UPDATE pairs SET run = ? WHERE ref = ? AND test = ?",
+                                       ((self.run, ref, test) for ref, test in self._touched_pairs))
+                self._conn.executemany("INSERT OR REPLACE INTO written (ref, test, id) VALUES (?, ?, ?)",
+                                       ((ref, test, data_id) for (ref, test), data_id in self._pending_written.items()))
+            self.stats['images_written'] += len(self._pending_images)
+            self.stats['pairs_written'] += len(self._pending_pairs)
+            self.stats['flushes'] += 1
+            self._pending_images.clear()
+            self._pending_pairs.clear()
+            self._touched_images.clear()
+            self._touched_pairs.clear()
+            self._pending_written.clear()
+
+    # ---- 遍历 ----
+
+    def _pages(self, sql: str, params: Tuple) -> Iterator[tuple]:
+        """按 seq 分页执行查询，sql 的第一列须为 seq，遍历期间可以继续写入"""
+        self.flush()
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(f"{sql} AND seq > ? ORDER BY seq LIMIT ?",
+                                          params + (last, _PAGE_SIZE)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last = rows[-1][0]
+
+    def infos(self, current_run: bool = True) -> 'ImageInfoView':
+        """以只读字典的形式访问图片信息，可直接替代 image_infos 字典
+        Args:
+            current_run: 为 True 时只遍历本次运行分析或复用的图片，否则遍历历次运行的全部图片
+        """
+        return ImageInfoView(self, self.run if current_run else None)
+
+    def new_image_names(self) -> List[str]:
+        """本次运行首次分析的图片，增量模式下只为这些图片生成配对"""
+        return [name for _, name in self._pages("SELECT seq, name FROM images WHERE first_run = ?", (self.run,))]
+
+    def matched_pairs(self) -> 'MatchedPairView':
+        """本次运行判断或复用的、配对成功的问答，格式与 create_reference_pairs 的返回值一致"""
+        return MatchedPairView(self)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._conn.close()
+
+
+class ImageInfoView:
+    """CorpusStore 中图片信息的只读字典视图
+
+    按文件名读取时不限运行，遍历和计数只包含视图对应运行的图片，遍历顺序为图片首次写入的顺序，
+    历次运行之间保持不变，续跑时候选对的参考图和测试图不会对调。
+    """
+
+    def __init__(self, store: CorpusStore, run: int = None):
+        self.store = store
+        self.run = run
+
+    def _where(self) -> Tuple[str, Tuple]:
+        return ("WHERE run = ?", (self.run,)) if self.run is not None else ("WHERE 1", ())
+
+    def __getitem__(self, name: str) -> Dict:
+        info = self.store.get_image(name)
+        if info is None:
+            raise KeyError(name)
+        return info
+
+    def get(self, name: str, default=None):
+        info = self.store.get_image(name)
+        return default if info is None else info
+
+    def __contains__(self, name: str) -> bool:
+        return self.store.get_image(name) is not None
+
+    def items(self) -> Iterator[Tuple[str, Dict]]:
+        where, params = self._where()
+        for _, name, info in self.store._pages(f"SELECT seq, name, info FROM images {where}", params):
+            yield name, json.loads(info)
+
+    def keys(self) -> Iterator[str]:
+        where, params = self._where()
+        for _, name in self.store._pages(f"SELECT seq, name FROM images {where}", params):
+            yield name
+
+    def values(self) -> Iterator[Dict]:
+        for _, info in self.items():
+            yield info
+
+    def __iter__(self) -> Iterator[str]:
+        return self.keys()
+
+    def __len__(self) -> int:
+        self.store.flush()
+        where, params = self._where()
+        with self.store._lock:
+            return self.store._conn.execute(f"SELECT COUNT(*) FROM images {where}", params).fetchone()[0]
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+
+class MatchedPairView:
+    """CorpusStore 中本次运行配对成功的问答，可多次遍历，遍历时按页读取"""
+
+    def __init__(self, store: CorpusStore):
+        self.store = store
+
+    def __iter__(self) -> Iterator[Dict]:
+        for _, ref, test, qa_pair in self.store._pages(
+                "SELECT seq, ref, test, qa_pair FROM pairs WHERE run = ? AND qa_pair IS NOT NULL",
+                (self.store.run,)):
+            yield {"reference": ref, "test": test, "qa_pair": json.loads(qa_pair)}
+
+    def __len__(self) -> int:
+        self.store.flush()
+        with self.store._lock:
+            return self.store._conn.execute(
+                "SELECT COUNT(*) FROM pairs WHERE run = ? AND qa_pair IS NOT NULL", (self.store.run,)
+            ).fetchone()[0]
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+
+def remove_store(path: str):
+    """删除存储文件及其 WAL 文件"""
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
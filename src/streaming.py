@@ -0,0 +1,190 @@
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+from prompts import estimate_tokens
+
+# 顶层 JSON 值的起止字符
+_CLOSING = {'{': '}', '[': ']'}
+
+
+class JsonStreamParser:
+    """增量识别回复中第一个完整的顶层 JSON 值
+
+    逐段接收模型输出，跳过开头的说明文字或 markdown 代码块标记，跟踪括号深度和字符串
+    转义，顶层对象（或数组）闭合时立即解析。解析失败或缺少必需的键时视为示例或草稿，
+    把其起始字符当作普通文字，从下一个字符重新寻找顶层值，因此说明文字中的零散括号
+    不会吞掉后面真正的 JSON。输出结束时调用 finish，未闭合的起始字符同样按普通文字处理。
+    """
+
+    def __init__(self, root: str = '{', required_keys: Sequence[str] = ()):
+        """
+        Args:
+            root: 顶层值的起始字符，'{' 表示对象，'[' 表示数组
+            required_keys: 必需的键；顶层为数组时要求每个元素都是包含这些键的对象
+        """
+        if root not in _CLOSING:
+            raise ValueError(f"不支持的顶层 JSON 类型: {root}")
+        self.root = root
+        self.required_keys = tuple(required_keys)
+        # 已接收的全部文本
+        self.text = ''
+        self._pos = 0
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        # 识别出的值及其原始文本，未完成时为 None
+        self.value: Any = None
+        self.json_text: Optional[str] = None
+
+    @property
+    def complete(self) -> bool:
+        return self.json_text is not None
+
+    def _restart(self, pos: int):
+        """放弃当前的候选值，从 pos 处重新寻找顶层值"""
+        self._pos = pos
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _accept(self, value) -> bool:
+        if self.root == '{':
+            return isinstance(value, dict) and all(key in value for key in self.required_keys)
+        return isinstance(value, list) and (not self.required_keys or all(
+            isinstance(item, dict) and all(key in item for key in self.required_keys) for item in value
+        ))
+
+    def feed(self, chunk: str) -> bool:
+        """接收一段输出，返回是否已得到完整且有效的顶层值"""
+        if self.complete:
+            return True
+        self.text += chunk
+        text = self.text
+        i = self._pos
+        while i < len(text):
+            c = text[i]
+            if self._start is None:
+                if c == self.root:
+                    self._start, self._depth = i, 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c in '{[':
+                self._depth += 1
+            elif c in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    start = self._start
+                    candidate = text[start:i + 1]
+                    try:
+                        value = json.loads(candidate)
+                    except json.JSONDecodeError:
+                        value = None
+                    if value is not None and self._accept(value):
+                        self.value, self.json_text = value, candidate
+                        self._restart(i + 1)
+                        return True
+                    # 起始字符可能只是说明文字中的括号，从它后面重新扫描
+                    self._restart(start + 1)
+                    i = start + 1
+                    continue
+            i += 1
+        self._pos = i
+        return False
+
+    def finish(self) -> bool:
+        """输出结束时调用，未闭合的候选值的起始字符按普通文字处理后继续寻找，返回是否得到有效值"""
+        while not self.complete and self._start is not None:
+            self._restart(self._start + 1)
+            self.feed('')
+        return self.complete
+
+
+def extract_json(content: str, root: str = '{', required_keys: Sequence[str] = ()):
+    """从完整的回复中取出第一个有效的顶层 JSON 值，忽略前后的多余文字，没有时返回 None"""
+    parser = JsonStreamParser(root, required_keys)
+    parser.feed(content)
+    return parser.value if parser.finish() else None
+
+
+class StreamedResponse:
+    """流式请求的结果，提供与非流式响应相同的 usage 属性供指标记录"""
+
+    def __init__(self, parser: JsonStreamParser, usage, stopped_early: bool, messages: List[Dict]):
+        self.parser = parser
+        self.stopped_early = stopped_early
+        # 识别出 JSON 时只返回该部分，之后的多余文字不再保留；否则返回全部文本交给调用方解析
+        self.content = parser.json_text if parser.complete else parser.text
+        if usage is None:
+            # 提前停止时服务端不再发送 usage，按文本长度估计（不含图片）
+            usage = _EstimatedUsage(_prompt_text_tokens(messages), estimate_tokens(parser.text))
+        self.usage = usage
+
+
+class _EstimatedUsage:
+    def __init__(self, prompt_tokens: int, completion_tokens: int):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+
+def _prompt_text_tokens(messages: List[Dict]) -> int:
+    tokens = 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            tokens += estimate_tokens(content)
+        elif isinstance(content, list):
+            tokens += sum(estimate_tokens(part.get('text', '')) for part in content if isinstance(part, dict))
+    return tokens
+
+
+def _chunk_parts(chunk):
+    """取出流式分块中的 (文本增量, 是否结束)"""
+    text, finished = '', False
+    for choice in getattr(chunk, 'choices', None) or []:
+        delta = getattr(choice, 'delta', None)
+        text += getattr(delta, 'content', None) or ''
+        finished = finished or getattr(choice, 'finish_reason', None) is not None
+    return text, finished
+
+
+def consume_stream(stream, parser: JsonStreamParser, messages: List[Dict]) -> StreamedResponse:
+    """读取同步流式响应，识别出完整的 JSON 后立即关闭连接，服务端随之停止生成"""
+    usage, finished = None, False
+    try:
+        for chunk in stream:
+            usage = getattr(chunk, 'usage', None) or usage
+            text, done = _chunk_parts(chunk)
+            finished = finished or done
+            if text and parser.feed(text):
+                break
+    finally:
+        stream.close()
+    if not parser.complete:
+        parser.finish()
+    return StreamedResponse(parser, usage, parser.complete and not finished, messages)
+
+
+async def aconsume_stream(stream, parser: JsonStreamParser, messages: List[Dict]) -> StreamedResponse:
+    """consume_stream 的异步版本"""
+    usage, finished = None, False
+    try:
+        async for chunk in stream:
+            usage = getattr(chunk, 'usage', None) or usage
+            text, done = _chunk_parts(chunk)
+            finished = finished or done
+            if text and parser.feed(text):
+                break
+    finally:
+        await stream.close()
+    if not parser.complete:
+        parser.finish()
+    return StreamedResponse(parser, usage, parser.complete and not finished, messages)
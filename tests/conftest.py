@@ -0,0 +1,76 @@
+import asyncio
+import json
+import os
+import re
+import sys
+
+import pytest
+
+# 源码为 src/ 下的平铺模块，与 main.py 的导入方式一致
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from metrics import MetricsRecorder  # noqa: E402
+
+
+class FakeClient:
+    """不发送请求的模型客户端，每个候选对都判为配对成功
+
+    rejected_batches 为开头按全部不配对回复的批量判断请求数。
+    """
+
+    class preprocessor:
+        @staticmethod
+        def to_data_url(image_data):
+            return 'data:image/jpeg;base64,'
+
+    def __init__(self, rejected_batches: int = 0):
+        self.metrics = MetricsRecorder()
+        self.rejected_batches = rejected_batches
+
+    def image_content(self, image_path):
+        return {'type': 'image_url', 'image_url': {'url': 'data:image/jpeg;base64,'}}
+
+    def chat(self, messages, stage, **kwargs):
+        self.metrics.record_call(stage, 0.01, 100, 20)
+        if stage == 'scene_description':
+            return '{"scene": "工地"}'
+        if stage == 'pair_judge_batch':
+            ids = re.findall(r'^\s*(P\d+):', messages[0]['content'], re.M)
+            if self.metrics.usage((stage,))['calls'] <= self.rejected_batches:
+                return json.dumps([{'id': i, 'match': False} for i in ids])
+            return json.dumps([{'id': i, 'match': True, 'question': 'q', 'answer': 'a'} for i in ids])
+        return '{"match": true, "question": "q", "answer": "a"}'
+
+    async def achat(self, messages, stage, **kwargs):
+        await asyncio.sleep(0.01)
+        return self.chat(messages, stage, **kwargs)
+
+
+def _annotations(n: int):
+    return {f"{i}.jpg": {'objects': ['塔吊', '安全帽', f"物体{i % 3}"], 'scene': f"场景{i % 2}"} for i in range(n)}
+
+
+@pytest.fixture
+def fake_client():
+    """创建 FakeClient 的工厂"""
+    return FakeClient
+
+
+@pytest.fixture
+def make_infos():
+    """生成 n 张图片的 image_infos 的工厂，图片名为 0.jpg、1.jpg ……"""
+    def make(n: int = 12):
+        return {name: {'annotation': annotation, 'description': '工地现场'}
+                for name, annotation in _annotations(n).items()}
+    return make
+
+
+@pytest.fixture
+def make_image_dir(tmp_path):
+    """在临时目录中生成 n 张空图片文件的工厂，返回 (图片目录, 标注数据)"""
+    def make(n: int = 12):
+        annotations = _annotations(n)
+        for name in annotations:
+            (tmp_path / name).write_bytes(b'')
+        return str(tmp_path), annotations
+    return make
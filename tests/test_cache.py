@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+from api_client import ModelClient
+from cache import ResponseCache
+from endpoints import Endpoint, EndpointPool
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.requests = 0
+
+    def create(self, **kwargs):
+        self.requests += 1
+        message = SimpleNamespace(content=f"回复{self.requests}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def _client(tmp_path, **cache_kwargs):
+    completions = FakeCompletions()
+    sdk = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    client = ModelClient('key', 'http://replica', cache=ResponseCache(str(tmp_path / 'cache.sqlite'), **cache_kwargs),
+                         model='test-model')
+    client._pool = EndpointPool([Endpoint('http://replica', client=sdk, async_client=None)])
+    return client, completions
+
+
+def _ask(client: ModelClient, stage: str, text: str = '你好', temperature: float = 0.8) -> str:
+    return client.chat([{'role': 'user', 'content': text}], stage=stage, temperature=temperature)
+
+
+def test_identical_request_hits_cache(tmp_path):
+    client, completions = _client(tmp_path)
+    assert _ask(client, 'scene_description') == '回复1'
+    assert _ask(client, 'scene_description') == '回复1'
+    assert completions.requests == 1
+    # 消息或采样参数变化时缓存键不同，重新请求模型
+    assert _ask(client, 'scene_description', text='另一张图') == '回复2'
+    assert _ask(client, 'scene_description', temperature=0.1) == '回复3'
+    assert client.cache.stats()['hits'] == 1
+    assert client.metrics.report()['stages']['scene_description']['cache_hits'] == 1
+
+
+def test_bypassed_stage_always_requests_model(tmp_path):
+    client, completions = _client(tmp_path, bypass_stages=['pair_judge'])
+    _ask(client, 'pair_judge')
+    _ask(client, 'pair_judge')
+    assert completions.requests == 2
+    assert client.cache.stats()['entries'] == 0
+
+
+def test_invalidate_clears_only_the_given_stage(tmp_path):
+    client, completions = _client(tmp_path)
+    _ask(client, 'scene_description', text='描述场景')
+    _ask(client, 'pair_judge', text='判断配对')
+    assert client.cache.invalidate('pair_judge') == 1
+    _ask(client, 'scene_description', text='描述场景')
+    assert completions.requests == 2
+    assert _ask(client, 'pair_judge', text='判断配对') == '回复3'
+    assert client.cache.invalidate() == 2
+    assert client.cache.stats()['entries'] == 0
@@ -0,0 +1,71 @@
+import json
+import os
+
+import pytest
+
+from dataset_writer import DATA_DIR, INDEX_FILE, MANIFEST_FILE, DatasetReader, DatasetWriter
+
+
+def _items(image_dir, n: int, start: int = 0):
+    images = []
+    for i in range(3):
+        path = os.path.join(image_dir, f"{i}.jpg")
+        with open(path, 'wb') as f:
+            f.write(f"image-{i}".encode('utf-8'))
+        images.append(path)
+    return [{'id': f"qa-{i}", 'images': [images[i % 3], images[(i + 1) % 3]], 'answer': '塔吊' * 20}
+            for i in range(start, start + n)]
+
+
+def _read_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip_with_rotation(tmp_path, compress):
+    image_dir = tmp_path / 'raw'
+    image_dir.mkdir()
+    output_dir = str(tmp_path / 'dataset')
+    items = _items(str(image_dir), 30)
+    flushed = []
+    with DatasetWriter(output_dir, image_mode='copy', max_shard_bytes=1024, compress=compress,
+                       block_bytes=512) as writer:
+        for item in items:
+            writer.write(item, on_flushed=lambda item_id=item['id']: flushed.append(item_id))
+    # 压缩分片按块写出，close 后全部回调都已调用
+    assert flushed == [item['id'] for item in items]
+    assert writer.stats['shards'] > 1
+    assert len(os.listdir(os.path.join(output_dir, DATA_DIR))) == writer.stats['shards']
+    # 同一张图片只存放一份
+    assert writer.stats['images_stored'] == 3
+
+    manifest = _read_jsonl(os.path.join(output_dir, MANIFEST_FILE))
+    assert [entry['id'] for entry in manifest] == [item['id'] for item in items]
+    assert manifest[0]['images'][0]['source'] == items[0]['images'][0]
+    assert len(_read_jsonl(os.path.join(output_dir, INDEX_FILE))) == len(items)
+
+    reader = DatasetReader(output_dir)
+    assert len(reader) == len(items) and 'qa-7' in reader
+    item = reader.get('qa-7')
+    assert item['answer'] == items[7]['answer']
+    with open(reader.image_path(item['images'][0]), 'rb') as f:
+        assert f.read() == b'image-1'
+    assert [item['id'] for item in reader] == [item['id'] for item in items]
+
+
+def test_resumed_writer_appends_new_shards(tmp_path):
+    image_dir = tmp_path / 'raw'
+    image_dir.mkdir()
+    output_dir = str(tmp_path / 'dataset')
+    with DatasetWriter(output_dir, image_mode='hardlink') as writer:
+        for item in _items(str(image_dir), 3):
+            writer.write(item)
+    with DatasetWriter(output_dir, image_mode='hardlink') as writer:
+        for item in _items(str(image_dir), 2, start=3):
+            writer.write(item)
+        # 图片哈希从 manifest 恢复，已存放的图片不再写入
+        assert writer.stats['images_stored'] == 0
+    assert sorted(os.listdir(os.path.join(output_dir, DATA_DIR))) == ['part-00000.jsonl', 'part-00001.jsonl']
+    reader = DatasetReader(output_dir)
+    assert [item['id'] for item in reader] == [f"qa-{i}" for i in range(5)]
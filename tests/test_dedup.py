@@ -0,0 +1,63 @@
+import random
+
+from dedup import HASH_BITS, HammingIndex, _dhash, _dhash_batch, cluster_duplicates, find_duplicates, hamming
+from journal import RunJournal
+
+
+def _pixels(seed: int):
+    rng = random.Random(seed)
+    return [rng.randrange(256) for _ in range(9 * 8)]
+
+
+def test_dhash_compares_adjacent_pixels():
+    # 每行亮度从左到右递增，每一位都是 1
+    assert _dhash(list(range(9)) * 8) == (1 << HASH_BITS) - 1
+    assert _dhash([0] * 72) == 0
+    rows = [_pixels(i) for i in range(5)]
+    assert _dhash_batch(rows) == [_dhash(pixels) for pixels in rows]
+
+
+def test_near_duplicate_pixels_have_small_distance():
+    pixels = _pixels(0)
+    brighter = [min(255, p + 2) for p in pixels]
+    assert hamming(_dhash(pixels), _dhash(brighter)) <= 6
+    assert hamming(_dhash(pixels), _dhash(_pixels(1))) > 6
+
+
+def test_hamming_index_matches_brute_force():
+    rng = random.Random(7)
+    values = {f"{i}.jpg": rng.getrandbits(HASH_BITS) for i in range(200)}
+    index = HammingIndex(max_distance=6)
+    for name, value in values.items():
+        index.add(name, value)
+    base = values['10.jpg']
+    for flips in (0, 3, 6, 7):
+        query = base
+        for bit in rng.sample(range(HASH_BITS), flips):
+            query ^= 1 << bit
+        expected = min(((name, hamming(query, value)) for name, value in values.items()
+                        if hamming(query, value) <= 6), key=lambda x: x[1], default=None)
+        assert index.nearest(query) == expected
+    assert index.nearest(base) == ('10.jpg', 0)
+
+
+def test_clusters_are_kept_across_runs(tmp_path):
+    hashes = {'a.jpg': f"d:{0:016x}", 'b.jpg': f"d:{0b111:016x}", 'c.jpg': f"d:{(1 << 40) - 1:016x}",
+              'd.jpg': 'c:same', 'e.jpg': 'c:same'}
+    journal = RunJournal(str(tmp_path / 'journal'), fsync=False)
+    result = cluster_duplicates(hashes, max_distance=6, journal=journal)
+    assert result.representatives == ['a.jpg', 'c.jpg', 'd.jpg']
+    assert result.clusters() == {'a.jpg': ['b.jpg'], 'd.jpg': ['e.jpg']}
+
+    # 增量运行：新图片与之前的代表图比较，之前的聚类结果不变
+    hashes['f.jpg'] = f"d:{0b11:016x}"
+    result = cluster_duplicates(hashes, max_distance=6, journal=journal)
+    assert result.duplicate_of == {'b.jpg': 'a.jpg', 'e.jpg': 'd.jpg', 'f.jpg': 'a.jpg'}
+
+
+def test_identical_files_are_duplicates(tmp_path):
+    for name, data in (('0.jpg', b'one'), ('1.jpg', b'two'), ('2.jpg', b'one')):
+        (tmp_path / name).write_bytes(data)
+    # 无法解码的文件退化为内容哈希，只合并完全相同的文件
+    result = find_duplicates(str(tmp_path), ['0.jpg', '1.jpg', '2.jpg'])
+    assert result.duplicate_of == {'2.jpg': '0.jpg'}
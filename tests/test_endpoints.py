@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import pytest
+
+from endpoints import Endpoint, EndpointPool
+from metrics import MetricsRecorder
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def _pool(delays, **kwargs):
+    endpoints = [Endpoint(f"http://replica-{i}", client=delay, async_client=delay)
+                 for i, delay in enumerate(delays)]
+    pool = EndpointPool(endpoints, metrics=MetricsRecorder(), **kwargs)
+    return pool, endpoints
+
+
+def _warm(pool: EndpointPool, latency: float, n: int = 20, stage: str = None):
+    for _ in range(n):
+        pool._samples(stage).append(latency)
+
+
+def test_sync_call_hedges_slow_replica():
+    pool, endpoints = _pool([1.0, 0.01], hedge_percentile=95)
+    _warm(pool, 0.02)
+
+    def request(delay):
+        time.sleep(delay)
+        return delay
+
+    start = time.perf_counter()
+    assert pool.call(request) == 0.01
+    assert time.perf_counter() - start < 0.5
+    assert pool.metrics.counters['hedged_requests'] == 1
+    assert pool.metrics.counters['hedge_wins'] == 1
+
+
+def test_non_retryable_error_keeps_replica_healthy():
+    pool, endpoints = _pool([0.0], failure_threshold=1)
+
+    def bad_request(_):
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        pool.call(bad_request)
+    assert endpoints[0].failures == 0
+    assert endpoints[0].healthy(time.monotonic())
+    assert endpoints[0].outstanding == 0
+
+    def overloaded(_):
+        raise StatusError(503)
+
+    with pytest.raises(StatusError):
+        pool.call(overloaded)
+    assert not endpoints[0].healthy(time.monotonic())
+
+
+def test_cancelled_caller_does_not_leak_request():
+    pool, endpoints = _pool([10.0, 10.0], hedge_percentile=95)
+    _warm(pool, 5.0)
+    started = []
+
+    async def request(delay):
+        started.append(delay)
+        await asyncio.sleep(delay)
+
+    async def scenario():
+        task = asyncio.ensure_future(pool.acall(request))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.01)
+        # 事件循环结束前检查，请求在调用方取消时即被取消
+        return [e.outstanding for e in endpoints]
+
+    assert asyncio.run(scenario()) == [0, 0]
+    assert started
+
+
+def test_hedge_delay_is_kept_per_stage():
+    pool, endpoints = _pool([0.3, 0.01], hedge_percentile=95)
+    _warm(pool, 0.02, stage='scene_description')
+    _warm(pool, 5.0, stage='pair_judge_batch')
+    assert pool.hedge_delay('scene_description') == 0.02
+    assert pool.hedge_delay('pair_judge_batch') == 5.0
+    assert pool.hedge_delay('qa') is None
+
+    def request(delay):
+        time.sleep(delay)
+        return delay
+
+    # 慢阶段的请求按本阶段的分位数等待，不会因为快阶段的阈值被对冲
+    assert pool.call(request, stage='pair_judge_batch') == 0.3
+    assert 'hedged_requests' not in pool.metrics.counters
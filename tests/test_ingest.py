@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from ingest import count_lines, iter_annotations, limit_items, shard_items, shard_of
+
+
+def _names(n: int):
+    return [f"{i}.jpg" for i in range(n)]
+
+
+@pytest.mark.parametrize('mode', ['hash', 'range'])
+def test_shards_partition_the_stream(mode):
+    names = _names(100)
+    shards = [list(shard_items(iter(names), 4, i, mode=mode, total=len(names))) for i in range(4)]
+    # 各分片互不重叠，合起来恰好是全部数据
+    assert sorted(sum(shards, [])) == sorted(names)
+    assert all(shards)
+
+
+def test_hash_shard_depends_only_on_name():
+    names = _names(50)
+    forward = list(shard_items(names, 3, 1))
+    backward = list(shard_items(reversed(names), 3, 1))
+    assert sorted(forward) == sorted(backward)
+    assert all(shard_of(name, 3) == 1 for name in forward)
+
+
+def test_range_shards_are_contiguous():
+    names = _names(10)
+    assert list(shard_items(names, 3, 0, mode='range', total=10)) == names[:3]
+    assert list(shard_items(names, 3, 2, mode='range', total=10)) == names[6:]
+    with pytest.raises(ValueError):
+        list(shard_items(names, 3, 0, mode='range'))
+    with pytest.raises(ValueError):
+        list(shard_items(names, 3, 3))
+
+
+def test_annotations_are_read_lazily_and_sharded(tmp_path):
+    path = tmp_path / 'annotations.jsonl'
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(20):
+            f.write(json.dumps({'image': f"raw/{i}.jpg", 'objects': ['塔吊'], 'scene': '工地', 'anomaly': False},
+                               ensure_ascii=False) + '\n')
+        f.write('\n')
+    assert count_lines(str(path)) == 20
+
+    items = shard_items(iter_annotations(str(path), '/data'), 2, 0, key=lambda item: item[0])
+    selected = dict(limit_items(items, limit=3, offset=1))
+    assert len(selected) == 3
+    for name, annotation in selected.items():
+        assert shard_of(name, 2) == 0
+        assert annotation['image_path'] == f"/data/raw/{name}"
@@ -0,0 +1,42 @@
+from analyzer import ImageAnalyzer
+from journal import RunJournal
+
+
+def test_records_survive_reopen_and_torn_last_line(tmp_path):
+    journal = RunJournal(str(tmp_path), fsync=False)
+    journal.record(RunJournal.ANALYZE, '0.jpg', {'description': '工地'})
+    journal.record(RunJournal.PAIR, RunJournal.pair_key('0.jpg', '1.jpg'), {'match': False})
+    journal.close()
+    # 模拟写到一半时进程中断
+    with open(tmp_path / 'analyze.jsonl', 'a', encoding='utf-8') as f:
+        f.write('{"key": "1.jpg", "val')
+
+    journal = RunJournal(str(tmp_path), fsync=False)
+    assert journal.records(RunJournal.ANALYZE) == {'0.jpg': {'description': '工地'}}
+    assert journal.has(RunJournal.PAIR, '0.jpg|1.jpg')
+    # 半行之后追加的新记录不与其粘连
+    journal.record(RunJournal.ANALYZE, '2.jpg', {'description': '仓库'})
+    journal.close()
+    assert set(RunJournal(str(tmp_path)).records(RunJournal.ANALYZE)) == {'0.jpg', '2.jpg'}
+
+    journal.reset()
+    assert not RunJournal(str(tmp_path)).records(RunJournal.ANALYZE)
+
+
+def test_resumed_pairing_reuses_journal(tmp_path, fake_client, make_infos):
+    infos = make_infos(6)
+
+    def run():
+        journal = RunJournal(str(tmp_path), fsync=False)
+        client = fake_client()
+        pairs = ImageAnalyzer(client, journal=journal).create_reference_pairs(infos, top_k=3)
+        journal.close()
+        return client, pairs
+
+    first_client, first_pairs = run()
+    assert first_client.metrics.usage(['pair_judge'])['calls'] == len(first_pairs) > 0
+
+    second_client, second_pairs = run()
+    # 已判断过的候选对从日志恢复，不再请求模型
+    assert not second_client.metrics.usage(['pair_judge'])['calls']
+    assert second_pairs == first_pairs
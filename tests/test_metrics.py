@@ -0,0 +1,17 @@
+from metrics import MetricsRecorder
+
+
+def test_cache_hits_are_counted_but_kept_out_of_latency():
+    metrics = MetricsRecorder()
+    metrics.record_call('pair_judge', 2.0, prompt_tokens=100, completion_tokens=10)
+    metrics.record_call('pair_judge', 4.0, prompt_tokens=100, completion_tokens=10)
+    for _ in range(8):
+        metrics.record_call('pair_judge', 0.001, cached=True)
+
+    summary = metrics.report()['stages']['pair_judge']
+    assert summary['calls'] == 10
+    assert summary['cache_hits'] == 8
+    assert summary['latency']['mean'] == 3.0
+    assert summary['latency']['p50'] == 3.0
+    assert metrics.usage(['pair_judge']) == {'calls': 2, 'tokens': 220}
+    assert 'refgen_model_latency_seconds_count{stage="pair_judge"} 2' in metrics.to_prometheus()
@@ -0,0 +1,25 @@
+from planner import RunPlanner
+
+
+def test_plan_applies_target_and_call_budget(make_image_dir):
+    image_dir, annotations = make_image_dir(20)
+    planner = RunPlanner(match_rate=0.5)
+    unlimited = planner.plan(image_dir, annotations)
+    assert unlimited['pairs']['skipped'] == 0
+
+    plan = planner.plan(image_dir, annotations, target_pairs=4)
+    assert plan['stages']['pair_judge']['calls'] == plan['pairs']['to_judge'] == 8
+    assert plan['expected_qa_pairs'] == 4
+    assert plan['pairs']['to_judge'] + plan['pairs']['skipped'] == unlimited['pairs']['candidates']
+
+    plan = planner.plan(image_dir, annotations, call_budget=3)
+    assert plan['stages']['pair_judge']['calls'] == 3
+
+
+def test_plan_applies_per_image_cap_to_batches(make_image_dir):
+    image_dir, annotations = make_image_dir(20)
+    plan = RunPlanner(match_rate=1.0).plan(image_dir, annotations, batch_tokens=4000, max_per_image=1)
+    # 每张图片最多参与一个问答，20 张图片最多 10 个问答
+    assert plan['expected_qa_pairs'] <= 10
+    assert plan['pairs']['to_judge'] == plan['expected_qa_pairs']
+    assert plan['pairs']['to_judge'] + plan['pairs']['skipped'] == plan['pairs']['candidates']
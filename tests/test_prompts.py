@@ -0,0 +1,31 @@
+import copy
+
+from prompts import PromptBuilder, estimate_tokens
+
+
+def test_estimate_tokens_weights_cjk_and_other_characters():
+    assert estimate_tokens('') == 0
+    chinese = estimate_tokens('塔吊' * 100)
+    ascii_json = estimate_tokens('{"ab":1}' * 25)
+    # 同样 200 个字符，中文的 token 数明显多于 ASCII/JSON，二者都少于字符数
+    assert ascii_json < chinese < 200
+
+
+def test_fragment_cache_hits_on_equal_content():
+    builder = PromptBuilder()
+    info = {'annotation': {'objects': ['塔吊'], 'scene': '工地'}, 'description': '{"塔吊": "黄色"}'}
+    first = builder.image_fragment('a.jpg', info)
+    # 从存储重新读出的信息是内容相同的新对象
+    assert builder.image_fragment('a.jpg', copy.deepcopy(info)) is first
+
+    changed = copy.deepcopy(info)
+    changed['description'] = '{"塔吊": "红色"}'
+    assert builder.image_fragment('a.jpg', changed) != first
+
+
+def test_truncation_respects_budget():
+    builder = PromptBuilder(token_budget=300)
+    long_info = {'annotation': {'objects': ['塔吊']}, 'description': '黄色塔吊正在吊装钢构件' * 100}
+    prompt = builder.pair_judge('a.jpg', long_info, 'b.jpg', long_info)
+    assert estimate_tokens(prompt) <= 300
+    assert builder.counters['pair_judge_prompts_truncated'] == 1
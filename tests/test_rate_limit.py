@@ -0,0 +1,96 @@
+import threading
+import time
+
+from rate_limit import AdaptiveConcurrencyLimiter, CircuitBreaker, RequestController
+
+
+def _complete(limiter: AdaptiveConcurrencyLimiter, latency: float, n: int = 1):
+    for _ in range(n):
+        limiter.acquire()
+        limiter.release(latency=latency)
+
+
+def test_limit_recovers_after_single_fast_outlier():
+    limiter = AdaptiveConcurrencyLimiter(initial=16, max_limit=64, cooldown=0.0, min_window=32)
+    # 一次异常快的请求（如缓存预热或查询模型id）之后延迟恢复正常
+    _complete(limiter, 0.005)
+    _complete(limiter, 0.2, 10)
+    assert limiter.limit < 16
+
+    _complete(limiter, 0.2, 500)
+    assert limiter.min_latency > 0.1
+    assert limiter.limit >= 16
+
+
+def test_sustained_latency_increase_still_backs_off():
+    limiter = AdaptiveConcurrencyLimiter(initial=16, cooldown=0.0, min_window=64)
+    _complete(limiter, 0.2, 20)
+    _complete(limiter, 1.0, 10)
+    assert limiter.limit < 16
+
+
+def test_calls_not_marked_as_samples_do_not_move_baseline():
+    limiter = AdaptiveConcurrencyLimiter(initial=4)
+    controller = RequestController(concurrency=limiter)
+    result, retries = controller.call(lambda: 'ok', latency_sample=False)
+    assert (result, retries) == ('ok', 0)
+    assert limiter.min_latency is None
+    assert limiter.in_flight == 0
+
+
+def test_latency_sample_decided_by_result():
+    limiter = AdaptiveConcurrencyLimiter(initial=4)
+    controller = RequestController(concurrency=limiter)
+    controller.call(lambda: 'stopped', latency_sample=lambda result: result != 'stopped')
+    assert limiter.min_latency is None
+    controller.call(lambda: 'ok', latency_sample=lambda result: result != 'stopped')
+    assert limiter.min_latency is not None
+
+
+def test_retry_bypasses_limiter_and_retries_transient_errors():
+    limiter = AdaptiveConcurrencyLimiter(initial=1)
+    controller = RequestController(concurrency=limiter, base_delay=0.0)
+    attempts = []
+
+    def lookup():
+        attempts.append(limiter.in_flight)
+        if len(attempts) < 3:
+            raise TimeoutError()
+        return 'model-id'
+
+    assert controller.retry(lookup) == 'model-id'
+    assert attempts == [0, 0, 0]
+    assert limiter.min_latency is None
+
+
+def test_baselines_are_kept_per_kind():
+    limiter = AdaptiveConcurrencyLimiter(initial=16, cooldown=0.0, min_window=64)
+    for _ in range(20):
+        for kind, latency in (('scene_description', 0.2), ('pair_judge_batch', 2.0)):
+            limiter.acquire()
+            limiter.release(latency=latency, kind=kind)
+    # 批量判断的请求本身更慢，不会相对单图请求的基准被判为拥塞
+    assert limiter.limit >= 16
+    assert limiter.baseline('scene_description') < limiter.baseline('pair_judge_batch')
+    assert limiter.min_latency == limiter.baseline('scene_description')
+
+
+def test_callers_wait_for_half_open_trial_without_using_retries():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.on_failure()
+    controller = RequestController(max_retries=0, base_delay=0.01, breaker=breaker)
+    time.sleep(0.06)
+    trial_started = threading.Event()
+
+    def trial():
+        trial_started.set()
+        time.sleep(0.1)
+        return 'trial'
+
+    thread = threading.Thread(target=controller.call, args=(trial,))
+    thread.start()
+    trial_started.wait()
+    # 试探请求进行中，其他请求等待其结果而不是以 CircuitOpenError 失败
+    assert controller.call(lambda: 'ok') == ('ok', 0)
+    thread.join()
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from analyzer import ImageAnalyzer
+from journal import RunJournal
+from main import seed_scheduler
+from pipeline import GenerationPipeline
+from scheduler import PairScheduler
+from store import CorpusStore
+
+
+def test_admit_batch_reserves_in_flight_pairs(make_infos):
+    infos = make_infos(4)
+    scheduler = PairScheduler(target_pairs=2)
+    batch = [('0.jpg', '1.jpg'), ('0.jpg', '2.jpg'), ('1.jpg', '3.jpg')]
+    admitted, deferred = scheduler.admit_batch(batch, infos)
+    assert admitted == batch[:2]
+    assert deferred == batch[2:]
+    # 名额被进行中的候选对占满，不再接纳
+    assert not scheduler.admit('2.jpg', '3.jpg', infos)
+
+    scheduler.record('0.jpg', '1.jpg', None, infos)
+    assert scheduler.in_flight == 1
+    assert scheduler.admit('1.jpg', '3.jpg', infos)
+    scheduler.record('0.jpg', '2.jpg', {'question': 'q', 'answer': 'a'}, infos)
+    scheduler.record('1.jpg', '3.jpg', {'question': 'q', 'answer': 'a'}, infos)
+    assert scheduler.in_flight == 0
+    assert scheduler.done
+
+
+def test_staged_batches_do_not_overshoot_target(fake_client, make_infos):
+    analyzer = ImageAnalyzer(fake_client())
+    scheduler = PairScheduler(target_pairs=5)
+    pairs = analyzer.create_reference_pairs(make_infos(), top_k=4, batch_tokens=4000, max_batch_pairs=8,
+                                            scheduler=scheduler)
+    assert len(pairs) == 5
+    assert scheduler.produced == 5
+
+
+def test_staged_judges_pairs_deferred_by_last_batch(fake_client, make_infos):
+    scheduler = PairScheduler(target_pairs=2)
+    pairs = ImageAnalyzer(fake_client(rejected_batches=1)).create_reference_pairs(
+        make_infos(4), top_k=None, batch_tokens=4000, max_batch_pairs=8, scheduler=scheduler)
+    # 全部 6 个候选对装入一批，截断后暂缓的 4 个在第一批都不配对后继续判断
+    assert len(pairs) == 2
+    assert scheduler.in_flight == 0
+
+
+def test_pipeline_written_within_target(tmp_path, fake_client, make_image_dir):
+    image_dir, annotations = make_image_dir(24)
+    output_file = tmp_path / 'out.jsonl'
+    scheduler = PairScheduler(target_pairs=6)
+    pipeline = GenerationPipeline(ImageAnalyzer(fake_client()), image_dir, annotations, str(output_file),
+                                  top_k=4, pair_concurrency=4, batch_tokens=4000, max_batch_pairs=4,
+                                  scheduler=scheduler)
+    stats = asyncio.run(pipeline.run())
+    with open(output_file, encoding='utf-8') as f:
+        written = sum(1 for _ in f)
+    assert stats['written'] == written
+    assert written <= 6
+    assert scheduler.produced == 6
+
+
+@pytest.mark.parametrize('state_store', ['journal', 'sqlite'])
+def test_resumed_pipeline_keeps_target(tmp_path, fake_client, make_image_dir, state_store):
+    image_dir, annotations = make_image_dir(16)
+    output_file = tmp_path / 'out.jsonl'
+
+    def run(image_files):
+        journal = RunJournal(str(tmp_path / 'journal'))
+        store = CorpusStore(str(tmp_path / 'state.sqlite')) if state_store == 'sqlite' else None
+        client = fake_client()
+        scheduler = PairScheduler(target_pairs=5)
+        seed_scheduler(scheduler, journal, store)
+        pipeline = GenerationPipeline(ImageAnalyzer(client, journal=journal, store=store), image_dir, annotations,
+                                      str(output_file), top_k=4, pair_concurrency=4, scheduler=scheduler)
+        asyncio.run(pipeline.run(image_files=image_files))
+        if store is not None:
+            store.close()
+        journal.close()
+        return client
+
+    names = list(annotations)
+    run(names[8:])
+    # 续跑时新图片先到达，先遇到的候选对都不是之前运行已写出的
+    client = run(names)
+    with open(output_file, encoding='utf-8') as f:
+        assert sum(1 for _ in f) == 5
+    # 之前运行已写出的问答达到目标，续跑时不再请求模型
+    assert not client.metrics.usage(('pair_judge', 'scene_description'))['calls']
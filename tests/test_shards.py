@@ -0,0 +1,59 @@
+import json
+import os
+
+import pytest
+
+from dataset_writer import DatasetReader, DatasetWriter
+from shards import merge_shards, shard_dir
+
+
+def _write_shard(output_dir, index, items, raw_dir, compress=False):
+    directory = shard_dir(output_dir, index, 2)
+    with DatasetWriter(directory, compress=compress) as writer:
+        for item_id, ref, test in items:
+            writer.write({'id': item_id, 'images': [os.path.join(raw_dir, ref), os.path.join(raw_dir, test)],
+                          'conversations': []})
+    return directory
+
+
+@pytest.fixture
+def raw_dir(tmp_path):
+    directory = tmp_path / 'raw'
+    directory.mkdir()
+    for i in range(4):
+        (directory / f'{i}.jpg').write_bytes(f'image-{i}'.encode())
+    return str(directory)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_merge_sharded_layout(tmp_path, raw_dir, compress):
+    output_dir = str(tmp_path / 'out')
+    _write_shard(output_dir, 0, [('p1', '0.jpg', '1.jpg'), ('p2', '1.jpg', '2.jpg')], raw_dir, compress)
+    _write_shard(output_dir, 1, [('p2', '1.jpg', '2.jpg'), ('p3', '2.jpg', '3.jpg')], raw_dir, compress)
+
+    stats = merge_shards(output_dir, os.path.join(output_dir, 'multimodal_data.jsonl'), num_shards=2,
+                         compress=compress)
+    assert stats['layout'] == 'sharded'
+    assert (stats['read'], stats['written'], stats['duplicates']) == (4, 3, 1)
+
+    reader = DatasetReader(output_dir)
+    assert sorted(reader.index) == ['p1', 'p2', 'p3']
+    for item in reader:
+        for path in item['images']:
+            # 图片路径相对合并后的输出目录
+            assert not os.path.isabs(path)
+            assert os.path.exists(reader.image_path(path))
+
+
+def test_merge_rejects_mixed_layouts(tmp_path, raw_dir):
+    output_dir = str(tmp_path / 'out')
+    _write_shard(output_dir, 0, [('p1', '0.jpg', '1.jpg')], raw_dir)
+    jsonl_shard = shard_dir(output_dir, 1, 2)
+    os.makedirs(jsonl_shard)
+    with open(os.path.join(jsonl_shard, 'multimodal_data.jsonl'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'id': 'p2', 'images': [], 'conversations': []}) + '\n')
+
+    merged = os.path.join(output_dir, 'multimodal_data.jsonl')
+    with pytest.raises(ValueError):
+        merge_shards(output_dir, merged, num_shards=2)
+    assert not os.path.exists(merged)
@@ -0,0 +1,53 @@
+from store import CorpusStore
+
+
+def _info(i: int):
+    return {'annotation': {'objects': ['塔吊'], 'scene': '工地'}, 'description': f"描述{i}"}
+
+
+def test_infos_and_new_images_follow_runs(tmp_path):
+    path = str(tmp_path / 'state.sqlite')
+    store = CorpusStore(path, batch_size=2, cache_size=2)
+    for i in range(3):
+        store.save_image(f"{i}.jpg", _info(i))
+    store.save_pair('0.jpg', '1.jpg', True, {'question': 'q', 'answer': 'a'})
+    store.save_pair('0.jpg', '2.jpg', False, None)
+    assert list(store.infos()) == ['0.jpg', '1.jpg', '2.jpg']
+    assert store.new_image_names() == ['0.jpg', '1.jpg', '2.jpg']
+    store.close()
+
+    store = CorpusStore(path, cache_size=2)
+    assert store.run == 2
+    # 复用一张旧图片并分析一张新图片，本次运行的视图只包含这两张
+    assert store.restore_image('1.jpg') == _info(1)
+    store.save_image('3.jpg', _info(3))
+    infos = store.infos()
+    assert list(infos) == ['1.jpg', '3.jpg'] and len(infos) == 2
+    assert infos['0.jpg'] == _info(0) and '9.jpg' not in infos
+    assert list(store.infos(current_run=False)) == ['0.jpg', '1.jpg', '2.jpg', '3.jpg']
+    assert store.new_image_names() == ['3.jpg']
+
+    # 只有本次运行判断或复用的配对成功问答出现在 matched_pairs 中
+    assert not store.matched_pairs()
+    assert store.restore_pair('0.jpg', '1.jpg') == {'match': True, 'qa_pair': {'question': 'q', 'answer': 'a'}}
+    assert store.restore_pair('0.jpg', '2.jpg') == {'match': False, 'qa_pair': None}
+    assert list(store.matched_pairs()) == [
+        {'reference': '0.jpg', 'test': '1.jpg', 'qa_pair': {'question': 'q', 'answer': 'a'}}]
+    store.close()
+
+
+def test_written_pairs_are_tracked_across_runs(tmp_path):
+    path = str(tmp_path / 'state.sqlite')
+    store = CorpusStore(path, batch_size=100)
+    assert not store.has_written()
+    store.mark_written('0.jpg', '1.jpg', 'qa-0')
+    # 缓冲中尚未提交的记录同样可见
+    assert store.is_written('0.jpg', '1.jpg') and store.has_written()
+    store.mark_written('2.jpg', '3.jpg')
+    store.close()
+
+    store = CorpusStore(path)
+    assert store.is_written('2.jpg', '3.jpg')
+    assert not store.is_written('1.jpg', '0.jpg')
+    assert list(store.written_pairs()) == [('0.jpg', '1.jpg'), ('2.jpg', '3.jpg')]
+    store.close()
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+from streaming import JsonStreamParser, consume_stream, extract_json
+
+
+def _chunks(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_extract_json_skips_stray_brace_in_prose():
+    assert extract_json('He said "{" then {"match": true}', '{', ('match',)) == {'match': True}
+    assert extract_json('先看 { 这个括号，结果：{"match": false}', '{', ('match',)) == {'match': False}
+
+
+def test_extract_json_skips_invalid_and_incomplete_candidates():
+    content = '示例 {"match": 是} 草稿 {"question": "q"} 最终 {"match": true, "question": "{q}"}'
+    assert extract_json(content, '{', ('match',)) == {'match': True, 'question': '{q}'}
+    assert extract_json('没有 JSON', '{') is None
+    assert extract_json('{"match": true', '{', ('match',)) is None
+
+
+def test_extract_json_array_root():
+    content = '```json\n[{"id": "P1", "match": true}, {"id": "P2", "match": false}]\n```'
+    assert extract_json(content, '[', ('id',)) == [{'id': 'P1', 'match': True}, {'id': 'P2', 'match': False}]
+    assert extract_json('[1, 2] 然后 [{"id": "P1"}]', '[', ('id',)) == [{'id': 'P1'}]
+
+
+def test_parser_completes_across_chunks():
+    text = '好的 [注意] 结果如下：{"match": true, "answer": "转义 \\" 和 }"} 以上。'
+    for size in (1, 3, 7, len(text)):
+        parser = JsonStreamParser('{', ('match',))
+        done = [parser.feed(chunk) for chunk in _chunks(text, size)]
+        assert parser.complete and done[-1]
+        assert parser.value == {'match': True, 'answer': '转义 " 和 }'}
+        assert parser.json_text == '{"match": true, "answer": "转义 \\" 和 }"}'
+
+
+def test_consume_stream_retries_unclosed_start_at_end():
+    text = 'He said "{" then {"match": true}'
+    chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=part), finish_reason=None)])
+              for part in _chunks(text, 4)]
+
+    class Stream(list):
+        def close(self):
+            pass
+
+    response = consume_stream(Stream(chunks), JsonStreamParser('{', ('match',)), [])
+    assert response.content == '{"match": true}'
+    assert response.parser.value == {'match': True}